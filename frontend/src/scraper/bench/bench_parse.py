@@ -0,0 +1,105 @@
+# Micro-benchmark of restaurant page state extraction: full pageManifest decode vs targeted extraction
+#
+# Usage: python bench/bench_parse.py [--corpus DIR] [--repeat N]
+
+import sys
+import json
+import argparse
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from scraper_utils import find_nested_key, extract_nested_key, json_loads
+from parsers import get_page_data
+
+
+TARGET = "RestaurantPresentation_searchRestaurantsByGeo"
+
+
+def synthetic_page(i: int, num_entries: int = 60, padding: int = 4000) -> str:
+    """Builds a restaurant page shaped like TripAdvisor's, with the target buried among other urqlCache entries
+
+    Args:
+        i (int): Restaurant number
+        num_entries (int, optional): Number of unrelated urqlCache entries. Defaults to 60.
+        padding (int, optional): Approximate size of each unrelated entry. Defaults to 4000.
+
+    Returns:
+        str: Page HTML
+    """
+    rst = {
+        "name": f"Restaurant {i}",
+        "localizedRealtimeAddress": f"{i} Main St, Los Angeles, CA",
+        "telephone": "+1 555 0100",
+        "reviewSummary": {"rating": 4.5, "count": 100 + i},
+        "topTags": [{"tag": {"localizedName": "Mid-range"}, "secondary_name": "$$ - $$$"}]
+    }
+    results = {}
+    for j in range(num_entries):
+        results[f"{j:08x}"] = {"data": json.dumps({f"Query_{j}": {"items": ["x" * 40] * (padding // 40)}})}
+    results["target"] = {"data": json.dumps({TARGET: {"restaurants": [rst]}})}
+    manifest = {"assets": ["/static/app.js"] * 200, "urqlCache": {"results": results}, "redux": {"page": "x" * 20000}}
+    manifest = json.dumps(manifest, separators = (",", ":"))
+    return f"<html><head><script>window.__WEB_CONTEXT__={{pageManifest:{manifest}}};</script></head><body></body></html>"
+
+
+def load_pages(corpus: Path | None, num_pages: int) -> list[str]:
+    if corpus is None:
+        return [synthetic_page(i) for i in range(num_pages)]
+    pages = [f.read_text(errors = "ignore") for f in sorted(corpus.glob("*.body"))]
+    pages = [p for p in pages if "urqlCache" in p and TARGET in p]
+    if len(pages) == 0:
+        raise RuntimeError(f"No restaurant pages found in {corpus}")
+    return pages[:num_pages]
+
+
+def full_path(html: str) -> dict:
+    data = get_page_data(html)["urqlCache"]["results"]
+    return find_nested_key(data, TARGET)
+
+
+def targeted_path(html: str) -> dict:
+    return extract_nested_key(html, TARGET) # type: ignore
+
+
+def main(args: argparse.Namespace):
+    pages = load_pages(Path(args.corpus) if args.corpus else None, args.pages)
+    size = sum(len(p) for p in pages) / len(pages)
+    print(f"{len(pages)} pages, {size / 1024:.0f} KB average, JSON backend: {json_loads.__module__}")
+
+    for page in pages:
+        if full_path(page) != targeted_path(page):
+            raise RuntimeError("Targeted extraction does not match full decode")
+
+    results = {}
+    for name, func in [("full", full_path), ("targeted", targeted_path)]:
+        t = min(timeit.repeat(lambda: [func(p) for p in pages], number = 1, repeat = args.repeat))
+        results[name] = t / len(pages)
+        print(f"{name:>10}: {results[name] * 1e6:9.1f} us/page  {1 / results[name]:9.0f} pages/s")
+    print(f"{'speedup':>10}: {results['full'] / results['targeted']:9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Page state extraction benchmark")
+    parser.add_argument(
+        "--corpus",
+        action = "store",
+        help = "record/replay corpus directory to read real restaurant pages from"
+    )
+    parser.add_argument(
+        "--pages",
+        action = "store",
+        help = "number of pages to benchmark",
+        type = int,
+        default = 50
+    )
+    parser.add_argument(
+        "--repeat",
+        action = "store",
+        help = "number of timed repetitions",
+        type = int,
+        default = 5
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,330 @@
+# Offline benchmark suite for the scraper's hot paths, compared against checked-in baselines
+#
+# Usage: python bench/bench_suite.py [--sizes 10000,100000,1000000] [--only NAME ...] [--save] [--check]
+#
+# Inputs are built from data/*.json (see corpus.py). Everything is written to a scratch directory and
+# database, so scrape.db and data/ are never touched. Throughput is the median of --repeat timed runs and
+# peak memory comes from one extra run under tracemalloc. Startup benchmarks time fresh interpreters,
+# so only their throughput is meaningful. Benchmarks bound by disk and SQLite vary more from run to run,
+# so their throughput is checked against the wider IO_TOLERANCE.
+
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import statistics
+import tempfile
+import subprocess
+import functools
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+SCRATCH_PATH = Path(tempfile.mkdtemp(prefix = "utravel-bench-"))
+os.environ["SCRAPE_DB"] = str(SCRATCH_PATH / "scrape.db")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lxml import etree
+from loguru import logger
+from sqlalchemy import select, func
+
+import scraper_ta
+import typesense_utils
+from database import engine, Base, Location, Restaurant
+from parsers import get_page_data, parse_search_fields, parse_rst_fields
+from scraper_utils import ScraperClient, find_nested_key, extract_nested_key, hash_str_array, save_json, save_all
+from writer import DatabaseWriter
+from replay import Corpus, ReplayServer, ReplayTransport, ReplayDriver
+from corpus import RST_KEY, load_rows, scale_rows, search_page, restaurant_page
+
+
+BASELINE_PATH = Path(__file__).resolve().parent / "baselines.json"
+SIZES = [10_000, 100_000, 1_000_000] # Rows for save_json, save_all, clean and to_jsonl
+TOLERANCE = 0.25 # Fraction of throughput lost or memory gained before a result counts as a regression
+IO_TOLERANCE = 0.5 # Fraction of throughput lost before a disk or database bound result counts as a regression
+REPEAT = 5
+NUM_SEARCH_PAGES = 100
+NUM_RST_PAGES = 100
+HASH_ROWS = 100_000
+REPLAY_PAGES = 10 # Search pages in the replayed crawl
+REPLAY_PER_PAGE = 30
+REPLAY_URL = "https://www.tripadvisor.com/Restaurants-g1-Bench.html"
+STARTUP_RUNS = 5 # Fresh interpreters per timed startup run
+STARTUP_COMMANDS = {
+    "import scraper_ta": ["-c", "import scraper_ta"],
+    "scraper_ta --read": ["scraper_ta.py", "--csv", "test", "--read"]
+}
+
+
+def reset_db():
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+
+
+def measure(name: str,
+            unit: str,
+            items: int,
+            run: Callable,
+            setup: Callable | None = None,
+            repeat: int | None = None,
+            io: bool = False) -> dict:
+    """Times a benchmark and records its peak memory
+
+    Args:
+        name (str): Benchmark name, also its key in the baselines
+        unit (str): What items are, e.g. "pages"
+        items (int): Items processed per run
+        run (Callable): Runs the benchmark once, given the result of setup
+        setup (Callable | None, optional): Untimed preparation before every run. Defaults to None.
+        repeat (int | None, optional): Timed runs - the median counts. Defaults to REPEAT.
+        io (bool, optional): Whether disk or database writes dominate, which widens its tolerance. Defaults to False.
+
+    Returns:
+        dict: Items, median time, throughput, peak memory and throughput tolerance
+    """
+    def prepare():
+        state = setup() if setup is not None else None
+        gc.collect()
+        return state
+
+    times = []
+    for _ in range(repeat or REPEAT):
+        state = prepare()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    state = prepare()
+    tracemalloc.start()
+    run(state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # The median shrugs off a single run slowed by the OS, which the best or the mean would not
+    median = statistics.median(times)
+    result = {
+        "name": name,
+        "unit": unit,
+        "items": items,
+        "seconds": round(median, 6),
+        "throughput": round(items / median, 3),
+        "peak_mb": round(peak / 2**20, 3),
+        "tolerance": IO_TOLERANCE if io else None
+    }
+    print(f"{name:<32} {items:>9} {unit:<6} {median:9.3f}s {result['throughput']:>14,.1f} {unit}/s {result['peak_mb']:>10.1f} MB", flush = True)
+    return result
+
+
+def bench_parsers(rows: list[dict]) -> list[dict]:
+    per_page = 30
+    search_pages = [search_page(rows[i * per_page:(i + 1) * per_page], len(rows)) for i in range(NUM_SEARCH_PAGES)]
+    rst_pages = [restaurant_page(row) for row in rows[:NUM_RST_PAGES]]
+    for html in rst_pages:
+        if parse_rst_fields(html).get("name") is None or extract_nested_key(html, RST_KEY) is None:
+            raise RuntimeError("Restaurant page corpus does not parse")
+    return [
+        measure("parse_search_page", "pages", len(search_pages),
+                lambda _: [scraper_ta.parse_search_page(etree.HTML(html, None)) for html in search_pages]),
+        measure("parse_search_fields", "pages", len(search_pages),
+                lambda _: [parse_search_fields(html) for html in search_pages]),
+        measure("get_page_data+find_nested_key", "pages", len(rst_pages),
+                lambda _: [find_nested_key(get_page_data(html)["urqlCache"]["results"], RST_KEY) for html in rst_pages]),
+        measure("extract_nested_key", "pages", len(rst_pages),
+                lambda _: [extract_nested_key(html, RST_KEY) for html in rst_pages]),
+        measure("parse_rst_fields", "pages", len(rst_pages),
+                lambda _: [parse_rst_fields(html) for html in rst_pages])
+    ]
+
+
+def bench_hash(rows: list[dict]) -> list[dict]:
+    keys = [[row["address"], row["name"]] for row in scale_rows(rows, HASH_ROWS)]
+    return [measure("hash_str_array", "calls", len(keys), lambda _: [hash_str_array(k) for k in keys])]
+
+
+def bench_rows(rows: list[dict], n: int) -> list[dict]:
+    scaled = scale_rows(rows, n)
+    rst_list = [Restaurant(**row) for row in scaled]
+    repeat = REPEAT if n <= 100_000 else 1
+    file = SCRATCH_PATH / "rows" / f"bench - {n}"
+    results = [
+        measure(f"save_json[{n}]", "rows", n, lambda _: save_json(file, rst_list), repeat = repeat, io = True),
+        measure(f"save_all[{n}]", "rows", n, lambda _: save_all(file, rst_list), setup = reset_db, repeat = repeat, io = True),
+        measure(f"clean[{n}]", "rows", n, lambda copies: [typesense_utils.clean(row) for row in copies],
+                setup = lambda: [dict(row, lat = 0, lng = 0) for row in scaled], repeat = repeat)
+    ]
+
+    def count() -> int:
+        with engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(Restaurant)).scalar()
+
+    def populate():
+        # save_all logs database errors rather than raising, so a failed save only shows up in the count
+        if count() != n:
+            reset_db()
+            save_all(file, rst_list)
+            if count() != n:
+                raise RuntimeError(f"save_all wrote {count()} of {n} restaurants")
+
+    results.append(measure(f"to_jsonl[{n}]", "rows", n, lambda _: typesense_utils.to_jsonl("bench"), setup = populate, repeat = repeat, io = True))
+    del rst_list
+    shutil.rmtree(SCRATCH_PATH / "rows", ignore_errors = True)
+    return results
+
+
+def bench_replay(rows: list[dict]) -> list[dict]:
+    listed = list({row["url"]: row for row in rows}.values())[:REPLAY_PAGES * REPLAY_PER_PAGE]
+    corpus = Corpus(SCRATCH_PATH / "corpus")
+    for p in range(REPLAY_PAGES):
+        page_rows = listed[p * REPLAY_PER_PAGE:(p + 1) * REPLAY_PER_PAGE]
+        url = scraper_ta.search_page_url(REPLAY_URL, p * REPLAY_PER_PAGE)
+        corpus.save("GET", url, b"", 200, {"content-type": "text/html"}, search_page(page_rows, len(listed)).encode())
+        for row in page_rows:
+            corpus.save("GET", row["url"], b"", 200, {"content-type": "text/html"}, restaurant_page(row).encode())
+    loc = Location(name = "Bench", url = REPLAY_URL, food_url = REPLAY_URL)
+
+    def setup():
+        reset_db()
+        shutil.rmtree(scraper_ta.SAVE_PATH, ignore_errors = True)
+
+    async def crawl(server_url: str) -> int:
+        async with DatabaseWriter() as writer:
+            async with ScraperClient(transport = ReplayTransport(server_url)) as client:
+                return await scraper_ta.scrape_food(client, loc, REPLAY_PAGES, functools.partial(ReplayDriver, server_url), "http", writer = writer)
+
+    def run(_):
+        if asyncio.run(crawl(server.url)) != len(listed):
+            raise RuntimeError("Replayed crawl did not scrape every restaurant")
+
+    with ReplayServer(corpus) as server:
+        return [measure("scrape_food[replay]", "pages", len(listed), run, setup = setup, io = True)]
+
+
+def bench_startup() -> list[dict]:
+    # Each run is a new interpreter, so nothing imported by the suite itself counts
+    def run(command: list[str]):
+        for _ in range(STARTUP_RUNS):
+            subprocess.run([sys.executable, *command], cwd = scraper_ta.CSV_PATH.parent, check = True, stdout = subprocess.DEVNULL)
+
+    return [
+        measure(f"startup[{name}]", "runs", STARTUP_RUNS, functools.partial(lambda command, _: run(command), command), io = True)
+        for name, command in STARTUP_COMMANDS.items()
+    ]
+
+
+def compare(results: list[dict], baselines: dict, tolerance: float) -> list[str]:
+    """Prints each result against its baseline
+
+    Args:
+        results (list[dict]): Results of this run
+        baselines (dict): Baseline of each benchmark by name
+        tolerance (float): Fraction of throughput lost or memory gained that counts as a regression - at least IO_TOLERANCE of throughput for disk and database bound results
+
+    Returns:
+        list[str]: Names of regressed benchmarks
+    """
+    regressions = []
+    print(f"\n{'benchmark':<32} {'throughput':>12} {'peak memory':>12}")
+    for result in results:
+        base = baselines.get(result["name"])
+        if base is None:
+            print(f"{result['name']:<32} {'(no baseline)':>12}")
+            continue
+        speed = result["throughput"] / base["throughput"] - 1
+        memory = result["peak_mb"] / base["peak_mb"] - 1 if base["peak_mb"] > 0 else 0.0
+        regressed = speed < -max(tolerance, result["tolerance"] or 0) or memory > tolerance
+        if regressed:
+            regressions.append(result["name"])
+        print(f"{result['name']:<32} {speed:>+12.1%} {memory:>+12.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(args: argparse.Namespace):
+    logger.remove()
+    logger.add(sys.stderr, level = "WARNING")
+    scraper_ta.SAVE_PATH = SCRATCH_PATH / "data"
+    typesense_utils.curr_path = SCRATCH_PATH
+    rows = load_rows()
+    sizes = [int(s) for s in args.sizes.split(",")] if args.sizes else SIZES
+    print(f"{len(rows)} restaurants from data/, scratch directory {SCRATCH_PATH}\n")
+
+    groups = {
+        "parsers": lambda: bench_parsers(rows),
+        "hash": lambda: bench_hash(rows),
+        "rows": lambda: [r for n in sizes for r in bench_rows(rows, n)],
+        "replay": lambda: bench_replay(rows),
+        "startup": bench_startup
+    }
+    results = []
+    try:
+        for name, group in groups.items():
+            if args.only and name not in args.only:
+                continue
+            results.extend(group())
+    finally:
+        engine.dispose()
+        shutil.rmtree(SCRATCH_PATH, ignore_errors = True)
+
+    baselines = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.is_file() else {"machine": {}, "results": {}}
+    regressions = compare(results, baselines["results"], args.tolerance)
+    if args.out:
+        Path(args.out).write_text(json.dumps(results, indent = 4))
+    if args.save:
+        baselines["machine"] = {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor() or platform.machine()}
+        baselines["results"].update({r["name"]: {k: r[k] for k in ("unit", "items", "throughput", "peak_mb")} for r in results})
+        BASELINE_PATH.write_text(json.dumps(baselines, indent = 4) + "\n")
+        print(f"\nSaved {len(results)} baselines to {BASELINE_PATH}")
+    if args.check and len(regressions) > 0:
+        print(f"\n{len(regressions)} regressions beyond {args.tolerance:.0%}: {regressions}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Scraper benchmark suite")
+    parser.add_argument(
+        "--sizes",
+        action = "store",
+        help = "comma-separated row counts for the save/export benchmarks, e.g. '10000,100000,1000000'"
+    )
+    parser.add_argument(
+        "--only",
+        action = "store",
+        help = "benchmark groups to run",
+        nargs = "+",
+        choices = ["parsers", "hash", "rows", "replay", "startup"]
+    )
+    parser.add_argument(
+        "--repeat",
+        action = "store",
+        help = "timed runs per benchmark",
+        type = int,
+        default = REPEAT
+    )
+    parser.add_argument(
+        "--tolerance",
+        action = "store",
+        help = "fraction of throughput lost or memory gained that counts as a regression",
+        type = float,
+        default = TOLERANCE
+    )
+    parser.add_argument(
+        "--out",
+        action = "store",
+        help = "file to write this run's results to as JSON"
+    )
+    parser.add_argument(
+        "--save",
+        action = "store_true",
+        help = "store this run's results as the new baselines"
+    )
+    parser.add_argument(
+        "--check",
+        action = "store_true",
+        help = "exit with an error if any benchmark regressed against its baseline"
+    )
+    args = parser.parse_args()
+    REPEAT = args.repeat
+    main(args)
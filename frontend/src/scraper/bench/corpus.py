@@ -0,0 +1,109 @@
+# Benchmark inputs: restaurants from data/*.json scaled to any size, and TripAdvisor-shaped pages built from them
+#
+# Pages follow the structure the parsers read from live TripAdvisor HTML - search listings in data-test
+# divs and restaurant details buried in the pageManifest's urqlCache among unrelated entries.
+
+import json
+import random
+from pathlib import Path
+
+SCRAPER_PATH = Path(__file__).resolve().parent.parent
+DATA_PATH = SCRAPER_PATH / "data"
+RST_KEY = "RestaurantPresentation_searchRestaurantsByGeo"
+SEED = 1234 # Every generated input is the same across runs
+ROW_DEFAULTS = {"rating": 0, "review_count": 0, "tags": "[]", "price": ""} # Older pages were saved before these fields existed
+
+
+def load_rows(data_path: Path = DATA_PATH) -> list[dict]:
+    """Loads every scraped restaurant saved under data/
+
+    Args:
+        data_path (Path, optional): Directory of scraped JSON pages. Defaults to DATA_PATH.
+
+    Returns:
+        list[dict]: Restaurant rows in file name order, with missing fields filled from ROW_DEFAULTS
+    """
+    rows = []
+    for file in sorted(data_path.glob("*.json")):
+        rows.extend({**ROW_DEFAULTS, **row} for row in json.loads(file.read_text()))
+    if len(rows) == 0:
+        raise RuntimeError(f"No restaurants found in {data_path}")
+    return rows
+
+
+def scale_rows(rows: list[dict], n: int) -> list[dict]:
+    """Repeats rows up to n with unique ids and URLs, so they insert as distinct restaurants
+
+    Args:
+        rows (list[dict]): Restaurant rows
+        n (int): Number of rows wanted
+
+    Returns:
+        list[dict]: n restaurant rows
+    """
+    scaled = []
+    for i in range(n):
+        row = dict(rows[i % len(rows)])
+        copy = i // len(rows)
+        if copy > 0:
+            row["id"] = f"{row['id']}{copy}"
+            row["url"] = row["url"].replace("-Reviews-", f"-Reviews-c{copy}-")
+        scaled.append(row)
+    return scaled
+
+
+def search_page(rows: list[dict], total: int, location: str = "Bench") -> str:
+    """Builds a search results page listing restaurants
+
+    Args:
+        rows (list[dict]): Restaurants on the page
+        total (int): Total number of results shown in the page header
+        location (str, optional): Location name in the page. Defaults to "Bench".
+
+    Returns:
+        str: Page HTML
+    """
+    items = []
+    for i, row in enumerate(rows):
+        path = row["url"].removeprefix("https://www.tripadvisor.com")
+        imgs = "".join(f'<div style="background-image: url(&quot;{img}&quot;)"></div>' for img in json.loads(row["imgs"] or "[]"))
+        items.append(
+            f'<div data-test="{i + 1}_list_item"><div><a href="{path}">{i + 1}. {row["name"]}</a></div>'
+            f'<div><span>{row["rating"]} of 5 bubbles</span><span>{row["review_count"]} reviews</span></div>{imgs}</div>'
+        )
+    return (
+        f"<html><head><title>Restaurants in {location}</title></head><body>"
+        f'<div data-test="SL_list_item"><a href="/Restaurant_Review-g1-d1-Reviews-Sponsored-{location}.html">Sponsored</a></div>'
+        f"<span><span>{total:,}</span> results match your filters</span>{''.join(items)}</body></html>"
+    )
+
+
+def restaurant_page(row: dict, num_entries: int = 20, padding: int = 4000) -> str:
+    """Builds a restaurant page with the restaurant's details among unrelated urqlCache entries
+
+    Args:
+        row (dict): Restaurant row
+        num_entries (int, optional): Number of unrelated urqlCache entries. Defaults to 20.
+        padding (int, optional): Approximate size of each unrelated entry. Defaults to 4000.
+
+    Returns:
+        str: Page HTML
+    """
+    rng = random.Random(row["url"])
+    tags = json.loads(row["tags"] or "[]") or ["Restaurant"]
+    rst = {
+        "name": row["name"],
+        "localizedRealtimeAddress": row["address"],
+        "telephone": row["phone"],
+        "reviewSummary": {"rating": row["rating"], "count": row["review_count"]},
+        "topTags": [{"tag": {"localizedName": tag}, "secondary_name": row["price"] or None if i == 0 else None} for i, tag in enumerate(tags)],
+        "latitude": round(rng.uniform(-60, 60), 6),
+        "longitude": round(rng.uniform(-180, 180), 6)
+    }
+    results = {}
+    for j in range(num_entries):
+        results[f"{rng.getrandbits(32):08x}"] = {"data": json.dumps({f"Query_{j}": {"items": ["x" * 40] * (padding // 40)}})}
+    results[f"{rng.getrandbits(32):08x}"] = {"data": json.dumps({RST_KEY: {"restaurants": [rst]}})}
+    manifest = {"assets": ["/static/app.js"] * 200, "urqlCache": {"results": results}, "redux": {"page": "x" * 20000}}
+    manifest = json.dumps(manifest, separators = (",", ":"))
+    return f"<html><head><script>window.__WEB_CONTEXT__={{pageManifest:{manifest}}};</script></head><body></body></html>"
@@ -0,0 +1,183 @@
+import gzip
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from loguru import logger
+
+
+CACHE_TTL = 7 * 24 * 60 * 60 # Seconds before a cached page is considered stale
+CACHE_MAX_BYTES = 2 * 1024**3
+CACHE_MODES = ("use", "refresh", "bypass")
+ACCESS_BATCH = 100 # Hits whose access times are written together
+
+
+def normalize_url(url: str) -> str:
+    """Normalizes a URL so equivalent requests share a cache key
+
+    Args:
+        url (str): URL to normalize
+
+    Returns:
+        str: Lowercased scheme/host, sorted query, no fragment or trailing slash
+    """
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values = True)))
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, query, ""))
+
+
+class ResponseCache:
+    """On-disk cache of response bodies with TTL and size-bounded LRU eviction
+
+    Bodies are gzipped and stored under the SHA-256 of their content, so identical pages fetched from
+    different URLs are only stored once. A small SQLite index maps normalized URLs to content hashes.
+    The total size is kept as a running count, so only puts that overflow max_bytes scan the index.
+    """
+    def __init__(self,
+                 path: str | Path,
+                 ttl: float = CACHE_TTL,
+                 max_bytes: int = CACHE_MAX_BYTES,
+                 mode: str = "use"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Cache mode must be one of {CACHE_MODES}")
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        (self.path / "blobs").mkdir(parents = True, exist_ok = True)
+        self._db = sqlite3.connect(self.path / "index.db")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+            CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+        """)
+        self._bytes = self.size()
+        self._accessed: dict[str, float] = {} # Access times of hits not yet written to the index
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()
+
+    def _blob(self, digest: str) -> Path:
+        return self.path / "blobs" / digest[:2] / f"{digest}.gz"
+
+    def get(self, url: str) -> str | None:
+        """Looks up a fresh cached body for a URL
+
+        Args:
+            url (str): Requested URL
+
+        Returns:
+            str | None: Cached body, or None on a miss, stale entry or non-"use" mode
+        """
+        if self.mode != "use":
+            return None
+        key = self.key(url)
+        row = self._db.execute("SELECT digest, created, size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            self.misses += 1
+            return None
+        try:
+            body = gzip.decompress(self._blob(row[0]).read_bytes()).decode("utf-8")
+        except (OSError, EOFError):
+            self._delete(key, row[0], row[2])
+            self._db.commit()
+            self.misses += 1
+            return None
+        self._accessed[key] = time.time()
+        if len(self._accessed) >= ACCESS_BATCH:
+            self._flush_accessed()
+        self.hits += 1
+        return body
+
+    def _flush_accessed(self):
+        if len(self._accessed) == 0:
+            return
+        self._db.executemany("UPDATE entries SET accessed = ? WHERE key = ?", [(t, k) for k, t in self._accessed.items()])
+        self._db.commit()
+        self._accessed.clear()
+
+    def put(self, url: str, body: str):
+        """Stores a response body, evicting least recently used entries past max_bytes
+
+        Args:
+            url (str): Requested URL
+            body (str): Response body
+        """
+        if self.mode == "bypass":
+            return
+        data = body.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self._blob(digest)
+        if not blob.is_file():
+            blob.parent.mkdir(exist_ok = True)
+            tmp = blob.with_suffix(".tmp")
+            tmp.write_bytes(gzip.compress(data, compresslevel = 6))
+            tmp.replace(blob)
+
+        key = self.key(url)
+        old = self._db.execute("SELECT digest, size FROM entries WHERE key = ?", (key,)).fetchone()
+        stored = self._db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None
+        size = blob.stat().st_size
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+            (key, normalize_url(url), digest, size, now, now)
+        )
+        self._accessed.pop(key, None)
+        if not stored:
+            self._bytes += size
+        if old is not None and old[0] != digest and self._drop_blob(old[0]):
+            self._bytes -= old[1]
+        self._db.commit()
+        if self._bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        if self._bytes <= self.max_bytes:
+            return
+        # Pending access times decide which entries are least recently used
+        self._flush_accessed()
+        rows = self._db.execute("SELECT key, digest, size FROM entries ORDER BY accessed").fetchall()
+        num_evicted = 0
+        for key, digest, size in rows:
+            if self._bytes <= self.max_bytes:
+                break
+            self._delete(key, digest, size)
+            num_evicted += 1
+        self._db.commit()
+        logger.debug(f"Evicted {num_evicted} cached pages")
+
+    def size(self) -> int:
+        row = self._db.execute("SELECT SUM(size) FROM (SELECT DISTINCT digest, size FROM entries)").fetchone()
+        return row[0] or 0
+
+    def _delete(self, key: str, digest: str, size: int):
+        self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._accessed.pop(key, None)
+        # Shared blobs only free space once their last entry is gone
+        if self._drop_blob(digest):
+            self._bytes -= size
+
+    def _drop_blob(self, digest: str) -> bool:
+        if self._db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+            return False
+        self._blob(digest).unlink(missing_ok = True)
+        return True
+
+    def close(self):
+        self._flush_accessed()
+        logger.info(f"Response cache: {self.hits} hits, {self.misses} misses, {self._bytes / 1024**2:.1f} MB on disk")
+        self._db.close()
@@ -1,7 +1,13 @@
+import os
+import time
+import json
+import math
 from pathlib import Path
 from dataclasses import dataclass, field
 
-from sqlalchemy import String, create_engine
+from loguru import logger
+from sqlalchemy import String, Index, ForeignKey, create_engine, event, inspect, text, or_, select, delete, update, func, bindparam
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import (
     DeclarativeBase,
     sessionmaker,
@@ -38,9 +44,358 @@ class Restaurant(Base):
     imgs: Mapped[str] = mapped_column(String, default = "")
     address: Mapped[str] = mapped_column(default = "")
     phone: Mapped[str] = mapped_column(default = "")
+    updated: Mapped[float] = mapped_column(default = 0.0, index = True) # Last time any other column changed
+    price_id: Mapped[int] = mapped_column(default = 0, index = True) # Interned price, maintained by sync_facets()
+    lat: Mapped[float] = mapped_column(default = 0.0)
+    lng: Mapped[float] = mapped_column(default = 0.0)
+    cell: Mapped[int] = mapped_column(default = -1, index = True) # Grid cell of lat/lng from grid_cell(), -1 if unknown
     
 
+@dataclass
+class LocationEntry(Base):
+    __tablename__ = "locations"
+    query: Mapped[str] = mapped_column(String, primary_key = True) # Name the location was looked up by
+    name: Mapped[str] = mapped_column(default = "")
+    url: Mapped[str] = mapped_column(default = "")
+    food_url: Mapped[str] = mapped_column(default = "")
+    fun_url: Mapped[str] = mapped_column(default = "")
+    hotel_url: Mapped[str] = mapped_column(default = "")
+    place_type: Mapped[str] = mapped_column(default = "")
+    lat: Mapped[float] = mapped_column(default = -1.0)
+    lng: Mapped[float] = mapped_column(default = -1.0)
+    updated: Mapped[float] = mapped_column(default = 0.0)
+
+
+@dataclass
+class SeenEntity(Base):
+    __tablename__ = "seen_entities"
+    entity_id: Mapped[str] = mapped_column(String, primary_key = True) # "d[number]" part of the restaurant URL
+    url: Mapped[str] = mapped_column(default = "") # URL the restaurant is crawled under
+    first_seen: Mapped[float] = mapped_column(default = 0.0)
+
+
+@dataclass
+class Tag(Base):
+    __tablename__ = "tags"
+    id: Mapped[int] = mapped_column(primary_key = True)
+    name: Mapped[str] = mapped_column(String, unique = True)
+
+
+@dataclass
+class RestaurantTag(Base):
+    __tablename__ = "restaurant_tags"
+    __table_args__ = (Index("restaurant_tags_tag", "tag_id", "restaurant_id"),)
+    restaurant_id: Mapped[str] = mapped_column(ForeignKey("restaurants.id"), primary_key = True)
+    tag_id: Mapped[int] = mapped_column(ForeignKey("tags.id"), primary_key = True)
+
+
+@dataclass
+class PriceTier(Base):
+    __tablename__ = "price_tiers"
+    id: Mapped[int] = mapped_column(primary_key = True)
+    name: Mapped[str] = mapped_column(String, unique = True)
+
+
+@dataclass
+class FacetCount(Base):
+    __tablename__ = "facet_counts"
+    field: Mapped[str] = mapped_column(String, primary_key = True) # "tags" or "price"
+    value: Mapped[str] = mapped_column(String, primary_key = True)
+    count: Mapped[int] = mapped_column(default = 0)
+
+
+@dataclass
+class FrontierEntry(Base):
+    __tablename__ = "frontier"
+    __table_args__ = (Index("frontier_location", "location", "kind", "page"),)
+    url: Mapped[str] = mapped_column(String, primary_key = True)
+    kind: Mapped[str] = mapped_column(default = "") # "location", "search" or "restaurant"
+    location: Mapped[str] = mapped_column(default = "")
+    page: Mapped[int] = mapped_column(default = 0)
+    status: Mapped[str] = mapped_column(default = "pending") # "pending", "leased", "done" or "failed"
+    attempts: Mapped[int] = mapped_column(default = 0)
+    updated: Mapped[float] = mapped_column(default = 0.0)
+    lease_until: Mapped[float] = mapped_column(default = 0.0)
+    worker: Mapped[str] = mapped_column(default = "") # Worker holding the lease
+    data: Mapped[str] = mapped_column(String, default = "") # JSON-encoded listings of a finished search page
+
+
+@dataclass
+class RestaurantMeta(Base):
+    __tablename__ = "restaurant_meta"
+    url: Mapped[str] = mapped_column(String, primary_key = True)
+    id: Mapped[str] = mapped_column(String, default = "")
+    etag: Mapped[str] = mapped_column(default = "")
+    last_modified: Mapped[str] = mapped_column(default = "")
+    fields_hash: Mapped[str] = mapped_column(default = "")
+    checked: Mapped[float] = mapped_column(default = 0.0) # Last time the page was requested
+    changed: Mapped[float] = mapped_column(default = 0.0) # Last time the extracted fields differed
+
+
+@dataclass
+class ExportState(Base):
+    __tablename__ = "exports"
+    name: Mapped[str] = mapped_column(String, primary_key = True)
+    watermark: Mapped[float] = mapped_column(default = 0.0) # Latest Restaurant.updated included in the export
+    rows: Mapped[int] = mapped_column(default = 0)
+    exported: Mapped[float] = mapped_column(default = 0.0)
+
+
+@dataclass
+class PushedDoc(Base):
+    __tablename__ = "pushed"
+    target: Mapped[str] = mapped_column(String, primary_key = True) # "[host]:[port]/[collection]" pushed to
+    id: Mapped[str] = mapped_column(String, primary_key = True)
+    hash: Mapped[str] = mapped_column(default = "") # SHA-256 of the document as last imported
+    pushed: Mapped[float] = mapped_column(default = 0.0)
+
+
+@dataclass
+class WorkItem(Base):
+    __tablename__ = "work_items"
+    __table_args__ = (Index("work_items_status", "status", "row"),)
+    query: Mapped[str] = mapped_column(String, primary_key = True) # Location name from a CSV row
+    source: Mapped[str] = mapped_column(default = "") # CSV file the location came from
+    row: Mapped[int] = mapped_column(default = 0) # Position in the CSV, the order locations are claimed in
+    status: Mapped[str] = mapped_column(default = "pending") # "pending", "leased", "done" or "failed"
+    worker: Mapped[str] = mapped_column(default = "") # Worker holding or last holding the lease
+    attempts: Mapped[int] = mapped_column(default = 0)
+    lease_until: Mapped[float] = mapped_column(default = 0.0)
+    updated: Mapped[float] = mapped_column(default = 0.0)
+    result: Mapped[int] = mapped_column(default = -1) # Restaurant pages scraped, -1 until done
+    error: Mapped[str] = mapped_column(default = "")
+
+
+RST_DERIVED = ["price_id", "cell"] # Columns maintained by the database rather than the scraper
+GRID_SIZE = 0.01 # Degrees per grid cell side, about 1.1 km of latitude
+GRID_COLS = round(360 / GRID_SIZE)
+RST_COLUMNS = [c.name for c in Restaurant.__table__.columns if c.name not in RST_DERIVED]
+RST_DEFAULTS = {c.name: c.default.arg for c in Restaurant.__table__.columns}
+BUSY_TIMEOUT = 30 # Seconds a connection waits on another process's write lock
+UPSERT_CHUNK = 10_000 # Rows per statement - facet lookups bind every id, and SQLite caps bound variables
+
+
+def grid_cell(lat: float, lng: float) -> int:
+    """Maps coordinates to the grid cell used to index restaurant locations
+
+    Args:
+        lat (float): Latitude in degrees
+        lng (float): Longitude in degrees
+
+    Returns:
+        int: Row-major cell number, or -1 for unknown (0, 0) coordinates
+    """
+    if lat == 0 and lng == 0:
+        return -1
+    row = min(math.floor((lat + 90) / GRID_SIZE), round(180 / GRID_SIZE) - 1)
+    col = math.floor((lng + 180) / GRID_SIZE) % GRID_COLS
+    return row * GRID_COLS + col
+
+
+def to_row(rst: Restaurant) -> dict:
+    # Unset attributes fall back to column defaults so every row has the same keys for executemany
+    row = {c: getattr(rst, c) for c in RST_COLUMNS}
+    return {c: v if v is not None else RST_DEFAULTS[c] for c, v in row.items()}
+
+
+def upsert_restaurants(rows: list[dict], chunk_size: int = UPSERT_CHUNK):
+    """Inserts restaurants in one transaction, updating existing rows with the same id
+
+    Rows without an id (restaurants whose page could not be parsed) are skipped, since they would otherwise
+    fail the whole transaction or all collapse into one row.
+
+    Args:
+        rows (list[dict]): Restaurant column values from to_row()
+        chunk_size (int, optional): Rows written per statement. Defaults to UPSERT_CHUNK.
+    """
+    skipped = [row.get("url") for row in rows if not row.get("id")]
+    if len(skipped) > 0:
+        logger.warning(f"Skipping {len(skipped)} restaurants without an id: {skipped}")
+        rows = [row for row in rows if row.get("id")]
+    if len(rows) == 0:
+        return
+    now = time.time()
+    rows = [{**row, "updated": now, "cell": grid_cell(row["lat"], row["lng"])} for row in rows]
+    stmt = insert(Restaurant)
+    # Identical rows are left alone so "updated" only moves when a restaurant actually changes
+    stmt = stmt.on_conflict_do_update(
+        index_elements = ["id"],
+        set_ = {c: stmt.excluded[c] for c in RST_COLUMNS + ["cell"] if c != "id"},
+        where = or_(*[Restaurant.__table__.c[c] != stmt.excluded[c] for c in RST_COLUMNS if c not in ("id", "updated")])
+    )
+    with engine.begin() as conn:
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            conn.execute(stmt, chunk)
+            sync_facets(conn, chunk)
+
+
+def parse_tags(tags: str) -> list[str]:
+    try:
+        tags = json.loads(tags)
+    except (TypeError, ValueError):
+        return []
+    return [t for t in dict.fromkeys(tags) if isinstance(t, str)] if isinstance(tags, list) else []
+
+
+def sync_facets(conn, rows: list[dict]):
+    """Updates the tag links and price tiers of restaurants, then recounts the facet values they touched
+
+    Args:
+        conn (Connection): Connection in the transaction that wrote the rows
+        rows (list[dict]): Restaurant column values that were just written
+    """
+    tags = {row["id"]: parse_tags(row["tags"]) for row in rows}
+    prices = {row["id"]: row["price"] or "" for row in rows}
+    ids = list(tags)
+    names = {t for ts in tags.values() for t in ts}
+    if names:
+        conn.execute(insert(Tag).on_conflict_do_nothing(index_elements = ["name"]), [{"name": n} for n in names])
+    conn.execute(insert(PriceTier).on_conflict_do_nothing(index_elements = ["name"]), [{"name": p} for p in set(prices.values())])
+    tag_ids = dict(conn.execute(select(Tag.name, Tag.id).where(Tag.name.in_(names))).all())
+    price_ids = dict(conn.execute(select(PriceTier.name, PriceTier.id).where(PriceTier.name.in_(set(prices.values())))).all())
+
+    old_links = set(conn.execute(select(RestaurantTag.restaurant_id, RestaurantTag.tag_id).where(RestaurantTag.restaurant_id.in_(ids))).all())
+    new_links = {(rid, tag_ids[t]) for rid, ts in tags.items() for t in ts}
+    for rid, tid in old_links - new_links:
+        conn.execute(delete(RestaurantTag).where(RestaurantTag.restaurant_id == rid, RestaurantTag.tag_id == tid))
+    if new_links - old_links:
+        conn.execute(insert(RestaurantTag), [{"restaurant_id": rid, "tag_id": tid} for rid, tid in new_links - old_links])
+
+    old_prices = dict(conn.execute(select(Restaurant.id, Restaurant.price_id).where(Restaurant.id.in_(ids))).all())
+    moved = [{"rid": rid, "pid": price_ids[p]} for rid, p in prices.items() if old_prices.get(rid) != price_ids[p]]
+    if moved:
+        conn.execute(
+            update(Restaurant).where(Restaurant.id == bindparam("rid")).values(price_id = bindparam("pid")),
+            moved
+        )
+
+    # Only values whose membership changed are recounted, each with an index range count
+    touched_tags = {tid for _, tid in old_links ^ new_links}
+    touched_prices = {old_prices[m["rid"]] for m in moved if m["rid"] in old_prices} | {m["pid"] for m in moved}
+    counts = [
+        ("tags", select(Tag.name, func.count(RestaurantTag.restaurant_id)).select_from(Tag).outerjoin(RestaurantTag).where(Tag.id.in_(touched_tags)).group_by(Tag.id)),
+        ("price", select(PriceTier.name, func.count(Restaurant.id)).select_from(PriceTier).outerjoin(Restaurant, Restaurant.price_id == PriceTier.id).where(PriceTier.id.in_(touched_prices)).group_by(PriceTier.id))
+    ]
+    for field, stmt in counts:
+        facet_rows = [{"field": field, "value": value, "count": count} for value, count in conn.execute(stmt).all()]
+        if len(facet_rows) == 0:
+            continue
+        stmt = insert(FacetCount)
+        conn.execute(stmt.on_conflict_do_update(index_elements = ["field", "value"], set_ = {"count": stmt.excluded["count"]}), facet_rows)
+    conn.execute(delete(FacetCount).where(FacetCount.count == 0))
+
+
+def backfill_facets(chunk_size: int = 1000):
+    """Builds the tag links, price tiers and facet counts of restaurants written before they existed"""
+    with engine.begin() as conn:
+        if conn.execute(select(PriceTier.id).limit(1)).first() is not None:
+            return
+        result = conn.execute(select(Restaurant.id, Restaurant.tags, Restaurant.price))
+        chunks = [[dict(row) for row in chunk] for chunk in result.mappings().partitions(chunk_size)]
+        for chunk in chunks:
+            sync_facets(conn, chunk)
+
+
+def get_locations(queries: list[str], max_age: float) -> dict[str, Location]:
+    """Looks up locations resolved by an earlier run
+
+    Args:
+        queries (list[str]): Names the locations are looked up by
+        max_age (float): Seconds before a resolved location has to be looked up again
+
+    Returns:
+        dict[str, Location]: Location dataclass for each query resolved recently enough
+    """
+    locs = {}
+    with engine.connect() as conn:
+        for i in range(0, len(queries), 500):
+            stmt = select(LocationEntry).where(
+                LocationEntry.query.in_(queries[i:i + 500]),
+                LocationEntry.updated >= time.time() - max_age
+            )
+            for row in conn.execute(stmt).mappings():
+                locs[row["query"]] = Location(
+                    name = row["name"],
+                    url = row["url"],
+                    food_url = row["food_url"],
+                    fun_url = row["fun_url"],
+                    hotel_url = row["hotel_url"],
+                    place_type = row["place_type"],
+                    pos = (row["lat"], row["lng"])
+                )
+    return locs
+
+
+def save_location(query: str, loc: Location):
+    row = {
+        "query": query,
+        "name": loc.name,
+        "url": loc.url,
+        "food_url": loc.food_url,
+        "fun_url": loc.fun_url,
+        "hotel_url": loc.hotel_url,
+        "place_type": loc.place_type,
+        "lat": loc.pos[0],
+        "lng": loc.pos[1],
+        "updated": time.time()
+    }
+    stmt = insert(LocationEntry)
+    stmt = stmt.on_conflict_do_update(index_elements = ["query"], set_ = {c: stmt.excluded[c] for c in row if c != "query"})
+    with engine.begin() as conn:
+        conn.execute(stmt, row)
+
+
+def migrate():
+    """Adds columns and indexes missing from tables created by an older version of the models
+
+    SQLite can only add columns with a constant default, which every column here has.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                default = column.default.arg if column.default is not None else ""
+                default = f"'{default}'" if isinstance(default, str) else default
+                conn.execute(text(
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)} NOT NULL DEFAULT {default}"
+                ))
+            for index in table.indexes:
+                index.create(conn, checkfirst = True)
+
+
+def checkpoint():
+    """Folds the write-ahead log back into the database file and closes pooled connections
+
+    Run when a crawl ends, so scrape.db holds every write on its own once the process exits.
+    """
+    with engine.connect() as conn:
+        busy = conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)")).first()[0]
+    if busy:
+        logger.warning("Could not checkpoint the database while another connection is using it")
+    engine.dispose()
+
+
 dir = Path(__file__).resolve().parent
-engine = create_engine(f"sqlite:///{dir}/scrape.db")
+engine = create_engine(
+    f"sqlite:///{os.environ.get('SCRAPE_DB', dir / 'scrape.db')}", # SCRAPE_DB points benchmarks and tests at a scratch database
+    connect_args = {"timeout": BUSY_TIMEOUT} # Several workers may write to the same database
+)
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_conn, connection_record):
+    # WAL lets readers keep working while the writer commits
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
 Base.metadata.create_all(engine)
+migrate()
+backfill_facets()
 Session = sessionmaker(engine)
\ No newline at end of file
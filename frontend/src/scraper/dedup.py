@@ -0,0 +1,115 @@
+import re
+import math
+import time
+import hashlib
+import threading
+
+from loguru import logger
+from sqlalchemy import select, func
+from sqlalchemy.dialects.sqlite import insert
+
+from database import engine, SeenEntity
+
+
+BLOOM_CAPACITY = 1_000_000 # Minimum number of entities the filter is sized for
+BLOOM_ERROR_RATE = 0.001
+
+_entity_re = re.compile(r"Restaurant_Review-g\d+-d(\d+)-")
+
+
+def entity_id(url: str) -> str | None:
+    """Parses TripAdvisor's entity id from a restaurant URL
+
+    Args:
+        url (str): Restaurant_Review URL
+
+    Returns:
+        str | None: Digits after "-d", or None if the URL has none
+    """
+    m = _entity_re.search(url)
+    return m.group(1) if m else None
+
+
+class BloomFilter:
+    """Fixed-size set membership test with no false negatives and a bounded false positive rate"""
+    def __init__(self, capacity: int = BLOOM_CAPACITY, error_rate: float = BLOOM_ERROR_RATE):
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key: str) -> list[int]:
+        # Double hashing derives every position from two halves of one digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size = 16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class SeenSet:
+    """Restaurants already claimed by some search page, keyed on entity id and kept in the database across runs
+
+    A Bloom filter answers most lookups for new entities without touching the database. Claims are safe to make from several threads.
+    """
+    def __init__(self, capacity: int = BLOOM_CAPACITY, error_rate: float = BLOOM_ERROR_RATE):
+        with engine.connect() as conn:
+            num_seen = conn.execute(select(func.count()).select_from(SeenEntity)).scalar() or 0
+            self._bloom = BloomFilter(max(capacity, 2 * num_seen), error_rate)
+            result = conn.execution_options(stream_results = True, yield_per = 10000).execute(select(SeenEntity.entity_id))
+            for (entity,) in result:
+                self._bloom.add(entity)
+        self.claimed = 0
+        self.duplicates = 0
+        self.db_lookups = 0
+        self._lock = threading.Lock() # Two claims of one new entity would otherwise both keep it
+        logger.debug(f"Loaded {num_seen} seen restaurants")
+
+    def claim(self, urls: list[str]) -> list[bool]:
+        """Claims restaurants for crawling, rejecting those already claimed under a different URL
+
+        URLs claimed before keep their claim, so resumed and overlapping searches still see their own restaurants.
+
+        Args:
+            urls (list[str]): Restaurant URLs from a search page
+
+        Returns:
+            list[bool]: Whether each restaurant should be crawled
+        """
+        entities = [entity_id(url) for url in urls]
+        with self._lock:
+            maybe_seen = {e for e in entities if e is not None and e in self._bloom}
+            owners = {}
+            if maybe_seen:
+                self.db_lookups += 1
+                with engine.connect() as conn:
+                    owners = dict(conn.execute(
+                        select(SeenEntity.entity_id, SeenEntity.url).where(SeenEntity.entity_id.in_(maybe_seen))
+                    ).all())
+
+            keep = []
+            new_rows = {}
+            for url, entity in zip(urls, entities):
+                if entity is None:
+                    keep.append(True)
+                    continue
+                owner = owners.get(entity) or new_rows.get(entity, {}).get("url")
+                if owner is None:
+                    new_rows[entity] = {"entity_id": entity, "url": url, "first_seen": time.time()}
+                    owner = url
+                keep.append(owner == url)
+            if new_rows:
+                with engine.begin() as conn:
+                    conn.execute(insert(SeenEntity).on_conflict_do_nothing(index_elements = ["entity_id"]), list(new_rows.values()))
+                for entity in new_rows:
+                    self._bloom.add(entity)
+            self.claimed += len(new_rows)
+            self.duplicates += keep.count(False)
+            return keep
+
+    def stats(self) -> dict:
+        return {"claimed": self.claimed, "duplicates": self.duplicates, "db_lookups": self.db_lookups}
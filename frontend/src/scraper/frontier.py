@@ -0,0 +1,169 @@
+import time
+import json
+import socket
+
+from sqlalchemy import select, update, and_, or_
+from sqlalchemy.dialects.sqlite import insert
+
+from database import engine, FrontierEntry, Restaurant, Session
+
+
+LEASE_TIME = 10 * 60 # Seconds before an unfinished lease can be claimed again
+HOST_ID = socket.gethostname() # Default lease owner, so a crawl restarted on the same host can release its old leases
+
+
+def add_urls(urls: list[str], kind: str, location: str, page: int = 0):
+    """Registers URLs in the crawl frontier, leaving already known URLs untouched
+
+    Args:
+        urls (list[str]): URLs to crawl
+        kind (str): "location", "search" or "restaurant"
+        location (str): Location the URLs belong to
+        page (int, optional): Search page number the URLs were found on. Defaults to 0.
+    """
+    if len(urls) == 0:
+        return
+    now = time.time()
+    rows = [{
+        "url": url,
+        "kind": kind,
+        "location": location,
+        "page": page,
+        "status": "pending",
+        "attempts": 0,
+        "updated": now,
+        "lease_until": 0.0,
+        "worker": "",
+        "data": ""
+    } for url in urls]
+    with engine.begin() as conn:
+        conn.execute(insert(FrontierEntry).on_conflict_do_nothing(index_elements = ["url"]), rows)
+
+
+def lease_url(url: str, worker: str = HOST_ID, lease_time: float = LEASE_TIME) -> bool:
+    """Claims a URL so no other worker crawls it until the lease expires
+
+    A live lease can't be claimed again, even by the worker holding it - use release_leases() on startup to take back a previous run's leases.
+
+    Args:
+        url (str): URL to claim
+        worker (str, optional): Name the lease is held under. Defaults to HOST_ID.
+        lease_time (float, optional): Seconds the lease is held for. Defaults to LEASE_TIME.
+
+    Returns:
+        bool: Whether the URL was claimed - False if it is done or already leased
+    """
+    now = time.time()
+    stmt = (
+        update(FrontierEntry)
+        .where(and_(
+            FrontierEntry.url == url,
+            or_(
+                FrontierEntry.status.in_(["pending", "failed"]),
+                and_(FrontierEntry.status == "leased", FrontierEntry.lease_until < now)
+            )
+        ))
+        .values(
+            status = "leased",
+            attempts = FrontierEntry.attempts + 1,
+            updated = now,
+            lease_until = now + lease_time,
+            worker = worker
+        )
+    )
+    with engine.begin() as conn:
+        return conn.execute(stmt).rowcount > 0
+
+
+def set_status(urls: list[str], status: str):
+    if len(urls) == 0:
+        return
+    stmt = (
+        update(FrontierEntry)
+        .where(FrontierEntry.url.in_(urls))
+        .values(status = status, updated = time.time(), lease_until = 0.0, worker = "")
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt)
+
+
+def release_leases(workers: list[str]) -> int:
+    """Puts URLs leased by workers that are gone back to pending, so the worker taking over their locations crawls them
+
+    A crawl restarted under the same name calls this before crawling to take back its own leases.
+
+    Args:
+        workers (list[str]): Names the leases are held under
+
+    Returns:
+        int: Number of released URLs
+    """
+    if len(workers) == 0:
+        return 0
+    stmt = (
+        update(FrontierEntry)
+        .where(FrontierEntry.status == "leased", FrontierEntry.worker.in_(workers))
+        .values(status = "pending", updated = time.time(), lease_until = 0.0, worker = "")
+    )
+    with engine.begin() as conn:
+        return conn.execute(stmt).rowcount
+
+
+def complete_urls(urls: list[str]):
+    set_status(urls, "done")
+
+
+def fail_urls(urls: list[str]):
+    set_status(urls, "failed")
+
+
+def get_status(url: str) -> str | None:
+    with engine.connect() as conn:
+        return conn.execute(select(FrontierEntry.status).where(FrontierEntry.url == url)).scalar()
+
+
+def complete_search(url: str, listings: list[dict]):
+    """Marks a search page done, storing its listings so it never has to be fetched again
+
+    Args:
+        url (str): Search page URL
+        listings (list[dict]): Restaurant URL and JSON-encoded image URLs of each listing
+    """
+    stmt = (
+        update(FrontierEntry)
+        .where(FrontierEntry.url == url)
+        .values(status = "done", updated = time.time(), lease_until = 0.0, worker = "", data = json.dumps(listings))
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt)
+
+
+def get_listings(url: str) -> list[dict] | None:
+    """Rebuilds a finished search page's listings from the frontier
+
+    Args:
+        url (str): Search page URL
+
+    Returns:
+        list[dict] | None: Restaurant URL and JSON-encoded image URLs of each listing, or None if the page isn't done
+    """
+    stmt = select(FrontierEntry.data).where(and_(FrontierEntry.url == url, FrontierEntry.status == "done"))
+    with engine.connect() as conn:
+        data = conn.execute(stmt).scalar()
+    return json.loads(data) if data else None
+
+
+def load_restaurant(url: str) -> Restaurant | None:
+    """Loads a finished restaurant back from the database
+
+    Args:
+        url (str): Restaurant URL
+
+    Returns:
+        Restaurant | None: Detached Restaurant, or None if it was never saved
+    """
+    with Session(expire_on_commit = False) as session:
+        rst = session.scalars(select(Restaurant).where(Restaurant.url == url).limit(1)).first()
+        if rst is not None:
+            session.expunge(rst)
+        return rst
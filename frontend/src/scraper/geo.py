@@ -0,0 +1,162 @@
+import math
+import heapq
+
+from sqlalchemy import select, and_, or_
+
+from database import engine, Restaurant, GRID_SIZE, GRID_COLS
+
+
+EARTH_RADIUS = 6371.0 # Kilometers
+MAX_GRID_ROWS = 512 # Larger boxes are scanned by latitude instead of by grid cell
+NEAREST_RADIUS = 0.5 # Starting search radius of nearest() in kilometers
+NEAREST_MAX_RADIUS = 200.0
+
+_COLUMNS = [Restaurant.id, Restaurant.name, Restaurant.url, Restaurant.rating, Restaurant.review_count, Restaurant.price, Restaurant.lat, Restaurant.lng]
+
+
+def haversine(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two points in kilometers"""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lng2 - lng1)
+    a = math.sin(dp / 2)**2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2)**2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _cell_ranges(south: float, west: float, north: float, east: float) -> list[tuple[int, int]] | None:
+    # Cells are numbered row by row, so each grid row of the box is one contiguous range
+    row_lo = math.floor((max(south, -90) + 90) / GRID_SIZE)
+    row_hi = math.floor((min(north, 90 - 1e-9) + 90) / GRID_SIZE)
+    if row_hi - row_lo + 1 > MAX_GRID_ROWS:
+        return None
+    col_lo = math.floor((west + 180) / GRID_SIZE) % GRID_COLS
+    col_hi = math.floor((east + 180) / GRID_SIZE) % GRID_COLS
+    cols = [(col_lo, col_hi)] if col_lo <= col_hi else [(col_lo, GRID_COLS - 1), (0, col_hi)]
+    if east - west >= 360:
+        cols = [(0, GRID_COLS - 1)]
+    return [(row * GRID_COLS + lo, row * GRID_COLS + hi) for row in range(row_lo, row_hi + 1) for lo, hi in cols]
+
+
+def _query_box(south: float,
+               west: float,
+               north: float,
+               east: float,
+               min_rating: float | None,
+               circle: tuple[float, float, float] | None = None) -> list:
+    if west <= east:
+        lng_cond = Restaurant.lng.between(west, east)
+    else:
+        lng_cond = or_(Restaurant.lng >= west, Restaurant.lng <= east)
+    conditions = [Restaurant.cell >= 0, Restaurant.lat.between(south, north), lng_cond]
+    ranges = _cell_ranges(south, west, north, east)
+    if ranges is not None:
+        conditions.append(or_(*[Restaurant.cell.between(lo, hi) for lo, hi in ranges]))
+    if min_rating is not None:
+        conditions.append(Restaurant.rating >= min_rating)
+    if circle is not None:
+        # Flat-earth distance in degrees drops the box's corners before rows reach Python
+        lat, lng, dlat = circle
+        scale = math.cos(math.radians(abs(lat) + dlat))**2 # Narrowest longitude degrees in the circle, so distances are never overestimated
+        conditions.append(
+            (Restaurant.lat - lat) * (Restaurant.lat - lat) + (Restaurant.lng - lng) * (Restaurant.lng - lng) * scale
+            <= (dlat * 1.05)**2
+        )
+    with engine.connect() as conn:
+        return conn.execute(select(*_COLUMNS).where(and_(*conditions))).all()
+
+
+def within_bbox(south: float,
+                west: float,
+                north: float,
+                east: float,
+                min_rating: float | None = None,
+                limit: int | None = None) -> list[dict]:
+    """Finds restaurants inside a bounding box, ordered by distance from its center
+
+    Args:
+        south (float): Minimum latitude
+        west (float): Minimum longitude - greater than east for boxes crossing the antimeridian
+        north (float): Maximum latitude
+        east (float): Maximum longitude
+        min_rating (float | None, optional): Minimum rating. Defaults to None.
+        limit (int | None, optional): Maximum number of results. Defaults to all.
+
+    Returns:
+        list[dict]: Restaurant columns and "distance" from the center in kilometers
+    """
+    lat = (south + north) / 2
+    lng = (west + east) / 2 if west <= east else ((west + east + 360) / 2 + 180) % 360 - 180
+    rows = [(haversine(lat, lng, row.lat, row.lng), row) for row in _query_box(south, west, north, east, min_rating)]
+    return _closest(rows, limit)
+
+
+def within_radius(lat: float,
+                  lng: float,
+                  radius: float,
+                  min_rating: float | None = None,
+                  limit: int | None = None) -> list[dict]:
+    """Finds restaurants within a distance of a point, nearest first
+
+    Args:
+        lat (float): Latitude of the center
+        lng (float): Longitude of the center
+        radius (float): Distance in kilometers
+        min_rating (float | None, optional): Minimum rating. Defaults to None.
+        limit (int | None, optional): Maximum number of results. Defaults to all.
+
+    Returns:
+        list[dict]: Restaurant columns and "distance" in kilometers
+    """
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    south, north = lat - dlat, lat + dlat
+    if south <= -90 or north >= 90:
+        west, east = -180.0, 180.0
+    else:
+        # Widest longitude span of the circle is at the latitude furthest from the equator
+        dlng = math.degrees(radius / (EARTH_RADIUS * math.cos(math.radians(max(abs(south), abs(north))))))
+        west, east = lng - dlng, lng + dlng
+        if dlng >= 180:
+            west, east = -180.0, 180.0
+        else:
+            west, east = (west + 180) % 360 - 180, (east + 180) % 360 - 180
+    # Near the poles or antimeridian the flat-earth prefilter breaks down, so only the box is used there
+    circle = (lat, lng, dlat) if west <= east and abs(lat) + dlat < 60 else None
+    rows = []
+    for row in _query_box(max(south, -90), west, min(north, 90), east, min_rating, circle):
+        distance = haversine(lat, lng, row.lat, row.lng)
+        if distance <= radius:
+            rows.append((distance, row))
+    return _closest(rows, limit)
+
+
+def nearest(lat: float,
+            lng: float,
+            n: int = 10,
+            min_rating: float | None = None,
+            max_radius: float = NEAREST_MAX_RADIUS) -> list[dict]:
+    """Finds the restaurants nearest to a point by searching outwards in growing circles
+
+    Args:
+        lat (float): Latitude of the point
+        lng (float): Longitude of the point
+        n (int, optional): Number of restaurants. Defaults to 10.
+        min_rating (float | None, optional): Minimum rating. Defaults to None.
+        max_radius (float, optional): Distance in kilometers to give up at. Defaults to NEAREST_MAX_RADIUS.
+
+    Returns:
+        list[dict]: Up to n restaurants' columns and "distance" in kilometers, nearest first
+    """
+    radius = NEAREST_RADIUS
+    while True:
+        rows = within_radius(lat, lng, min(radius, max_radius), min_rating, n)
+        if len(rows) >= n or radius >= max_radius:
+            return rows
+        radius *= 4
+
+
+def _closest(rows: list[tuple], limit: int | None) -> list[dict]:
+    # Rows only become dicts once the closest ones are known
+    if limit is None:
+        rows = sorted(rows, key = lambda row: row[0])
+    else:
+        rows = heapq.nsmallest(limit, rows, key = lambda row: row[0])
+    return [{**row._asdict(), "distance": distance} for distance, row in rows]
@@ -0,0 +1,257 @@
+import time
+import random
+import string
+import asyncio
+from typing import Callable
+
+import httpx
+from loguru import logger
+
+from throttle import BACKOFF_STATUSES
+from user_agents import random_user_agent
+
+
+TOR_HOST = "127.0.0.1"
+TOR_SOCKS_PORTS = [9050]
+TOR_CONTROL_PORT = 9051
+TOR_PASSWORD = "password"
+ROTATE_INTERVAL = 120 # Seconds between rotations of the same identity - rotations are staggered across identities
+COOLDOWN_TIME = 10 # Seconds an identity rests after rotating - Tor rate limits NEWNYM to one every 10s
+DRAIN_TIMEOUT = 30 # Seconds to wait for an identity's requests to finish before closing its connections
+MAX_CONNECTIONS = 5 # Per identity
+
+
+class TorControlError(Exception):
+    """Raised when the Tor control port rejects a command"""
+
+
+async def tor_signal(signal: str = "NEWNYM",
+                     host: str = TOR_HOST,
+                     port: int = TOR_CONTROL_PORT,
+                     password: str = TOR_PASSWORD,
+                     timeout: float = 10):
+    """Sends a signal over the Tor control protocol without blocking the event loop
+
+    Args:
+        signal (str, optional): Signal name. Defaults to "NEWNYM".
+        host (str, optional): Control port host. Defaults to TOR_HOST.
+        port (int, optional): Control port. Defaults to TOR_CONTROL_PORT.
+        password (str, optional): Control port password. Defaults to TOR_PASSWORD.
+        timeout (float, optional): Seconds before giving up. Defaults to 10.
+    """
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        escaped = password.replace("\\", "\\\\").replace('"', '\\"')
+        for command in (f'AUTHENTICATE "{escaped}"', f"SIGNAL {signal}"):
+            writer.write(f"{command}\r\n".encode("ascii"))
+            await writer.drain()
+            reply = (await asyncio.wait_for(reader.readline(), timeout)).decode("ascii", "replace").strip()
+            if not reply.startswith("250"):
+                raise TorControlError(f"{command.split()[0]} failed: {reply}")
+        writer.write(b"QUIT\r\n")
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def default_transport(proxy: str | None) -> httpx.AsyncBaseTransport:
+    return httpx.AsyncHTTPTransport(
+        proxy = httpx.Proxy(proxy) if proxy else None,
+        http2 = True,
+        limits = httpx.Limits(max_connections = MAX_CONNECTIONS)
+    )
+
+
+class Identity:
+    """One egress identity - a SOCKS circuit, a User-Agent and a connection pool of its own
+
+    Tor isolates streams with different SOCKS credentials onto different circuits, so every rotation
+    switches to fresh random credentials as well as signalling NEWNYM when a control port is known.
+    """
+    def __init__(self,
+                 name: str,
+                 socks: str | None = None,
+                 control_port: int | None = None,
+                 factory: Callable[[str | None], httpx.AsyncBaseTransport] = default_transport):
+        """
+        Args:
+            name (str): Name used in logs
+            socks (str | None, optional): SOCKS5 proxy as "host:port", None to connect directly. Defaults to None.
+            control_port (int | None, optional): Control port of the Tor instance behind the SOCKS port. Defaults to None.
+            factory (Callable[[str | None], httpx.AsyncBaseTransport], optional): Creates a transport for a proxy URL. Defaults to default_transport.
+        """
+        self.name = name
+        self.socks = socks
+        self.control_port = control_port
+        self.factory = factory
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.rotations = 0
+        self.cooling = False
+        self._renew()
+
+    @property
+    def proxy(self) -> str | None:
+        if self.socks is None:
+            return None
+        return f"socks5://{self._credentials}:x@{self.socks}"
+
+    def _renew(self):
+        self.user_agent = random_user_agent()
+        self._credentials = "".join(random.choices(string.ascii_lowercase + string.digits, k = 12))
+        self.transport = self.factory(self.proxy)
+
+    async def rotate(self, cooldown: float = COOLDOWN_TIME):
+        """Takes the identity out of rotation, drains it and gives it a new circuit, User-Agent and connection pool
+
+        Args:
+            cooldown (float, optional): Seconds to rest before taking requests again. Defaults to COOLDOWN_TIME.
+        """
+        self.cooling = True
+        try:
+            start = time.monotonic()
+            while self.in_flight > 0 and time.monotonic() - start < DRAIN_TIMEOUT:
+                await asyncio.sleep(0.1)
+            old = self.transport
+            self._renew()
+            await old.aclose()
+            if self.control_port is not None:
+                try:
+                    await tor_signal("NEWNYM", self.socks.rpartition(":")[0] if self.socks else TOR_HOST, self.control_port)
+                except (OSError, asyncio.TimeoutError, TorControlError) as e:
+                    logger.warning(f"[{self.name}] Could not signal NEWNYM - {e}")
+            self.rotations += 1
+            logger.debug(f"[{self.name}] Identity rotated ({self.rotations} so far)")
+            await asyncio.sleep(max(0.0, cooldown - (time.monotonic() - start)))
+        finally:
+            self.cooling = False
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "rotations": self.rotations,
+            "in_flight": self.in_flight,
+            "cooling": self.cooling
+        }
+
+
+class TrackedStream(httpx.AsyncByteStream):
+    """Response body that counts as in flight on its identity until it is closed"""
+    def __init__(self, stream: httpx.AsyncByteStream, identity: Identity):
+        self._stream = stream
+        self._identity = identity
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream: # type: ignore
+            yield chunk
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._identity.in_flight -= 1
+        await self._stream.aclose() # type: ignore
+
+
+class IdentityPool(httpx.AsyncBaseTransport):
+    """HTTPX transport balancing requests across identities, rotating one identity at a time in the background
+
+    Rotations are staggered by ROTATE_INTERVAL / N, so while one identity cools down the others keep working.
+    An identity that gets throttled or blocked is rotated straight away.
+    """
+    def __init__(self,
+                 identities: list[Identity],
+                 interval: float = ROTATE_INTERVAL,
+                 cooldown: float = COOLDOWN_TIME):
+        if len(identities) == 0:
+            raise ValueError("IdentityPool needs at least one identity")
+        self.identities = identities
+        self.interval = interval
+        self.cooldown = cooldown
+        self._next = 0
+        self._rotations: set[asyncio.Task] = set()
+        self._scheduler: asyncio.Task | None = None
+
+    @classmethod
+    def tor(cls,
+            socks_ports: list[int] = TOR_SOCKS_PORTS,
+            control_ports: list[int] | None = None,
+            host: str = TOR_HOST,
+            factory: Callable[[str | None], httpx.AsyncBaseTransport] = default_transport,
+            **kwargs) -> "IdentityPool":
+        """Creates one identity per Tor SOCKS port
+
+        Args:
+            socks_ports (list[int], optional): SOCKS ports, from one Tor instance or several. Defaults to TOR_SOCKS_PORTS.
+            control_ports (list[int] | None, optional): Control port of each SOCKS port's Tor instance. Defaults to TOR_CONTROL_PORT for all.
+            host (str, optional): Host Tor listens on. Defaults to TOR_HOST.
+            factory (Callable[[str | None], httpx.AsyncBaseTransport], optional): Creates a transport for a proxy URL. Defaults to default_transport.
+
+        Returns:
+            IdentityPool: Pool of identities
+        """
+        if control_ports is None:
+            control_ports = [TOR_CONTROL_PORT] * len(socks_ports)
+        return cls([
+            Identity(f"tor:{port}", f"{host}:{port}", control, factory)
+            for port, control in zip(socks_ports, control_ports)
+        ], **kwargs)
+
+    def choose(self) -> Identity:
+        # Least loaded identity that isn't cooling down - every identity cooling at once only happens with a single identity
+        available = [i for i in self.identities if not i.cooling] or self.identities
+        return min(available, key = lambda i: (i.in_flight, i.requests))
+
+    def rotate_soon(self, identity: Identity):
+        if identity.cooling:
+            return
+        task = asyncio.ensure_future(identity.rotate(self.cooldown))
+        self._rotations.add(task)
+        task.add_done_callback(self._rotations.discard)
+
+    async def _schedule(self):
+        while True:
+            await asyncio.sleep(self.interval / len(self.identities))
+            identity = self.identities[self._next % len(self.identities)]
+            self._next += 1
+            self.rotate_soon(identity)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self._scheduler is None:
+            self._scheduler = asyncio.ensure_future(self._schedule())
+        identity = self.choose()
+        request.headers["User-Agent"] = identity.user_agent
+        identity.in_flight += 1
+        identity.requests += 1
+        try:
+            response = await identity.transport.handle_async_request(request)
+        except BaseException as e:
+            identity.in_flight -= 1
+            if isinstance(e, httpx.TransportError):
+                identity.failures += 1
+            raise
+        if response.status_code in BACKOFF_STATUSES:
+            identity.failures += 1
+            self.rotate_soon(identity)
+        # The identity's connections stay open until the body has been read
+        return httpx.Response(
+            response.status_code,
+            headers = response.headers,
+            stream = TrackedStream(response.stream, identity),
+            extensions = response.extensions
+        )
+
+    def stats(self) -> dict[str, dict]:
+        return {i.name: i.stats() for i in self.identities}
+
+    async def aclose(self):
+        if self._scheduler is not None:
+            self._scheduler.cancel()
+        for task in list(self._rotations):
+            task.cancel()
+        await asyncio.gather(*self._rotations, *([self._scheduler] if self._scheduler else []), return_exceptions = True)
+        for identity in self.identities:
+            await identity.transport.aclose()
+        logger.info(f"Identity pool closed - {self.stats()}")
@@ -0,0 +1,163 @@
+import time
+import random
+import select
+import socket
+import threading
+import http.client
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+
+HOP_HEADERS = {"connection", "keep-alive", "proxy-connection", "proxy-authorization", "transfer-encoding", "te", "upgrade"}
+TUNNEL_BUFFER = 64 * 1024
+
+
+class MockProxy:
+    """Local forward proxy for plain HTTP requests and CONNECT tunnels, with injected latency and errors"""
+    def __init__(self,
+                 latency: tuple[float, float] = (0, 0),
+                 error_rate: float = 0,
+                 error_status: int = 503,
+                 host: str = "127.0.0.1",
+                 port: int = 0):
+        """
+        Args:
+            latency (tuple[float, float], optional): Range of seconds added to every request. Defaults to (0, 0).
+            error_rate (float, optional): Fraction of requests to fail instead of forwarding. Defaults to 0.
+            error_status (int, optional): Status code of injected errors, 0 to drop the connection. Defaults to 503.
+            host (str, optional): Interface to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on, 0 for any free port. Defaults to 0.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._forward()
+
+            def do_POST(self):
+                self._forward()
+
+            def do_CONNECT(self):
+                if not self._admit():
+                    return
+                host, _, port = self.path.rpartition(":")
+                try:
+                    upstream = socket.create_connection((host, int(port)), timeout = 10)
+                except OSError:
+                    self._send(502, b"")
+                    return
+                self.send_response(200, "Connection Established")
+                self.end_headers()
+                self._tunnel(upstream)
+
+            def _admit(self) -> bool:
+                # Counts the request and applies injected latency and errors
+                with server._lock:
+                    server.requests += 1
+                lo, hi = server.latency
+                if hi > 0:
+                    time.sleep(random.uniform(lo, hi))
+                if server.error_rate > 0 and random.random() < server.error_rate:
+                    with server._lock:
+                        server.errors += 1
+                    if server.error_status == 0:
+                        self.close_connection = True
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                    else:
+                        self._send(server.error_status, b"")
+                    return False
+                return True
+
+            def _forward(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length > 0 else b""
+                if not self._admit():
+                    return
+                parts = urlsplit(self.path)
+                if parts.scheme != "http" or not parts.hostname:
+                    self._send(400, b"")
+                    return
+                headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_HEADERS}
+                conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout = 30)
+                try:
+                    conn.request(self.command, parts.path + (f"?{parts.query}" if parts.query else "") or "/", body = body, headers = headers)
+                    response = conn.getresponse()
+                    content = response.read()
+                except OSError:
+                    self._send(502, b"")
+                    return
+                finally:
+                    conn.close()
+                self.send_response(response.status)
+                for k, v in response.getheaders():
+                    if k.lower() not in HOP_HEADERS and k.lower() != "content-length":
+                        self.send_header(k, v)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def _tunnel(self, upstream: socket.socket):
+                sockets = [self.connection, upstream]
+                try:
+                    while True:
+                        readable, _, _ = select.select(sockets, [], [], 30)
+                        if not readable:
+                            break
+                        for s in readable:
+                            data = s.recv(TUNNEL_BUFFER)
+                            if not data:
+                                return
+                            (upstream if s is self.connection else self.connection).sendall(data)
+                except OSError:
+                    pass
+                finally:
+                    upstream.close()
+                    self.close_connection = True
+
+            def _send(self, status: int, content: bytes):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format: str, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "MockProxy":
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+        logger.info(f"Mock proxy listening on {self.url}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        logger.info(f"Mock proxy {self.url} stopped - {self.requests} requests, {self.errors} injected errors")
+
+    def __enter__(self) -> "MockProxy":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
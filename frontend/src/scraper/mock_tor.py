@@ -0,0 +1,178 @@
+import random
+import select
+import socket
+import struct
+import threading
+import socketserver
+
+from loguru import logger
+
+
+MOCK_PASSWORD = "password"
+TUNNEL_BUFFER = 64 * 1024
+
+
+class MockTor:
+    """Local stand-in for a Tor instance - a SOCKS5 proxy that tunnels connections and a control port accepting NEWNYM
+
+    Every distinct SOCKS username counts as a separate circuit, as with Tor's IsolateSOCKSAuth.
+    """
+    def __init__(self,
+                 error_rate: float = 0,
+                 password: str = MOCK_PASSWORD,
+                 host: str = "127.0.0.1",
+                 socks_port: int = 0,
+                 control_port: int = 0):
+        """
+        Args:
+            error_rate (float, optional): Fraction of SOCKS connections to refuse. Defaults to 0.
+            password (str, optional): Control port password. Defaults to MOCK_PASSWORD.
+            host (str, optional): Interface to listen on. Defaults to "127.0.0.1".
+            socks_port (int, optional): SOCKS port, 0 for any free port. Defaults to 0.
+            control_port (int, optional): Control port, 0 for any free port. Defaults to 0.
+        """
+        self.error_rate = error_rate
+        self.password = password
+        self.connections = 0
+        self.errors = 0
+        self.newnyms = 0
+        self.circuits: dict[str, int] = {} # Connections per SOCKS username
+        self._lock = threading.Lock()
+        self._socks = socketserver.ThreadingTCPServer((host, socks_port), self._make_socks_handler())
+        self._control = socketserver.ThreadingTCPServer((host, control_port), self._make_control_handler())
+        for server in (self._socks, self._control):
+            server.daemon_threads = True
+        self._threads: list[threading.Thread] = []
+
+    @property
+    def socks(self) -> str:
+        host, port = self._socks.server_address[:2]
+        return f"{host}:{port}"
+
+    @property
+    def socks_port(self) -> int:
+        return self._socks.server_address[1]
+
+    @property
+    def control_port(self) -> int:
+        return self._control.server_address[1]
+
+    def _make_socks_handler(self) -> type[socketserver.BaseRequestHandler]:
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    self._handle()
+                except (OSError, struct.error, ValueError):
+                    pass
+
+            def _handle(self):
+                version, num_methods = self.rfile.read(2)
+                methods = self.rfile.read(num_methods)
+                if version != 5:
+                    return
+                username = ""
+                if 2 in methods:
+                    # Username/password auth - any credentials are accepted
+                    self.wfile.write(b"\x05\x02")
+                    self.rfile.read(1)
+                    username = self.rfile.read(self.rfile.read(1)[0]).decode("utf-8", "replace")
+                    self.rfile.read(self.rfile.read(1)[0])
+                    self.wfile.write(b"\x01\x00")
+                else:
+                    self.wfile.write(b"\x05\x00")
+
+                _, command, _, address_type = self.rfile.read(4)
+                if address_type == 1:
+                    host = socket.inet_ntoa(self.rfile.read(4))
+                elif address_type == 3:
+                    host = self.rfile.read(self.rfile.read(1)[0]).decode("idna")
+                elif address_type == 4:
+                    host = socket.inet_ntop(socket.AF_INET6, self.rfile.read(16))
+                else:
+                    return
+                port = struct.unpack("!H", self.rfile.read(2))[0]
+
+                with server._lock:
+                    server.connections += 1
+                    server.circuits[username] = server.circuits.get(username, 0) + 1
+                if command != 1 or (server.error_rate > 0 and random.random() < server.error_rate):
+                    with server._lock:
+                        server.errors += 1
+                    self.wfile.write(b"\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00")
+                    return
+                try:
+                    upstream = socket.create_connection((host, port), timeout = 10)
+                except OSError:
+                    self.wfile.write(b"\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00")
+                    return
+                self.wfile.write(b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00")
+                self.wfile.flush()
+                self._tunnel(upstream)
+
+            def _tunnel(self, upstream: socket.socket):
+                sockets = [self.connection, upstream]
+                try:
+                    while True:
+                        readable, _, _ = select.select(sockets, [], [], 30)
+                        if not readable:
+                            break
+                        for s in readable:
+                            data = s.recv(TUNNEL_BUFFER)
+                            if not data:
+                                return
+                            (upstream if s is self.connection else self.connection).sendall(data)
+                finally:
+                    upstream.close()
+
+        return Handler
+
+    def _make_control_handler(self) -> type[socketserver.BaseRequestHandler]:
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                authenticated = False
+                for line in self.rfile:
+                    command, _, argument = line.decode("ascii", "replace").strip().partition(" ")
+                    command = command.upper()
+                    if command == "AUTHENTICATE":
+                        authenticated = argument.strip('"') == server.password
+                        self._reply("250 OK" if authenticated else "515 Authentication failed")
+                    elif command == "QUIT":
+                        self._reply("250 closing connection")
+                        return
+                    elif not authenticated:
+                        self._reply("514 Authentication required.")
+                    elif command == "SIGNAL" and argument.upper() == "NEWNYM":
+                        with server._lock:
+                            server.newnyms += 1
+                        self._reply("250 OK")
+                    else:
+                        self._reply(f'510 Unrecognized command "{command}"')
+
+            def _reply(self, text: str):
+                self.wfile.write(f"{text}\r\n".encode("ascii"))
+
+        return Handler
+
+    def start(self) -> "MockTor":
+        for server in (self._socks, self._control):
+            thread = threading.Thread(target = server.serve_forever, daemon = True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Mock Tor listening on {self.socks} (control port {self.control_port})")
+        return self
+
+    def stop(self):
+        for server in (self._socks, self._control):
+            server.shutdown()
+            server.server_close()
+        logger.info(f"Mock Tor {self.socks} stopped - {self.connections} connections over {len(self.circuits)} circuits, {self.newnyms} NEWNYM signals, {self.errors} injected errors")
+
+    def __enter__(self) -> "MockTor":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
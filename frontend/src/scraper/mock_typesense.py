@@ -0,0 +1,167 @@
+import json
+import random
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+
+MOCK_API_KEY = "mock"
+
+
+class MockTypesense:
+    """Local stand-in for the Typesense collection and import endpoints, with injected request and line errors"""
+    def __init__(self,
+                 error_rate: float = 0,
+                 line_error_rate: float = 0,
+                 error_status: int = 503,
+                 api_key: str = MOCK_API_KEY,
+                 host: str = "127.0.0.1",
+                 port: int = 0):
+        """
+        Args:
+            error_rate (float, optional): Fraction of import requests to fail outright. Defaults to 0.
+            line_error_rate (float, optional): Fraction of imported documents to reject individually. Defaults to 0.
+            error_status (int, optional): Status code of injected errors. Defaults to 503.
+            api_key (str, optional): Key clients have to send. Defaults to MOCK_API_KEY.
+            host (str, optional): Interface to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on, 0 for any free port. Defaults to 0.
+        """
+        self.error_rate = error_rate
+        self.line_error_rate = line_error_rate
+        self.error_status = error_status
+        self.api_key = api_key
+        self.collections: dict[str, dict] = {}
+        self.documents: dict[str, dict[str, dict]] = {}
+        self.requests = 0
+        self.imported = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def config(self) -> dict:
+        host, port = self._server.server_address[:2]
+        return {
+            "TYPESENSE_HOST": host,
+            "TYPESENSE_PORT": str(port),
+            "TYPESENSE_PROTOCOL": "http",
+            "TYPESENSE_API_KEY": self.api_key
+        }
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._route()
+
+            def do_POST(self):
+                self._route()
+
+            def do_DELETE(self):
+                self._route()
+
+            def _route(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length > 0 else b""
+                parts = urlsplit(self.path)
+                path = [p for p in parts.path.split("/") if p]
+                with server._lock:
+                    server.requests += 1
+                if self.headers.get("X-TYPESENSE-API-KEY") != server.api_key:
+                    self._send(401, {"message": "Forbidden - a valid `x-typesense-api-key` header must be sent."})
+                    return
+
+                if path == ["collections"] and self.command == "GET":
+                    self._send(200, list(server.collections.values()))
+                elif path == ["collections"] and self.command == "POST":
+                    schema = json.loads(body)
+                    with server._lock:
+                        if schema["name"] in server.collections:
+                            self._send(409, {"message": f"A collection with name `{schema['name']}` already exists."})
+                            return
+                        server.collections[schema["name"]] = schema
+                        server.documents[schema["name"]] = {}
+                    self._send(201, schema)
+                elif len(path) == 2 and path[0] == "collections" and self.command == "DELETE":
+                    with server._lock:
+                        schema = server.collections.pop(path[1], None)
+                        server.documents.pop(path[1], None)
+                    if schema is None:
+                        self._send(404, {"message": "Not Found"})
+                    else:
+                        self._send(200, schema)
+                elif len(path) == 4 and path[2:] == ["documents", "import"] and self.command == "POST":
+                    self._import(path[1], parse_qs(parts.query).get("action", ["create"])[0], body)
+                else:
+                    self._send(404, {"message": "Not Found"})
+
+            def _import(self, name: str, action: str, body: bytes):
+                if name not in server.documents:
+                    self._send(404, {"message": "Not Found"})
+                    return
+                if server.error_rate > 0 and random.random() < server.error_rate:
+                    with server._lock:
+                        server.errors += 1
+                    self._send(server.error_status, {"message": "Injected error"})
+                    return
+
+                results = []
+                for line in body.decode("utf-8").splitlines():
+                    if not line.strip():
+                        continue
+                    if server.line_error_rate > 0 and random.random() < server.line_error_rate:
+                        with server._lock:
+                            server.errors += 1
+                        results.append({"success": False, "error": "Injected error", "code": server.error_status, "document": line})
+                        continue
+                    try:
+                        doc = json.loads(line)
+                    except json.JSONDecodeError:
+                        results.append({"success": False, "error": "Bad JSON.", "code": 400, "document": line})
+                        continue
+                    with server._lock:
+                        docs = server.documents[name]
+                        if action == "create" and doc.get("id") in docs:
+                            results.append({"success": False, "error": "A document with id already exists.", "code": 409, "document": line})
+                            continue
+                        docs[doc.get("id", str(len(docs)))] = doc
+                        server.imported += 1
+                    results.append({"success": True})
+                self._send(200, "\n".join(json.dumps(r) for r in results))
+
+            def _send(self, status: int, data: object):
+                content = (data if isinstance(data, str) else json.dumps(data)).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format: str, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "MockTypesense":
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+        logger.info(f"Mock Typesense listening on {self.config['TYPESENSE_HOST']}:{self.config['TYPESENSE_PORT']}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        logger.info(f"Mock Typesense stopped - {self.requests} requests, {self.imported} documents imported, {self.errors} injected errors")
+
+    def __enter__(self) -> "MockTypesense":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
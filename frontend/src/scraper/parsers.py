@@ -0,0 +1,169 @@
+import re
+import json
+import asyncio
+from typing import Callable, TYPE_CHECKING
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from loguru import logger
+if TYPE_CHECKING:
+    # lxml is only imported when a search page is parsed
+    from lxml import etree
+
+from scraper_utils import ta_url, find_nested_key, extract_nested_key, hash_str_array
+from telemetry import TELEMETRY
+
+
+PARSE_WORKERS = 0 # Set above 0 to parse pages in a process pool off the event loop
+RST_KEY = "RestaurantPresentation_searchRestaurantsByGeo"
+
+
+def get_page_data(html: str) -> dict:
+    """Extract JS pageManifest object's state data from graphql hidden in HTML page
+
+    Args:
+        html (str): Page HTML
+
+    Returns:
+        dict: Dictionary representing JS state
+    """
+    data = re.findall(r"{pageManifest:({.+?})};", html, re.DOTALL)[0]
+    return json.loads(data)
+
+
+def parse_search_items(tree: "etree._Element") -> list[dict]:
+    """Parses search results page for individual items
+
+    Args:
+        tree (etree._Element): Root element of page
+
+    Returns:
+        list[dict]: Restaurant URL and JSON-encoded image URLs of each listing
+    """
+    items = []
+    r = re.compile(r"url\(\"(.*?)\"\)")
+
+    for elem in tree.xpath("//div[@data-test]"):
+        # Gather required info using xpath
+        if elem.xpath("@data-test")[0] == "SL_list_item":
+            continue
+        urls = elem.xpath(".//a[contains(@href, 'Restaurant_Review') and string-length(text()) > 0]/@href")
+        if len(urls) == 0:
+            continue
+
+        imgs = elem.xpath(".//div[contains(@style, 'background-image')]/@style")
+        imgs = [re.findall(r, img)[0] for img in imgs]
+        imgs = list(set(imgs))
+
+        items.append({"url": ta_url(urls[0]), "imgs": json.dumps(imgs)})
+
+    return items
+
+
+def parse_search_fields(html: str) -> dict | None:
+    """Parses the total result count and listings of a search page, rendered or not
+
+    Listings are read from the DOM when present, otherwise from restaurant links in the embedded page state.
+
+    Args:
+        html (str): Search page HTML
+
+    Returns:
+        dict | None: Total number of results under "count" and listings under "items", or None if not found
+    """
+    from lxml import etree
+    tree = etree.HTML(html, None)
+    if tree is None:
+        return None
+    items = parse_search_items(tree)
+    if len(items) == 0:
+        urls = dict.fromkeys(re.findall(r"(/Restaurant_Review-g\d+-d\d+-Reviews-[^\"'\\\s]+?\.html)", html))
+        items = [{"url": ta_url(u), "imgs": json.dumps([])} for u in urls]
+
+    count = tree.xpath("//span[contains(text(), 'results')]/span/text()")
+    if len(count) == 0:
+        count = re.findall(r"\"(?:totalResults|totalCount|resultCount)\"\s*:\s*(\d+)", html)
+    if len(count) == 0 or len(items) == 0:
+        return None
+    return {"count": int(str(count[0]).replace(",", "")), "items": items}
+
+
+def parse_rst_fields(html: str) -> dict:
+    """Parses a restaurant's details from its page
+
+    Args:
+        html (str): Restaurant page HTML
+
+    Returns:
+        dict: Restaurant fields found on the page - fields after the first missing one are left out
+    """
+    data_rst = extract_nested_key(html, RST_KEY)
+    if data_rst is None:
+        data = get_page_data(html)["urqlCache"]["results"]
+        data_rst = find_nested_key(data, RST_KEY)
+    data_rst = data_rst[RST_KEY]["restaurants"][0]
+
+    fields = {}
+    try:
+        fields["name"] = data_rst["name"]
+        fields["address"] = data_rst["localizedRealtimeAddress"]
+        fields["phone"] = data_rst["telephone"]
+        fields["id"] = hash_str_array([fields["address"], fields["name"]])
+        fields["rating"] = data_rst["reviewSummary"]["rating"]
+        fields["review_count"] = data_rst["reviewSummary"]["count"]
+        fields["tags"] = json.dumps([tag["tag"]["localizedName"] for tag in data_rst["topTags"]])
+        temp_price = data_rst["topTags"][0]["secondary_name"]
+        fields["price"] = temp_price if temp_price is not None else ""
+    except Exception:
+        pass
+    if data_rst.get("latitude") is not None and data_rst.get("longitude") is not None:
+        fields["lat"] = float(data_rst["latitude"])
+        fields["lng"] = float(data_rst["longitude"])
+    return fields
+
+
+class ParsePool:
+    """Runs parse functions in a process pool, falling back to threads if processes are unavailable"""
+    def __init__(self, workers: int = PARSE_WORKERS):
+        self.workers = workers
+        self._executor: Executor | None = None
+        if workers > 0:
+            try:
+                self._executor = ProcessPoolExecutor(workers)
+            except (OSError, NotImplementedError, ImportError) as e:
+                self._use_threads(e)
+
+    def _use_threads(self, e: Exception):
+        logger.warning(f"Process pool unavailable, parsing in threads instead - {e}")
+        if self._executor is not None:
+            self._executor.shutdown(wait = False, cancel_futures = True)
+        self._executor = ThreadPoolExecutor(self.workers)
+
+    async def run(self, func: Callable, *args) -> object:
+        """Runs a picklable parse function with plain arguments, timing it under the function's name
+
+        Args:
+            func (Callable): Module-level parse function
+            *args: Arguments to pass, e.g. raw HTML
+
+        Returns:
+            object: Result of the function
+        """
+        with TELEMETRY.timer("stage_seconds", stage = func.__name__):
+            return await self._run(func, *args)
+
+    async def _run(self, func: Callable, *args) -> object:
+        if self._executor is None:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        except (BrokenProcessPool, OSError) as e:
+            if isinstance(self._executor, ThreadPoolExecutor):
+                raise
+            self._use_threads(e)
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures = True)
@@ -0,0 +1,104 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+
+from telemetry import TELEMETRY
+
+
+QUEUE_SIZE = 100
+
+
+class Stage:
+    """A pool of workers pulling items from a bounded queue and passing results to the next stage"""
+    def __init__(self,
+                 name: str,
+                 func: Callable[[Any], Awaitable[Any]],
+                 concurrency: int = 1,
+                 maxsize: int = QUEUE_SIZE,
+                 fan_out: bool = False):
+        """
+        Args:
+            name (str): Stage name used in logs and stats
+            func (Callable[[Any], Awaitable[Any]]): Coroutine processing one item - returning None drops the item
+            concurrency (int, optional): Number of workers. Defaults to 1.
+            maxsize (int, optional): Queue bound - producers wait when the queue is full. Defaults to QUEUE_SIZE.
+            fan_out (bool, optional): Treat results as iterables and pass on each element. Defaults to False.
+        """
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.fan_out = fan_out
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.next: Stage | None = None
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self._workers: list[asyncio.Task] = []
+
+    async def put(self, item: Any):
+        await self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        TELEMETRY.set("queue_depth", self.queue.qsize(), stage = self.name)
+
+    async def _work(self):
+        while True:
+            item = await self.queue.get()
+            TELEMETRY.set("queue_depth", self.queue.qsize(), stage = self.name)
+            try:
+                result = await self.func(item)
+                self.processed += 1
+                if result is not None and self.next is not None:
+                    for r in (result if self.fan_out else [result]):
+                        await self.next.put(r)
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"[{self.name}] Stage failed to process item - {e}")
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions = True)
+        self._workers = []
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "depth": self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+            "failed": self.failed
+        }
+
+
+class Pipeline:
+    """Chain of Stages connected by bounded queues, so every stage runs concurrently with the others"""
+    def __init__(self, stages: list[Stage]):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+
+    def __getitem__(self, name: str) -> Stage:
+        return [stage for stage in self.stages if stage.name == name][0]
+
+    async def __aenter__(self) -> "Pipeline":
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    async def __aexit__(self, *args):
+        for stage in self.stages:
+            await stage.stop()
+
+    async def join(self):
+        # Items only flow forward, so once a stage drains nothing new can reach the stages before it
+        for stage in self.stages:
+            await stage.queue.join()
+
+    def stats(self) -> dict[str, dict]:
+        return {stage.name: stage.stats() for stage in self.stages}
@@ -1,22 +1,288 @@
 import re
-import requests
-from lxml import etree
-
-## HTTP proxies method
-
-r = r"([0-9]+(?:\.[0-9]+){3}:[0-9]+)"
-response = requests.get("https://spys.me/proxy.txt")
-text = response.text
-proxies = re.findall(r, text)
-
-response = requests.get("https://free-proxy-list.net/")
-tree = etree.HTML(response.text, None)
-text = tree.xpath("//textarea/text()")
-for t in text:
-    proxies_temp = re.findall(r, t)
-    proxies.extend(proxies_temp)
-    
-print(proxies)
-
-## SOCKS (Tor) proxies method
-# https://boredhacking.com/tor-webscraping-proxy/
\ No newline at end of file
+import time
+import random
+import asyncio
+import argparse
+from pathlib import Path
+from typing import Callable
+from dataclasses import dataclass
+
+import httpx
+from loguru import logger
+
+from throttle import BACKOFF_STATUSES
+
+
+PROXY_SOURCES = ["https://spys.me/proxy.txt", "https://free-proxy-list.net/"]
+PROXY_FILE = Path(__file__).resolve().parent / "csv" / "proxies.txt"
+CHECK_URL = "https://www.tripadvisor.com/robots.txt"
+CHECK_TIMEOUT = 5
+CHECK_CONCURRENCY = 50
+MIN_SAMPLES = 5 # Requests through a proxy before its success rate can evict it
+MIN_SUCCESS_RATE = 0.5
+MAX_FAILURES = 3 # Consecutive failures that evict a proxy regardless of its success rate
+LATENCY_WEIGHT = 0.3 # Weight of the newest sample in a proxy's moving average latency
+SESSION_EXTENSION = "proxy_session" # Request extension naming a sticky session
+
+_proxy_re = re.compile(r"(?:(https?|socks5h?)://)?((?:[^\s:@/]+:[^\s:@/]+@)?[0-9]+(?:\.[0-9]+){3}:[0-9]+)")
+
+
+class NoProxyError(Exception):
+    """Raised when every proxy in a pool has been evicted"""
+
+
+def parse_candidates(text: str) -> list[str]:
+    """Finds proxy addresses in free-form text, such as a proxy list page or a file with one proxy per line
+
+    Args:
+        text (str): Text containing "host:port" or "scheme://[user:pass@]host:port" addresses
+
+    Returns:
+        list[str]: Unique proxy URLs in order of appearance - "http://" unless a scheme was given
+    """
+    urls = [f"{scheme or 'http'}://{address}" for scheme, address in _proxy_re.findall(text)]
+    return list(dict.fromkeys(urls))
+
+
+def load_candidates(source: str | Path | list[str]) -> list[str]:
+    """Loads proxy URLs from a file or a list
+
+    Args:
+        source (str | Path | list[str]): Path to a text file, or proxy addresses
+
+    Returns:
+        list[str]: Unique proxy URLs
+    """
+    if isinstance(source, list):
+        return parse_candidates("\n".join(source))
+    return parse_candidates(Path(source).read_text())
+
+
+async def fetch_candidates(sources: list[str] = PROXY_SOURCES) -> list[str]:
+    """Downloads free proxy lists - candidates are mostly dead and should be checked before use
+
+    Args:
+        sources (list[str], optional): URLs of proxy list pages. Defaults to PROXY_SOURCES.
+
+    Returns:
+        list[str]: Unique proxy URLs
+    """
+    async with httpx.AsyncClient(timeout = CHECK_TIMEOUT, follow_redirects = True) as client:
+        responses = await asyncio.gather(*[client.get(url) for url in sources], return_exceptions = True)
+    text = []
+    for url, response in zip(sources, responses):
+        if isinstance(response, Exception):
+            logger.error(f"Could not fetch proxy list {url}: {response}")
+            continue
+        text.append(response.text)
+    return parse_candidates("\n".join(text))
+
+
+def default_transport(url: str) -> httpx.AsyncBaseTransport:
+    return httpx.AsyncHTTPTransport(proxy = httpx.Proxy(url), http2 = True)
+
+
+@dataclass
+class Proxy:
+    url: str
+    latency: float = 0.0 # Moving average seconds to response headers
+    successes: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    in_flight: int = 0
+    evicted: bool = False
+
+    @property
+    def success_rate(self) -> float:
+        # Smoothed so a proxy isn't judged on its first few requests
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def score(self) -> float:
+        return self.success_rate / (max(self.latency, 0.05) * (1 + self.in_flight))
+
+
+class ProxyPool:
+    """Proxies scored by latency and success rate, with failing ones evicted from rotation"""
+    def __init__(self,
+                 candidates: list[str],
+                 check_url: str = CHECK_URL,
+                 factory: Callable[[str], httpx.AsyncBaseTransport] = default_transport,
+                 min_success_rate: float = MIN_SUCCESS_RATE,
+                 max_failures: int = MAX_FAILURES):
+        """
+        Args:
+            candidates (list[str]): Proxy URLs
+            check_url (str, optional): URL requested by health checks. Defaults to CHECK_URL.
+            factory (Callable[[str], httpx.AsyncBaseTransport], optional): Creates the transport for a proxy URL. Defaults to default_transport.
+            min_success_rate (float, optional): Success rate below which a proxy is evicted. Defaults to MIN_SUCCESS_RATE.
+            max_failures (int, optional): Consecutive failures that evict a proxy. Defaults to MAX_FAILURES.
+        """
+        self.check_url = check_url
+        self.factory = factory
+        self.min_success_rate = min_success_rate
+        self.max_failures = max_failures
+        self._proxies = {url: Proxy(url) for url in dict.fromkeys(candidates)}
+        self._transports: dict[str, httpx.AsyncBaseTransport] = {}
+        self._sessions: dict[str, Proxy] = {}
+
+    @property
+    def active(self) -> list[Proxy]:
+        return [p for p in self._proxies.values() if not p.evicted]
+
+    def transport(self, proxy: Proxy) -> httpx.AsyncBaseTransport:
+        if proxy.url not in self._transports:
+            self._transports[proxy.url] = self.factory(proxy.url)
+        return self._transports[proxy.url]
+
+    def choose(self, session: str | None = None) -> Proxy:
+        """Picks a proxy for a request - the better of two random proxies, which spreads load while favouring fast ones
+
+        Args:
+            session (str | None, optional): Sticky session whose requests should keep the same proxy. Defaults to None.
+
+        Returns:
+            Proxy: Proxy to send the request through
+        """
+        if session is not None:
+            proxy = self._sessions.get(session)
+            if proxy is not None and not proxy.evicted:
+                return proxy
+        active = self.active
+        if len(active) == 0:
+            raise NoProxyError(f"All {len(self._proxies)} proxies have been evicted")
+        proxy = max(random.sample(active, min(2, len(active))), key = lambda p: p.score)
+        if session is not None:
+            self._sessions[session] = proxy
+        return proxy
+
+    def record(self, proxy: Proxy, ok: bool, latency: float | None = None):
+        """Updates a proxy's score after a request, evicting it if it keeps failing
+
+        Args:
+            proxy (Proxy): Proxy the request was sent through
+            ok (bool): Whether the request succeeded
+            latency (float | None, optional): Seconds to response headers. Defaults to None.
+        """
+        if latency is not None:
+            proxy.latency = latency if proxy.latency == 0 else (1 - LATENCY_WEIGHT) * proxy.latency + LATENCY_WEIGHT * latency
+        if ok:
+            proxy.successes += 1
+            proxy.consecutive_failures = 0
+            return
+        proxy.failures += 1
+        proxy.consecutive_failures += 1
+        if proxy.consecutive_failures >= self.max_failures:
+            self.evict(proxy, f"{proxy.consecutive_failures} consecutive failures")
+        elif proxy.successes + proxy.failures >= MIN_SAMPLES and proxy.success_rate < self.min_success_rate:
+            self.evict(proxy, f"success rate {proxy.success_rate:.0%}")
+
+    def evict(self, proxy: Proxy, reason: str):
+        if proxy.evicted:
+            return
+        proxy.evicted = True
+        logger.warning(f"[{proxy.url}] Proxy evicted - {reason} ({len(self.active)} left)")
+
+    async def check(self, concurrency: int = CHECK_CONCURRENCY, timeout: float = CHECK_TIMEOUT) -> list[Proxy]:
+        """Requests the check URL through every active proxy at once, evicting those that fail
+
+        Args:
+            concurrency (int, optional): Maximum checks in flight. Defaults to CHECK_CONCURRENCY.
+            timeout (float, optional): Seconds before a check fails. Defaults to CHECK_TIMEOUT.
+
+        Returns:
+            list[Proxy]: Proxies that passed, fastest first
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def check_one(proxy: Proxy):
+            async with semaphore:
+                request = httpx.Request("GET", self.check_url, extensions = {"timeout": httpx.Timeout(timeout).as_dict()})
+                start = time.perf_counter()
+                try:
+                    response = await asyncio.wait_for(self.transport(proxy).handle_async_request(request), timeout)
+                    await response.aclose()
+                except (httpx.HTTPError, asyncio.TimeoutError, OSError) as e:
+                    self.evict(proxy, f"health check failed: {type(e).__name__}")
+                    return
+                # Any answer from the site shows the proxy works, unless the site is refusing it
+                if response.status_code in BACKOFF_STATUSES or response.status_code >= 500:
+                    self.evict(proxy, f"health check returned HTTP {response.status_code}")
+                    return
+                self.record(proxy, True, time.perf_counter() - start)
+
+        proxies = self.active
+        start = time.perf_counter()
+        await asyncio.gather(*[check_one(p) for p in proxies])
+        passed = sorted(self.active, key = lambda p: p.latency)
+        logger.info(f"{len(passed)}/{len(proxies)} proxies passed health check in {time.perf_counter() - start:.2f}s")
+        return passed
+
+    def stats(self) -> dict:
+        active = self.active
+        return {
+            "active": len(active),
+            "evicted": len(self._proxies) - len(active),
+            "requests": sum(p.successes + p.failures for p in self._proxies.values()),
+            "failures": sum(p.failures for p in self._proxies.values()),
+            "sessions": len(self._sessions)
+        }
+
+    async def aclose(self):
+        for transport in self._transports.values():
+            await transport.aclose()
+        self._transports.clear()
+
+
+class ProxyTransport(httpx.AsyncBaseTransport):
+    """HTTPX transport that sends each request through a proxy chosen from a ProxyPool
+
+    Requests carrying a "proxy_session" extension keep using the same proxy while it stays in the pool.
+    """
+    def __init__(self, pool: ProxyPool):
+        self.pool = pool
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        proxy = self.pool.choose(request.extensions.get(SESSION_EXTENSION))
+        proxy.in_flight += 1
+        start = time.perf_counter()
+        try:
+            response = await self.pool.transport(proxy).handle_async_request(request)
+        except httpx.TransportError:
+            self.pool.record(proxy, False)
+            raise
+        finally:
+            proxy.in_flight -= 1
+        self.pool.record(proxy, response.status_code not in BACKOFF_STATUSES, time.perf_counter() - start)
+        return response
+
+    async def aclose(self):
+        await self.pool.aclose()
+
+
+async def refresh_file(file: Path, fetch: bool):
+    candidates = await fetch_candidates() if fetch else load_candidates(file)
+    pool = ProxyPool(candidates)
+    passed = await pool.check()
+    await pool.aclose()
+    file.parent.mkdir(parents = True, exist_ok = True)
+    file.write_text("".join(f"{p.url}\n" for p in passed))
+    logger.info(f"Saved {len(passed)} working proxies to {file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Proxy list maintenance")
+    parser.add_argument(
+        "--file",
+        action = "store",
+        help = "proxy list to check and rewrite instead of csv/proxies.txt",
+        default = PROXY_FILE
+    )
+    parser.add_argument(
+        "--fetch",
+        action = "store_true",
+        help = "replace the list with proxies downloaded from free proxy lists"
+    )
+    args = parser.parse_args()
+
+    asyncio.run(refresh_file(Path(args.file), args.fetch))
@@ -0,0 +1,226 @@
+import time
+import math
+import heapq
+import json
+import hashlib
+import asyncio
+import argparse
+
+from loguru import logger
+from sqlalchemy import select, or_
+from sqlalchemy.dialects.sqlite import insert
+
+from scraper_utils import ScraperClient, wrap_except
+from scraper_ta import MAX_CONN_AT_ONCE, MAX_CONN_PER_SEC
+from parsers import ParsePool, PARSE_WORKERS, parse_rst_fields
+from database import engine, Restaurant, RestaurantMeta, Session, RST_DEFAULTS
+from writer import DatabaseWriter
+from throttle import AdaptiveThrottle
+
+
+REFRESH_BUDGET = 1000 # Maximum number of restaurant pages requested per refresh
+REFRESH_MAX_AGE = 7 * 24 * 60 * 60 # Seconds before a checked restaurant is due again
+HASH_FIELDS = ["name", "address", "phone", "rating", "review_count", "tags", "price", "lat", "lng"]
+
+
+def hash_fields(fields: dict) -> str:
+    """Hashes the fields extracted from a restaurant page so unchanged pages can be detected
+
+    Args:
+        fields (dict): Fields from parse_rst_fields()
+
+    Returns:
+        str: SHA-256 of the fields, independent of key order
+    """
+    data = json.dumps({k: fields.get(k, RST_DEFAULTS[k]) for k in HASH_FIELDS}, sort_keys = True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def priority(review_count: int, checked: float | None, now: float) -> float:
+    # Older checks come first, weighted towards popular restaurants whose details change more often
+    age = now - (checked or 0.0)
+    return age * (1 + math.log1p(max(review_count, 0)))
+
+
+def select_due(budget: int = REFRESH_BUDGET, max_age: float = REFRESH_MAX_AGE) -> list[tuple[Restaurant, RestaurantMeta]]:
+    """Picks the restaurants most in need of a refresh
+
+    Args:
+        budget (int, optional): Maximum number of restaurants to pick. Defaults to REFRESH_BUDGET.
+        max_age (float, optional): Seconds since the last check before a restaurant is due. Defaults to REFRESH_MAX_AGE.
+
+    Returns:
+        list[tuple[Restaurant, RestaurantMeta]]: Detached restaurants and their refresh metadata, highest priority first
+    """
+    now = time.time()
+    stmt = (
+        select(Restaurant.id, Restaurant.url, Restaurant.review_count, RestaurantMeta.checked)
+        .outerjoin(RestaurantMeta, RestaurantMeta.url == Restaurant.url)
+        .where(Restaurant.url != "")
+        .where(or_(RestaurantMeta.checked.is_(None), RestaurantMeta.checked < now - max_age))
+    )
+    with engine.connect() as conn:
+        rows = conn.execute(stmt).all()
+    rows = heapq.nlargest(budget, rows, key = lambda row: priority(row.review_count, row.checked, now))
+    ids = [row.id for row in rows]
+
+    with Session(expire_on_commit = False) as session:
+        rsts = {rst.id: rst for rst in session.scalars(select(Restaurant).where(Restaurant.id.in_(ids)))}
+        metas = {meta.url: meta for meta in session.scalars(select(RestaurantMeta).where(RestaurantMeta.url.in_([row.url for row in rows])))}
+        session.expunge_all()
+
+    due = []
+    seen = set()
+    for row in rows:
+        if row.url in seen or row.id not in rsts:
+            continue
+        seen.add(row.url)
+        rst = rsts[row.id]
+        meta = metas.get(row.url)
+        if meta is None:
+            # Restaurants never refreshed are compared against what the crawl stored
+            fields_hash = hash_fields({k: getattr(rst, k) for k in HASH_FIELDS})
+            meta = RestaurantMeta(url = row.url, id = row.id, etag = "", last_modified = "", fields_hash = fields_hash, checked = 0.0, changed = 0.0)
+        due.append((rst, meta))
+    return due
+
+
+def upsert_meta(metas: list[RestaurantMeta]):
+    if len(metas) == 0:
+        return
+    columns = [c.name for c in RestaurantMeta.__table__.columns]
+    stmt = insert(RestaurantMeta)
+    stmt = stmt.on_conflict_do_update(
+        index_elements = ["url"],
+        set_ = {c: stmt.excluded[c] for c in columns if c != "url"}
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt, [{c: getattr(meta, c) for c in columns} for meta in metas])
+
+
+@wrap_except("Could not refresh restaurant page")
+async def refresh_rst_page(client: ScraperClient,
+                           rst: Restaurant,
+                           meta: RestaurantMeta,
+                           parse_pool: ParsePool) -> tuple[str, Restaurant]:
+    """Conditionally re-scrapes a restaurant page, parsing it only if the server sent a new version
+
+    Args:
+        client (ScraperClient): HTTPX client
+        rst (Restaurant): Stored Restaurant dataclass containing URL to refresh
+        meta (RestaurantMeta): Validators and fields hash from the last refresh - updated in place
+        parse_pool (ParsePool): Executor for parsing off the event loop
+
+    Returns:
+        tuple[str, Restaurant]: "not_modified", "unchanged" or "changed", and the possibly modified Restaurant dataclass
+    """
+    headers = {}
+    if meta.etag:
+        headers["If-None-Match"] = meta.etag
+    if meta.last_modified:
+        headers["If-Modified-Since"] = meta.last_modified
+    response = await client.get(rst.url, headers = headers)
+    now = time.time()
+    if response.status_code == 304:
+        meta.checked = now
+        return "not_modified", rst
+    response.raise_for_status()
+
+    fields = await parse_pool.run(parse_rst_fields, response.text)
+    if "name" not in fields:
+        raise ValueError("No restaurant details found on page")
+    meta.etag = response.headers.get("ETag", "")
+    meta.last_modified = response.headers.get("Last-Modified", "")
+    meta.checked = now
+    fields_hash = hash_fields(fields)
+    if fields_hash == meta.fields_hash:
+        return "unchanged", rst
+
+    # Keep the stored id so renamed or moved restaurants are updated rather than duplicated
+    fields.pop("id", None)
+    for k, v in fields.items():
+        setattr(rst, k, v)
+    meta.id = rst.id
+    meta.fields_hash = fields_hash
+    meta.changed = now
+    logger.debug(f"Restaurant changed: {rst.name}")
+    return "changed", rst
+
+
+async def refresh(budget: int = REFRESH_BUDGET,
+                  max_age: float = REFRESH_MAX_AGE,
+                  transport = None,
+                  parse_workers: int = PARSE_WORKERS) -> dict[str, int]:
+    """Re-scrapes the restaurants most in need of a refresh, writing only those whose details changed
+
+    Args:
+        budget (int, optional): Maximum number of restaurant pages to request. Defaults to REFRESH_BUDGET.
+        max_age (float, optional): Seconds since the last check before a restaurant is due. Defaults to REFRESH_MAX_AGE.
+        transport (httpx.AsyncBaseTransport | None, optional): Transport for record/replay. Defaults to None.
+        parse_workers (int, optional): Number of parsing processes, 0 to parse on the event loop. Defaults to PARSE_WORKERS.
+
+    Returns:
+        dict[str, int]: Number of restaurants per outcome - "not_modified", "unchanged", "changed" and "failed"
+    """
+    start = time.perf_counter()
+    due = select_due(budget, max_age)
+    logger.info(f"Refreshing {len(due)} restaurants")
+    counts = {"not_modified": 0, "unchanged": 0, "changed": 0, "failed": 0}
+    headers = {"Referer": "https://www.tripadvisor.com/"}
+    throttle = AdaptiveThrottle(MAX_CONN_AT_ONCE, MAX_CONN_PER_SEC)
+    parse_pool = ParsePool(parse_workers)
+
+    async def refresh_one(rst: Restaurant, meta: RestaurantMeta):
+        result = await refresh_rst_page(client, rst, meta, parse_pool)
+        if result is None:
+            counts["failed"] += 1
+            return
+        status, rst = result
+        counts[status] += 1
+        if status == "changed":
+            writer.add([rst])
+
+    try:
+        async with DatabaseWriter() as writer:
+            # Cached copies would defeat the point of asking the server what changed
+            async with ScraperClient(headers, transport = transport, throttle = throttle) as client:
+                await asyncio.gather(*[refresh_one(rst, meta) for rst, meta in due])
+    finally:
+        parse_pool.close()
+        upsert_meta([meta for _, meta in due if meta.checked > 0])
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Refreshed {len(due)} restaurants in {elapsed:.2f}s - {counts}")
+    return counts
+
+
+def main(args: argparse.Namespace):
+    asyncio.run(refresh(args.budget, args.max_age * 24 * 60 * 60, parse_workers = args.parse_workers))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "TripAdvisor Refresh")
+    parser.add_argument(
+        "--budget", "-b",
+        action = "store",
+        help = "maximum number of restaurant pages to request",
+        type = int,
+        default = REFRESH_BUDGET
+    )
+    parser.add_argument(
+        "--max-age",
+        action = "store",
+        help = "days since the last check before a restaurant is refreshed",
+        type = float,
+        default = REFRESH_MAX_AGE / (24 * 60 * 60)
+    )
+    parser.add_argument(
+        "--parse-workers",
+        action = "store",
+        help = "number of processes to parse pages in, 0 to parse on the event loop",
+        type = int,
+        default = PARSE_WORKERS
+    )
+    args = parser.parse_args()
+
+    main(args)
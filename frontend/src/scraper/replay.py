@@ -0,0 +1,234 @@
+import json
+import time
+import random
+import hashlib
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+from loguru import logger
+
+
+REPLAY_HEADER = "X-Replay-Url"
+REPLAY_METHOD_HEADER = "X-Replay-Method"
+DROP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+
+class Corpus:
+    """On-disk store of request/response pairs keyed by method, URL and request body"""
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.mkdir(parents = True, exist_ok = True)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(method: str, url: str, body: bytes = b"") -> str:
+        h = hashlib.sha256()
+        h.update(method.upper().encode("utf-8"))
+        h.update(b" ")
+        h.update(url.encode("utf-8"))
+        h.update(b" ")
+        h.update(body)
+        return h.hexdigest()
+
+    def save(self, method: str, url: str, body: bytes, status: int, headers: dict, content: bytes):
+        """Writes a single exchange to the corpus, overwriting any previous recording
+
+        Args:
+            method (str): HTTP method
+            url (str): Requested URL
+            body (bytes): Request body
+            status (int): Response status code
+            headers (dict): Response headers
+            content (bytes): Decoded response body
+        """
+        key = self.key(method, url, body)
+        meta = {
+            "method": method.upper(),
+            "url": url,
+            "status": status,
+            "headers": {k: v for k, v in headers.items() if k.lower() not in DROP_HEADERS},
+            "recorded": time.time()
+        }
+        with self._lock:
+            (self.path / f"{key}.body").write_bytes(content)
+            with open(self.path / f"{key}.json", "w") as f:
+                json.dump(meta, f, indent = 4)
+
+    def load(self, method: str, url: str, body: bytes = b"") -> tuple[int, dict, bytes] | None:
+        """Looks up a recorded exchange
+
+        Args:
+            method (str): HTTP method
+            url (str): Requested URL
+            body (bytes, optional): Request body. Defaults to b"".
+
+        Returns:
+            tuple[int, dict, bytes] | None: Status, headers and body, or None if not recorded
+        """
+        key = self.key(method, url, body)
+        meta_file = self.path / f"{key}.json"
+        if not meta_file.is_file():
+            return None
+        with open(meta_file) as f:
+            meta = json.load(f)
+        return meta["status"], meta["headers"], (self.path / f"{key}.body").read_bytes()
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.path.glob("*.json"))
+
+
+class RecordTransport(httpx.AsyncBaseTransport):
+    """HTTPX transport that forwards requests to the network and records every exchange"""
+    def __init__(self, corpus: Corpus, inner: httpx.AsyncBaseTransport | None = None):
+        self._corpus = corpus
+        self._inner = inner if inner is not None else httpx.AsyncHTTPTransport(http2 = True)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self._inner.handle_async_request(request)
+        content = await response.aread()
+        self._corpus.save(
+            request.method,
+            str(request.url),
+            request.content,
+            response.status_code,
+            dict(response.headers),
+            content
+        )
+        return response
+
+    async def aclose(self):
+        await self._inner.aclose()
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """HTTPX transport that redirects every request to a ReplayServer, optionally through a proxy"""
+    def __init__(self, server_url: str, proxy: str | None = None):
+        self._server_url = httpx.URL(server_url)
+        self._inner = httpx.AsyncHTTPTransport(proxy = httpx.Proxy(proxy) if proxy else None)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        headers = dict(request.headers)
+        headers.pop("host", None)
+        headers[REPLAY_HEADER] = str(request.url)
+        headers[REPLAY_METHOD_HEADER] = request.method
+        # Always POST so the original body reaches the server regardless of method
+        replay_request = httpx.Request(
+            "POST",
+            self._server_url,
+            headers = headers,
+            content = request.content,
+            extensions = request.extensions
+        )
+        return await self._inner.handle_async_request(replay_request)
+
+    async def aclose(self):
+        await self._inner.aclose()
+
+
+class ReplayServer:
+    """Local HTTP stand-in that serves a recorded Corpus with injected latency and errors"""
+    def __init__(self,
+                 corpus: Corpus,
+                 latency: tuple[float, float] = (0, 0),
+                 error_rate: float = 0,
+                 error_status: int = 503,
+                 host: str = "127.0.0.1",
+                 port: int = 0):
+        self.corpus = corpus
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._replay()
+
+            def do_POST(self):
+                self._replay()
+
+            def _replay(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length > 0 else b""
+                url = self.headers.get(REPLAY_HEADER, "")
+                method = self.headers.get(REPLAY_METHOD_HEADER, self.command)
+
+                lo, hi = server.latency
+                if hi > 0:
+                    time.sleep(random.uniform(lo, hi))
+
+                if server.error_rate > 0 and random.random() < server.error_rate:
+                    server.errors += 1
+                    self._send(server.error_status, {}, b"")
+                    return
+
+                entry = server.corpus.load(method, url, body)
+                if entry is None:
+                    server.misses += 1
+                    logger.warning(f"Replay miss: {method} {url}")
+                    self._send(404, {}, b"")
+                    return
+                server.hits += 1
+                self._send(*entry)
+
+            def _send(self, status: int, headers: dict, content: bytes):
+                self.send_response(status)
+                for k, v in headers.items():
+                    if k.lower() not in DROP_HEADERS:
+                        self.send_header(k, v)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format: str, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "ReplayServer":
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+        logger.info(f"Replaying {len(self.corpus)} recorded responses from {self.url}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        logger.info(f"Replay server stopped - {self.hits} hits, {self.misses} misses, {self.errors} injected errors")
+
+    def __enter__(self) -> "ReplayServer":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class ReplayDriver:
+    """Drop-in replacement for SeleniumDriver that reads search pages from a ReplayServer"""
+    def __init__(self, server_url: str):
+        self._client = httpx.Client(base_url = server_url)
+
+    def get(self, url: str, wait: list[str] = []) -> str:
+        response = self._client.post("/", headers = {REPLAY_HEADER: url, REPLAY_METHOD_HEADER: "GET"})
+        response.raise_for_status()
+        return response.text
+
+    def close(self):
+        self._client.close()
@@ -0,0 +1,191 @@
+import time
+import random
+import asyncio
+
+import httpx
+from loguru import logger
+
+
+MAX_RETRIES = 5 # Attempts per call, including the first
+RETRY_BASE_WAIT = 1 # Seconds before the first retry, doubled for every retry after it
+RETRY_MAX_WAIT = 30
+RETRY_BUDGET_RATIO = 0.2 # Retries allowed per first attempt across the whole crawl
+RETRY_BUDGET_RESERVE = 20 # Retries always allowed, so a quiet start can still recover from errors
+RETRY_STATUSES = {403, 408, 425, 429, 500, 502, 503, 504}
+BREAKER_THRESHOLD = 5 # Consecutive failures before a host's circuit opens
+BREAKER_RESET_TIME = 30 # Seconds a circuit stays open before a trial request is let through
+BREAKER_MAX_RESET_TIME = 10 * 60
+MAX_CIRCUIT_WAIT = 30 * 60 # Seconds one call waits on open circuits before giving up
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to a host whose circuit is open"""
+    def __init__(self, host: str, retry_in: float):
+        super().__init__(f"Circuit open for {host} - retrying in {retry_in:.0f}s")
+        self.host = host
+        self.retry_in = retry_in
+
+
+def is_retryable(e: BaseException) -> bool:
+    """Classifies an exception as transient - network failures, throttling or server error statuses and open circuits
+
+    Args:
+        e (BaseException): Exception raised by an attempt
+
+    Returns:
+        bool: Whether another attempt may succeed
+    """
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRY_STATUSES
+    return isinstance(e, (httpx.TransportError, asyncio.TimeoutError, ConnectionError, CircuitOpenError))
+
+
+class RetryBudget:
+    """Token bucket shared by all retries - every first attempt earns a fraction of a retry"""
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, reserve: float = RETRY_BUDGET_RESERVE):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+        self.attempts = 0
+        self.retries = 0
+        self.denied = 0
+        self.exhausted = 0
+
+    def deposit(self):
+        self.attempts += 1
+        self.tokens = min(self.tokens + self.ratio, self.reserve)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            self.denied += 1
+            return False
+        self.tokens -= 1
+        self.retries += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "denied": self.denied,
+            "exhausted": self.exhausted,
+            "tokens": round(self.tokens, 1)
+        }
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, drawing retries from a RetryBudget
+
+    Calls turned away by an open circuit never reached the host, so they wait for the circuit instead of
+    using up an attempt or the budget.
+    """
+    def __init__(self,
+                 max_attempts: int = MAX_RETRIES,
+                 base_wait: float = RETRY_BASE_WAIT,
+                 max_wait: float = RETRY_MAX_WAIT,
+                 max_circuit_wait: float = MAX_CIRCUIT_WAIT,
+                 budget: RetryBudget | None = None):
+        self.max_attempts = max_attempts
+        self.base_wait = base_wait
+        self.max_wait = max_wait
+        self.max_circuit_wait = max_circuit_wait
+        self.budget = budget if budget is not None else RetryBudget()
+
+    def delay(self, attempt: int) -> float:
+        # Full jitter spreads out retries from requests that failed together
+        return random.uniform(0, min(self.max_wait, self.base_wait * 2**attempt))
+
+    def circuit_delay(self, e: CircuitOpenError) -> float:
+        # Jittered so the calls waiting on a circuit don't all arrive as it half-opens
+        return e.retry_in + self.delay(0)
+
+    def should_retry(self, e: BaseException, attempt: int) -> bool:
+        """Decides whether to make another attempt after a failure
+
+        Args:
+            e (BaseException): Exception raised by the attempt
+            attempt (int): 0-based number of the failed attempt
+
+        Returns:
+            bool: Whether to retry
+        """
+        if attempt + 1 >= self.max_attempts or not is_retryable(e):
+            return False
+        return self.budget.withdraw()
+
+
+class CircuitBreaker:
+    """Stops requests to a failing host, letting a single trial request through once the reset time has passed"""
+    def __init__(self,
+                 host: str,
+                 threshold: int = BREAKER_THRESHOLD,
+                 reset_time: float = BREAKER_RESET_TIME,
+                 max_reset_time: float = BREAKER_MAX_RESET_TIME):
+        self.host = host
+        self.threshold = threshold
+        self.base_reset_time = reset_time
+        self.reset_time = reset_time
+        self.max_reset_time = max_reset_time
+        self.failures = 0
+        self.opened = 0
+        self._open_until = 0.0
+        self._trial = False
+        self._trial_at = 0.0
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.threshold:
+            return "closed"
+        return "open" if time.monotonic() < self._open_until else "half-open"
+
+    def check(self):
+        """Raises CircuitOpenError unless a request to the host may be sent"""
+        state = self.state
+        if state == "closed":
+            return
+        # A trial that never reported back doesn't keep the circuit open forever
+        if state == "half-open" and (not self._trial or time.monotonic() - self._trial_at > self.reset_time):
+            self._trial = True
+            self._trial_at = time.monotonic()
+            return
+        raise CircuitOpenError(self.host, max(0.0, self._open_until - time.monotonic()))
+
+    def success(self):
+        if self.failures >= self.threshold:
+            logger.info(f"[{self.host}] Circuit closed")
+        self.failures = 0
+        self.reset_time = self.base_reset_time
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self._trial:
+            # Failed trial - stay open for longer
+            self._trial = False
+            self.reset_time = min(self.max_reset_time, self.reset_time * 2)
+        elif self.failures != self.threshold:
+            return
+        self.opened += 1
+        self._open_until = time.monotonic() + self.reset_time
+        logger.warning(f"[{self.host}] Circuit opened for {self.reset_time:.0f}s after {self.failures} consecutive failures")
+
+
+class CircuitBreakers:
+    """Per-host collection of CircuitBreakers sharing the same settings"""
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._hosts: dict[str, CircuitBreaker] = {}
+
+    def host(self, host: str) -> CircuitBreaker:
+        if host not in self._hosts:
+            self._hosts[host] = CircuitBreaker(host, **self._kwargs)
+        return self._hosts[host]
+
+    def states(self) -> dict[str, dict]:
+        return {
+            host: {"state": b.state, "failures": b.failures, "opened": b.opened}
+            for host, b in self._hosts.items()
+        }
+
+
+RETRY_POLICY = RetryPolicy() # Default policy of wrap_except, sharing one budget across the crawl
@@ -1,19 +1,21 @@
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+# Selenium and chromedriver_autoinstaller are imported when a driver is created, so runs that never open
+# a browser don't pay for loading them
 from loguru import logger
-import chromedriver_autoinstaller
 
 
 TIMEOUT = 5
 MAX_RETRIES = 5
+_driver_installed = False # Only check for a chromedriver install once per process
 
 
 class SeleniumDriver:
-    def __init__(self):    
-        chromedriver_autoinstaller.install()
+    def __init__(self, corpus = None):
+        global _driver_installed
+        from selenium import webdriver
+        if not _driver_installed:
+            import chromedriver_autoinstaller
+            chromedriver_autoinstaller.install()
+            _driver_installed = True
         chrome_options = webdriver.ChromeOptions()
 
         options = [
@@ -27,8 +29,13 @@ class SeleniumDriver:
             chrome_options.add_argument(option)
 
         self._driver = webdriver.Chrome(options = chrome_options)
+        self._corpus = corpus # Optional replay.Corpus to record rendered pages into
     
     def get(self, url: str, wait: list[str] = []) -> str:
+        from selenium.webdriver.common.by import By
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.support.wait import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
         self._driver.get(url)
         wait_driver = WebDriverWait(self._driver, TIMEOUT)
         for i in range(MAX_RETRIES + 1):
@@ -39,7 +46,10 @@ class SeleniumDriver:
             except TimeoutException:
                 logger.error(f"Selenium driver timed out for {url}... retrying ({i + 1}/{MAX_RETRIES})")
                 self._driver.refresh()
-        return self._driver.page_source
+        page_source = self._driver.page_source
+        if self._corpus is not None:
+            self._corpus.save("GET", url, b"", 200, {"Content-Type": "text/html; charset=utf-8"}, page_source.encode("utf-8"))
+        return page_source
     
     def close(self):
         self._driver.quit()
\ No newline at end of file
@@ -1,42 +1,80 @@
 # Certain scraping optimizations were implemented from: https://scrapfly.io/blog/how-to-scrape-tripadvisor/
 
 import re
-import json
 import asyncio
 import random
 import string
 import math
 import functools
 import argparse
+import time
 from pathlib import Path
 from pprint import pprint
+from typing import Callable, TYPE_CHECKING
 
-import aiometer
 from loguru import logger
-from lxml import etree
+if TYPE_CHECKING:
+    # lxml is only imported when a search page is parsed
+    from lxml import etree
 
 from scraper_utils import (
     ScraperClient,
     wrap_except,
     ta_url,
     load_locations,
-    find_nested_key,
-    hash_str_array,
     save_all,
     is_file
 )
 from scraper_se import SeleniumDriver
-from database import Location, Restaurant
+from parsers import (
+    ParsePool,
+    PARSE_WORKERS,
+    parse_search_items,
+    parse_search_fields,
+    parse_rst_fields
+)
+from database import Location, Restaurant, get_locations, save_location, checkpoint
+from throttle import AdaptiveThrottle
+from retry import RETRY_POLICY, CircuitBreakers
+from telemetry import TELEMETRY, SNAPSHOT_INTERVAL
+from pipeline import Pipeline, Stage
+from writer import DatabaseWriter, WRITE_INTERVAL
+from frontier import (
+    add_urls,
+    lease_url,
+    release_leases,
+    set_status,
+    complete_urls,
+    fail_urls,
+    get_status,
+    complete_search,
+    get_listings,
+    load_restaurant,
+    HOST_ID
+)
+from cache import ResponseCache, CACHE_MODES
+from dedup import SeenSet
+from identities import IdentityPool
+from proxies import ProxyPool, ProxyTransport, load_candidates, SESSION_EXTENSION
+from replay import Corpus, RecordTransport, ReplayTransport, ReplayServer, ReplayDriver
+from workqueue import WorkQueue, QueueWorker, WORKER_ID
 
 
 MAX_PAGES = 5 # Set to -1 for all pages
-MAX_CONN_AT_ONCE = 5
+MAX_CONN_AT_ONCE = 5 # Starting limits per host - adjusted at runtime by AdaptiveThrottle
 MAX_CONN_PER_SEC = 1
+MAX_LOCS_AT_ONCE = 3
 SAVE_PATH = Path(__file__).resolve().parent / "data"
 CSV_PATH = Path(__file__).resolve().parent / "csv"
+CACHE_PATH = Path(__file__).resolve().parent / "cache"
+LOCATION_TTL = 90 * 24 * 60 * 60 # Seconds before a resolved location is looked up again
+SEARCH_MODE = "http" # Set to "selenium" to always render search pages in a browser
+STAGE_CONCURRENCY = {"search": 2, "fetch": 10, "parse": 1, "persist": 1} # Workers per pipeline stage in scrape_food
+SEARCH_WAIT_LIST = ["//span[contains(text(), 'results')]", "//div[contains(@style, 'background-image')]"]
 
 
 @wrap_except("Failed to scrape location summary")
+@TELEMETRY.timed("request_loc")
 async def request_loc(client: ScraperClient, query: str) -> Location:
     """Clone a graphql request to obtain location details
 
@@ -129,38 +167,31 @@ async def request_loc(client: ScraperClient, query: str) -> Location:
 
 
 @wrap_except("Could not request page")
-async def request_page(client: ScraperClient, url: str) -> str:
+@TELEMETRY.timed("request_page")
+async def request_page(client: ScraperClient, url: str, session: str | None = None) -> str:
     """Request a page's HTML content
 
     Args:
         client (ScraperClient): HTTPX client
         url (str): URL to request
+        session (str | None, optional): Sticky session keeping related requests on one proxy. Defaults to None.
 
     Returns:
         str: HTML as a string
     """
-    response = await client.get(url)
+    if client.cache is not None:
+        html = client.cache.get(url)
+        if html is not None:
+            return html
+    response = await client.get(url, extensions = {} if session is None else {SESSION_EXTENSION: session})
     response.raise_for_status()
+    if client.cache is not None:
+        client.cache.put(url, response.text)
     return response.text
 
 
-@wrap_except("Could not request page")
-async def request_page_tree(client: ScraperClient, url:str) -> etree._Element:
-    """Request a page's HTML content as an XML tree
-
-    Args:
-        client (ScraperClient): HTTPX client
-        url (str): URL to request
-
-    Returns:
-        etree._Element: Root element of tree
-    """
-    html = await request_page(client, url)
-    return etree.HTML(html, None)
-
-
 @wrap_except("Could not parse search page")
-def parse_search_page(tree: etree._Element) -> list[Restaurant]:
+def parse_search_page(tree: "etree._Element") -> list[Restaurant]:
     """Parses search results page for individual items
 
     Args:
@@ -169,186 +200,397 @@ def parse_search_page(tree: etree._Element) -> list[Restaurant]:
     Returns:
         list[Restaurant]: List of Restaurant dataclasses
     """
-    items = []
-    
-    for elem in tree.xpath("//div[@data-test]"):
-        # Gather required info using xpath
-        if elem.xpath("@data-test")[0] == "SL_list_item":
-            continue
-        url = elem.xpath(".//a[contains(@href, 'Restaurant_Review') and string-length(text()) > 0]/@href")[0]
-        item = Restaurant(
-            url = ta_url(url)
-        )
-        
-        imgs = elem.xpath(".//div[contains(@style, 'background-image')]/@style")
-        r = re.compile(r"url\(\"(.*?)\"\)")
-        imgs = [re.findall(r, img)[0] for img in imgs]
-        imgs = list(set(imgs))
-        item.imgs = json.dumps(imgs)
-        
-        items.append(item)
-        
-    return items
-
-
-@wrap_except("Could not scrape search page")
-async def scrape_search_page(client: ScraperClient, rst_list: list[Restaurant]) -> list[Restaurant]:
-    # Use aiometer to throttle connections to bypass bot checks
-    rst_list = await asyncio.gather(*[scrape_rst_page(client, rst) for rst in rst_list]) # Too fast
-    # jobs = [functools.partial(scrape_rst_page, client, rst) for rst in rst_list]
-    # rst_list = await aiometer.run_all(jobs, max_at_once = MAX_CONN_AT_ONCE, max_per_second = MAX_CONN_PER_SEC)
-    
-    return rst_list
+    return [Restaurant(**item) for item in parse_search_items(tree)]
 
 
-@wrap_except("Could not scrape restaurant page")
-async def scrape_rst_page(client: ScraperClient, rst: Restaurant) -> Restaurant:
-    """Scrapes content of restaurant page
+def to_search_result(fields: dict | None) -> tuple[int, list[Restaurant]] | None:
+    if fields is None:
+        return None
+    return fields["count"], [Restaurant(**item) for item in fields["items"]]
 
-    Args:
-        client (ScraperClient): HTTPX client
-        rst (Restaurant): Restaurant dataclass containing URL to parse
 
-    Returns:
-        Restaurant: Modified Restaurant dataclass
-    """
-    html = await request_page(client, rst.url)
-    data = get_page_data(html)["urqlCache"]["results"]
-    data_rst = find_nested_key(data, "RestaurantPresentation_searchRestaurantsByGeo")
-    data_rst = data_rst["RestaurantPresentation_searchRestaurantsByGeo"]["restaurants"][0]
-
-    try:
-        rst.name = data_rst["name"]
-        rst.address = data_rst["localizedRealtimeAddress"]
-        rst.phone = data_rst["telephone"]
-        rst.id = hash_str_array([rst.address, rst.name]) # type: ignore
-        rst.rating = data_rst["reviewSummary"]["rating"]
-        rst.review_count = data_rst["reviewSummary"]["count"]
-        # rst.imgs
-        rst.tags = json.dumps([tag["tag"]["localizedName"] for tag in data_rst["topTags"]])
-        temp_price = data_rst["topTags"][0]["secondary_name"]
-        rst.price = temp_price if temp_price is not None else ""
-    except Exception:
-        pass
-
-    
-    # # Implementation for scraping reviews if ever desired
-    #
-    # tree = etree.HTML(html, None)
-    # data_rev = tree.xpath(".//div[contains(@class, 'review-container')]")
-    # num_rev_page = len(data_rev)
-    # num_rev_total = rst.review_count
-    # num_page_total = math.ceil(num_rev_total / num_rev_page)
-    # rev_urls = [rst.url.replace("-Reviews-", f"-Reviews-or{num_rev_page * i}-") for i in range(1, num_page_total)]
-    # rev_list = []
-    # responses = await asyncio.gather(*[request_page_tree(rev_url, client) for rev_url in rev_urls])
-    # for response in [tree, *responses]:
-    #     rev_list.extend(scrape_rev(response))
-    
-    logger.debug(f"Successfully scraped restaurant: {rst.name}")
-    return rst
-
-
-def get_page_data(html: str) -> dict:
-    """Extract JS pageManifest object's state data from graphql hidden in HTML page
+def search_page_url(url: str, offset: int) -> str:
+    """Builds the URL of a search page starting at a given result offset
 
     Args:
-        html (str): Page HTML
+        url (str): URL of the first search page
+        offset (int): Index of the first result on the page
 
     Returns:
-        dict: Dictionary representing JS state
+        str: Search page URL with an "oa{offset}" segment
     """
-    data = re.findall(r"{pageManifest:({.+?})};", html, re.DOTALL)[0]
-    return json.loads(data)
-
-
-async def scrape(locs: list[str], num_pages_max: int = MAX_PAGES):
+    if offset == 0:
+        return url
+    return re.sub(r"(Restaurants-g\d+-)(?:oa\d+-)?", rf"\g<1>oa{offset}-", url, count = 1)
+
+
+async def scrape(locs: list[str],
+                 num_pages_max: int = MAX_PAGES,
+                 transport = None,
+                 driver: Callable = SeleniumDriver,
+                 cache: ResponseCache | None = None,
+                 search_mode: str = SEARCH_MODE,
+                 num_workers: int = MAX_LOCS_AT_ONCE,
+                 parse_workers: int = PARSE_WORKERS,
+                 commit_interval: float = WRITE_INTERVAL,
+                 location_ttl: float = LOCATION_TTL,
+                 proxy_pool: ProxyPool | None = None,
+                 metrics: str | Path | None = None,
+                 metrics_interval: float = SNAPSHOT_INTERVAL,
+                 work_queue: WorkQueue | None = None,
+                 worker_id: str | None = None) -> dict[str, int | None]:
     """Scrapes a location summary - entry point for specific type scraping
 
     Args:
         locs (list[str], optional): _description_. Defaults to [].
         num_pages_max (int | None, optional): _description_. Defaults to None.
+        transport (httpx.AsyncBaseTransport | None, optional): Transport for record/replay. Defaults to None.
+        driver (Callable, optional): Factory for the search page browser. Defaults to SeleniumDriver.
+        cache (ResponseCache | None, optional): On-disk cache for restaurant pages. Defaults to None.
+        search_mode (str, optional): "http" or "selenium" search page fetching. Defaults to SEARCH_MODE.
+        num_workers (int, optional): Number of locations scraped at once. Defaults to MAX_LOCS_AT_ONCE.
+        parse_workers (int, optional): Number of parsing processes, 0 to parse on the event loop. Defaults to PARSE_WORKERS.
+        commit_interval (float, optional): Maximum seconds between database commits. Defaults to WRITE_INTERVAL.
+        location_ttl (float, optional): Seconds before a resolved location is looked up again. Defaults to LOCATION_TTL.
+        proxy_pool (ProxyPool | None, optional): Proxies to spread requests across, checked before scraping and used instead of transport - so not with an IdentityPool. Defaults to None.
+        metrics (str | Path | None, optional): File to keep writing telemetry to - ".prom" for a Prometheus textfile, otherwise JSON. Defaults to None.
+        metrics_interval (float, optional): Seconds between metrics file writes. Defaults to SNAPSHOT_INTERVAL.
+        work_queue (WorkQueue | None, optional): Shared queue to lease locations from until it is finished, instead of locs. Defaults to None.
+        worker_id (str | None, optional): Name locations and restaurants are leased under. Defaults to WORKER_ID with a work queue, otherwise HOST_ID so a restarted crawl takes back its own restaurant leases on startup.
+
+    Returns:
+        dict[str, int | None]: Number of restaurant pages scraped per location, None if it failed
     """
     headers = {"Referer": "https://www.tripadvisor.com/"}
-    async with ScraperClient(headers) as client:
-        responses = [asyncio.ensure_future(request_loc(client, loc)) for loc in locs]
-        locs_data = await asyncio.gather(*responses)
-        
-        for loc_data in locs_data:
+    start = time.perf_counter()
+    results: dict[str, int | None] = {}
+    num_done = 0
+    queue: asyncio.Queue[str] = asyncio.Queue()
+    for loc in locs:
+        queue.put_nowait(loc)
+    
+    async def next_loc() -> str | None:
+        if source is not None:
+            return await source.next()
+        return None if queue.empty() else queue.get_nowait()
+
+    async def worker(client: ScraperClient):
+        # Each location is resolved and scraped in isolation so one failure doesn't stop the others
+        while (loc := await next_loc()) is not None:
+            results[loc] = None
+            error = ""
             try:
-                await scrape_food(client, loc_data, num_pages_max)
+                loc_data = known.get(loc) if source is None else (await asyncio.to_thread(get_locations, [loc], location_ttl)).get(loc)
+                if loc_data is None:
+                    loc_data = await request_loc(client, loc)
+                    if loc_data is None:
+                        raise RuntimeError("Could not resolve location")
+                    await asyncio.to_thread(save_location, loc, loc_data)
+                results[loc] = await scrape_food(client, loc_data, num_pages_max, driver, search_mode, parse_pool = parse_pool, writer = writer, seen = seen, worker_id = worker_id)
             except Exception as e:
-                logger.error(f"[{loc_data.name}] Could not process location - {e}")
+                error = str(e)
+                logger.error(f"[{loc}] Could not process location - {e}")
+            nonlocal num_done
+            num_done += 1
+            if source is not None:
+                await source.done(loc, results[loc], error)
+                logger.info(f"[{loc}] Processed location {num_done} from the queue")
+            else:
+                logger.info(f"[{loc}] Processed location {num_done}/{len(locs)}")
+    
+    # Locations never move, so only names not resolved recently are looked up over the network
+    known = get_locations(locs, location_ttl)
+    logger.info(f"{len(known)}/{len(locs)} locations already resolved")
+    seen = SeenSet()
+    throttle = AdaptiveThrottle(MAX_CONN_AT_ONCE, MAX_CONN_PER_SEC)
+    breakers = CircuitBreakers()
+    if proxy_pool is not None:
+        if isinstance(transport, IdentityPool):
+            # The proxies would replace the identities' transport, leaving the pool unused and never closed
+            raise ValueError("A proxy pool can't be combined with an IdentityPool transport")
+        if len(await proxy_pool.check()) == 0:
+            raise RuntimeError("No proxies passed the health check")
+        transport = ProxyTransport(proxy_pool)
+    worker_id = worker_id or (HOST_ID if work_queue is None else WORKER_ID)
+    # Leases still held under this name were left by a previous run - live ones are never claimed twice while crawling
+    num_released = await asyncio.to_thread(release_leases, [worker_id])
+    if num_released > 0:
+        logger.info(f"Released {num_released} restaurants leased by a previous run of {worker_id}")
+    source = None if work_queue is None else QueueWorker(work_queue, worker_id)
+    num_workers = num_workers if source is not None else min(num_workers, len(locs))
+    parse_pool = ParsePool(parse_workers)
+    TELEMETRY.reset()
+    reporter = None if metrics is None else asyncio.ensure_future(TELEMETRY.report(metrics, metrics_interval))
+    try:
+        async with DatabaseWriter(interval = commit_interval) as writer:
+            async with ScraperClient(headers, transport = transport, throttle = throttle, cache = cache, breakers = breakers) as client:
+                workers = [asyncio.ensure_future(worker(client)) for _ in range(max(1, num_workers))]
+                if source is None:
+                    await asyncio.gather(*workers)
+                else:
+                    async with source:
+                        await asyncio.gather(*workers)
+    finally:
+        parse_pool.close()
+        if cache is not None:
+            cache.close()
+        if reporter is not None:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions = True)
+        checkpoint()
+    
+    num_scraped = sum(n for n in results.values() if n is not None)
+    num_failed = len([n for n in results.values() if n is None])
+    elapsed = time.perf_counter() - start
+    logger.info(f"Scraped {num_scraped} restaurant pages in {elapsed:.2f}s ({num_scraped / elapsed:.2f} pages/s)")
+    if num_failed > 0:
+        logger.warning(f"{num_failed}/{len(results)} locations failed: {[loc for loc, n in results.items() if n is None]}")
+    logger.info(f"Restaurant deduplication: {seen.stats()}")
+    logger.info(f"Retries: {RETRY_POLICY.budget.stats()}")
+    for host, state in breakers.states().items():
+        logger.info(f"[{host}] Circuit: {state}")
+    if proxy_pool is not None:
+        logger.info(f"Proxies: {proxy_pool.stats()}")
+    for host, limits in throttle.limits().items():
+        logger.info(f"[{host}] Final limits: {limits}")
+    logger.info(TELEMETRY.summary())
+    return results
             
                 
-async def scrape_food(client: ScraperClient, loc_data: Location, num_pages_max: int = MAX_PAGES):
+async def scrape_food(client: ScraperClient,
+                      loc_data: Location,
+                      num_pages_max: int = MAX_PAGES,
+                      driver: Callable = SeleniumDriver,
+                      search_mode: str = SEARCH_MODE,
+                      concurrency: dict[str, int] = STAGE_CONCURRENCY,
+                      parse_pool: ParsePool | None = None,
+                      writer: DatabaseWriter | None = None,
+                      seen: SeenSet | None = None,
+                      worker_id: str = HOST_ID) -> int:
     """Scrapes all restaurants for a specified location generated from scrape()
 
+    The crawl runs as a pipeline of search page fetching, restaurant page fetching, parsing and persisting,
+    so later search pages download while earlier restaurants are still in flight.
+    Progress is tracked per URL in the crawl frontier, so a resumed crawl only fetches unfinished pages.
+
     Args:
         client (ScraperClient): HTTPX client
         loc_data (Location): Location dataclass
         num_pages_max (int | None, optional): Maximum number of pages to scrape. Defaults to None.
+        driver (Callable, optional): Factory for the search page browser. Defaults to SeleniumDriver.
+        search_mode (str, optional): "http" to fetch search pages with HTTPX, "selenium" to render them. Defaults to SEARCH_MODE.
+        concurrency (dict[str, int], optional): Number of workers per stage. Defaults to STAGE_CONCURRENCY.
+        parse_pool (ParsePool | None, optional): Executor for parsing off the event loop. Defaults to parsing inline.
+        writer (DatabaseWriter | None, optional): Batched database writer. Defaults to writing each page directly.
+        seen (SeenSet | None, optional): Restaurants claimed by other searches, which are skipped. Defaults to no deduplication.
+        worker_id (str, optional): Name restaurants are leased under. Defaults to HOST_ID.
+
+    Returns:
+        int: Number of restaurant pages scraped
     """
     url = getattr(loc_data, f"food_url")
+    num_scraped = 0
+    num_pages_saved = 0
+    chrome = None
+    chrome_lock = asyncio.Lock() # One Selenium driver serves one page at a time
+    pages: dict[int, dict] = {} # Page number -> expected number of restaurants, those finished so far and those held elsewhere
+    leased: set[str] = set()
+    if parse_pool is None:
+        parse_pool = ParsePool(0)
+    
+    def get_chrome():
+        nonlocal chrome
+        if chrome is None:
+            chrome = driver()
+        return chrome
+    
+    async def get_search_page(page_url: str) -> tuple[int, list[Restaurant]] | None:
+        if search_mode == "http" and chrome is None:
+            # A location's search pages paginate one result list, so they keep to one proxy
+            html = await request_page(client, page_url, session = loc_data.name)
+            if html is not None:
+                search = to_search_result(await parse_pool.run(parse_search_fields, html))
+                if search is not None:
+                    return search
+            logger.warning(f"[{loc_data.name}] Falling back to Selenium for search pages")
+        async with chrome_lock:
+            with TELEMETRY.timer("stage_seconds", stage = "chrome"):
+                # Selenium blocks, so it runs off the event loop while restaurant fetches continue
+                html = await asyncio.to_thread(lambda: get_chrome().get(page_url, SEARCH_WAIT_LIST))
+        return to_search_result(await parse_pool.run(parse_search_fields, html))
+    
+    async def add_page(page_num: int, page_url: str, rst_list: list[Restaurant]) -> list[tuple[int, Restaurant]]:
+        await asyncio.to_thread(complete_search, page_url, [{"url": rst.url, "imgs": rst.imgs} for rst in rst_list])
+        if seen is not None:
+            # Drop restaurants already crawled under another URL before any request is made for them
+            num_listed = len(rst_list)
+            claimed = await asyncio.to_thread(seen.claim, [rst.url for rst in rst_list])
+            rst_list = [rst for rst, keep in zip(rst_list, claimed) if keep]
+            if len(rst_list) < num_listed:
+                logger.debug(f"[{loc_data.name}] Skipping {num_listed - len(rst_list)} duplicate restaurants on page {page_num}")
+        if len(rst_list) == 0:
+            save_all(SAVE_PATH / f"{loc_data.name} - {page_num}", [], writer)
+            return []
+        pages[page_num] = {"expected": len(rst_list), "done": [], "elsewhere": 0}
+        await asyncio.to_thread(add_urls, [rst.url for rst in rst_list], "restaurant", loc_data.name, page_num)
+        return [(page_num, rst) for rst in rst_list]
+    
+    async def search_stage(item: tuple[int, str]) -> list[tuple[int, Restaurant]]:
+        page_num, page_url = item
+        # Listings of search pages finished in an earlier run are kept in the frontier
+        listings = await asyncio.to_thread(get_listings, page_url)
+        if listings is not None:
+            return await add_page(page_num, page_url, [Restaurant(**listing) for listing in listings])
+        search = await get_search_page(page_url)
+        if search is None:
+            logger.error(f"[{loc_data.name}] Could not parse search page {page_url}")
+            await asyncio.to_thread(fail_urls, [page_url])
+            return []
+        return await add_page(page_num, page_url, search[1])
     
-    chrome = SeleniumDriver()
-    wait_list = ["//span[contains(text(), 'results')]", "//div[contains(@style, 'background-image')]"]
-    tree = etree.HTML(chrome.get(url, wait_list), None)
+    async def fetch_stage(item: tuple[int, Restaurant]) -> tuple[int, Restaurant, str | None] | None:
+        page_num, rst = item
+        # Frontier calls wait on the database's write lock, so they run off the event loop
+        if await asyncio.to_thread(get_status, rst.url) == "done":
+            saved = await asyncio.to_thread(load_restaurant, rst.url)
+            if saved is not None:
+                await pipeline["persist"].put((page_num, saved, True))
+                return None
+            await asyncio.to_thread(set_status, [rst.url], "pending")
+        if not await asyncio.to_thread(lease_url, rst.url, worker_id):
+            logger.warning(f"[{loc_data.name}] Skipping {rst.url} already leased by another location or worker")
+            return page_num, rst, None
+        leased.add(rst.url)
+        return page_num, rst, await request_page(client, rst.url)
+    
+    async def parse_stage(item: tuple[int, Restaurant, str | None]) -> tuple[int, Restaurant, bool]:
+        page_num, rst, html = item
+        if html is None:
+            return page_num, rst, False
+        try:
+            for k, v in (await parse_pool.run(parse_rst_fields, html)).items():
+                setattr(rst, k, v)
+        except Exception as e:
+            logger.error(f"Could not parse restaurant page {rst.url} - {e}")
+            return page_num, rst, False
+        logger.debug(f"Successfully scraped restaurant: {rst.name}")
+        return page_num, rst, True
+    
+    async def persist_stage(item: tuple[int, Restaurant, bool]):
+        nonlocal num_scraped, num_pages_saved
+        page_num, rst, ok = item
+        if ok:
+            await asyncio.to_thread(complete_urls, [rst.url])
+            TELEMETRY.inc("pages_scraped_total")
+        elif rst.url in leased:
+            await asyncio.to_thread(fail_urls, [rst.url])
+        page = pages[page_num]
+        page["done"].append(rst if ok else None)
+        if not ok and rst.url not in leased:
+            page["elsewhere"] += 1
+        if len(page["done"]) < page["expected"]:
+            return
+        if page["elsewhere"] > 0:
+            # A saved page is never crawled again, so it waits until no other location or worker holds its restaurants
+            logger.warning(f"[{loc_data.name}] Not saving page {page_num} - {page['elsewhere']} restaurants are leased elsewhere")
+            return
+        rst_list = [r for r in page["done"] if r is not None]
+        if len(rst_list) < page["expected"]:
+            logger.warning(f"[{loc_data.name}] {page['expected'] - len(rst_list)} restaurants failed on page {page_num}")
+        save_all(SAVE_PATH / f"{loc_data.name} - {page_num}", rst_list, writer)
+        num_scraped += len(rst_list)
+        del pages[page_num]
+        logger.info(f"[{loc_data.name}] Successfully scraped page {page_num}/{num_pages_max}")
+        logger.debug(f"[{loc_data.name}] Pipeline: {pipeline.stats()}")
+        num_pages_saved += 1
+        if num_pages_saved % 3 == 0:
+            client.reset()
     
     # Get total number of results to calculate number of pages
-    rst_list_init = parse_search_page(tree)
+    await asyncio.to_thread(add_urls, [loc_data.url], "location", loc_data.name)
+    search = await get_search_page(url)
+    if search is None:
+        raise RuntimeError("Could not parse first search page")
+    num_results_total, rst_list_init = search
     num_results_page = len(rst_list_init)
-    num_results_total = int(tree.xpath("//span[contains(text(), 'results')]/span/text()")[0])
     num_pages_total = math.ceil(num_results_total / num_results_page)
     if num_pages_max < 0 or num_pages_max > num_pages_total:
         num_pages_max = num_pages_total
     logger.info(f"[{loc_data.name}] Scraping {num_pages_max}/{num_pages_total} pages")
-    page_count = 0
-    
-    # Process first page
-    fn = SAVE_PATH / f"{loc_data.name} - {page_count + 1}"
-    if not is_file(fn.with_suffix(".json")):
-        rst_list = await scrape_search_page(client, rst_list_init)
-        save_all(fn, rst_list)
-        logger.info(f"[{loc_data.name}] First page scraped")
-    page_count += 1
-
-    next_url = ta_url(tree.xpath("//a[@data-page-number and contains(text(), 'Next')]/@href")[0])
-    next_urls = []
+
+    next_pages = []
     for i in range(1, num_pages_max):
-        fn = SAVE_PATH / f"{loc_data.name} - {i + 1}"
-        if is_file(fn.with_suffix(".json")):
-            page_count += 1
-        else:
-            next_urls.append(next_url.replace(f"oa{num_results_page}", f"oa{num_results_page * i}"))
-    logger.info(f"[{loc_data.name}] Starting process at page {page_count + 1}/{num_pages_max}")
+        await asyncio.to_thread(add_urls, [search_page_url(url, num_results_page * i)], "search", loc_data.name, i + 1)
+        if not is_file((SAVE_PATH / f"{loc_data.name} - {i + 1}").with_suffix(".json")):
+            next_pages.append((i + 1, search_page_url(url, num_results_page * i)))
+    first_page = not is_file((SAVE_PATH / f"{loc_data.name} - 1").with_suffix(".json"))
+    logger.info(f"[{loc_data.name}] {num_pages_max - len(next_pages) - first_page}/{num_pages_max} pages already scraped")
     
-    # next_pages = [asyncio.ensure_future(request_page_tree(client, n)) for n in next_urls] # Asynchronously iterate through pages
-    # for next_page_data in asyncio.as_completed(next_pages):
-    # for next_page_data in [await request_page_tree(client, n) for n in next_urls]: # Synchronously iterate through pages
-    for next_url in next_urls: # Synchronously lazily iterate using Selenium
-        fn = SAVE_PATH / f"{loc_data.name} - {page_count + 1}"
-        rst_list_temp = parse_search_page(etree.HTML(chrome.get(next_url, wait_list), None))
-        rst_list = await scrape_search_page(client, rst_list_temp)
-        save_all(fn, rst_list)
-        page_count += 1
-        if page_count % 3 == 0:
-            client.reset()
-        
-        logger.info(f"[{loc_data.name}] Successfully scraped {page_count}/{num_pages_max} pages")
-
-    logger.info(f"[{loc_data.name}] Location processed")
+    # Only one browser is available to render search pages
+    pipeline = Pipeline([
+        Stage("search", search_stage, concurrency["search"] if chrome is None else 1, fan_out = True),
+        Stage("fetch", fetch_stage, concurrency["fetch"]),
+        Stage("parse", parse_stage, max(concurrency["parse"], parse_pool.workers)),
+        Stage("persist", persist_stage, concurrency["persist"])
+    ])
+    try:
+        async with pipeline:
+            if first_page:
+                await asyncio.to_thread(add_urls, [url], "search", loc_data.name, 1)
+                for item in await add_page(1, url, rst_list_init):
+                    await pipeline["fetch"].put(item)
+            for item in next_pages:
+                await pipeline["search"].put(item)
+            await pipeline.join()
+    finally:
+        if chrome is not None:
+            chrome.close()
     
-    chrome.close()
+    for page_num, page in pages.items():
+        logger.error(f"[{loc_data.name}] Page {page_num} incomplete - {len(page['done']) - page['elsewhere']}/{page['expected']} restaurants finished")
+    if len(pages) == 0:
+        await asyncio.to_thread(complete_urls, [loc_data.url])
+    logger.info(f"[{loc_data.name}] Location processed - {pipeline.stats()}")
+    return num_scraped
 
 
 def main(args: argparse.Namespace):
-    csv_file = CSV_PATH / args.csv
-    locs = load_locations(csv_file)
+    global SAVE_PATH
+    locs = load_locations(CSV_PATH / args.csv) if args.csv else []
     if args.read:
         pprint(locs)
         exit()
-    asyncio.run(scrape(locs, args.num))
+    work_queue = None
+    if args.queue:
+        work_queue = WorkQueue(args.queue)
+        if args.csv:
+            # Sharding is idempotent, so each worker can add the CSV without waiting on a coordinator
+            work_queue.shard(locs, Path(args.csv).stem)
+            locs = []
+    if args.out:
+        SAVE_PATH = Path(args.out).resolve()
+    candidates = load_candidates(args.proxies) if args.proxies else None
+    tor_ports = [int(p) for p in args.tor.split(",")] if args.tor else None
+    control_ports = [int(p) for p in args.tor_control.split(",")] if args.tor_control else None
+    if args.record:
+        corpus = Corpus(args.record)
+        asyncio.run(scrape(locs, args.num, RecordTransport(corpus), functools.partial(SeleniumDriver, corpus), search_mode = args.search_mode, num_workers = args.workers, parse_workers = args.parse_workers, commit_interval = args.commit_interval, location_ttl = args.location_ttl * 24 * 60 * 60, metrics = args.metrics, metrics_interval = args.metrics_interval, work_queue = work_queue, worker_id = args.worker_id))
+    elif args.replay:
+        latency = tuple(float(t) for t in args.latency.split(","))
+        with ReplayServer(Corpus(args.replay), (latency[0], latency[-1]), args.error_rate) as server:
+            # Replayed requests go through the proxies to the replay server instead of the site
+            proxy_pool = None if candidates is None else ProxyPool(candidates, factory = functools.partial(ReplayTransport, server.url))
+            transport = ReplayTransport(server.url)
+            if tor_ports is not None:
+                transport = IdentityPool.tor(tor_ports, control_ports, factory = functools.partial(ReplayTransport, server.url))
+            asyncio.run(scrape(locs, args.num, transport, functools.partial(ReplayDriver, server.url), search_mode = args.search_mode, num_workers = args.workers, parse_workers = args.parse_workers, commit_interval = args.commit_interval, location_ttl = args.location_ttl * 24 * 60 * 60, metrics = args.metrics, metrics_interval = args.metrics_interval, proxy_pool = proxy_pool, work_queue = work_queue, worker_id = args.worker_id))
+    else:
+        cache = None
+        if args.cache_mode != "bypass":
+            cache = ResponseCache(args.cache or CACHE_PATH, mode = args.cache_mode)
+        proxy_pool = None if candidates is None else ProxyPool(candidates)
+        transport = None if tor_ports is None else IdentityPool.tor(tor_ports, control_ports)
+        asyncio.run(scrape(locs, args.num, transport, cache = cache, search_mode = args.search_mode, num_workers = args.workers, parse_workers = args.parse_workers, commit_interval = args.commit_interval, location_ttl = args.location_ttl * 24 * 60 * 60, metrics = args.metrics, metrics_interval = args.metrics_interval, proxy_pool = proxy_pool, work_queue = work_queue, worker_id = args.worker_id))
 
 
 if __name__ == "__main__":
@@ -356,8 +598,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--csv",
         action = "store",
-        help = "CSV file containing locations to scrape",
-        required = True
+        help = "CSV file containing locations to scrape - with --queue, its rows are added to the queue first"
     )
     parser.add_argument(
         "--num", "-n",
@@ -371,6 +612,122 @@ if __name__ == "__main__":
         action = "store_true",
         help = "print out the list of locations in a CSV"
     )
+    parser.add_argument(
+        "--out", "-o",
+        action = "store",
+        help = "directory to save JSON results to instead of data/"
+    )
+    parser.add_argument(
+        "--record",
+        action = "store",
+        help = "record every request and response into a corpus directory"
+    )
+    parser.add_argument(
+        "--replay",
+        action = "store",
+        help = "serve requests from a recorded corpus directory instead of the network"
+    )
+    parser.add_argument(
+        "--latency",
+        action = "store",
+        help = "replay latency in seconds as '[min],[max]'",
+        default = "0,0"
+    )
+    parser.add_argument(
+        "--error-rate",
+        action = "store",
+        help = "fraction of replayed responses to fail with HTTP 503",
+        type = float,
+        default = 0
+    )
+    parser.add_argument(
+        "--workers", "-w",
+        action = "store",
+        help = "number of locations to scrape at once",
+        type = int,
+        default = MAX_LOCS_AT_ONCE
+    )
+    parser.add_argument(
+        "--parse-workers",
+        action = "store",
+        help = "number of processes to parse pages in, 0 to parse on the event loop",
+        type = int,
+        default = PARSE_WORKERS
+    )
+    parser.add_argument(
+        "--commit-interval",
+        action = "store",
+        help = "maximum seconds between database commits",
+        type = float,
+        default = WRITE_INTERVAL
+    )
+    parser.add_argument(
+        "--location-ttl",
+        action = "store",
+        help = "days before a location resolved in an earlier run is looked up again",
+        type = float,
+        default = LOCATION_TTL / (24 * 60 * 60)
+    )
+    parser.add_argument(
+        "--search-mode",
+        action = "store",
+        help = "fetch search pages over 'http' with a Selenium fallback, or always render them with 'selenium'",
+        choices = ["http", "selenium"],
+        default = SEARCH_MODE
+    )
+    # Requests leave through either the proxies or the Tor identities
+    egress = parser.add_mutually_exclusive_group()
+    egress.add_argument(
+        "--proxies",
+        action = "store",
+        help = "file of proxies to spread requests across, one 'host:port' or proxy URL per line"
+    )
+    egress.add_argument(
+        "--tor",
+        action = "store",
+        help = "comma-separated Tor SOCKS ports to use as separate identities"
+    )
+    parser.add_argument(
+        "--tor-control",
+        action = "store",
+        help = "comma-separated Tor control ports matching --tor, 9051 for all by default"
+    )
+    parser.add_argument(
+        "--metrics",
+        action = "store",
+        help = "file to write telemetry to during the run - '.prom' for a Prometheus textfile, otherwise a JSON snapshot"
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        action = "store",
+        help = "seconds between telemetry writes",
+        type = float,
+        default = SNAPSHOT_INTERVAL
+    )
+    parser.add_argument(
+        "--queue", "-q",
+        action = "store",
+        help = "work queue file shared with other workers to lease locations from, see workqueue.py"
+    )
+    parser.add_argument(
+        "--worker-id",
+        action = "store",
+        help = "name to lease locations and restaurants under, '[host]:[pid]' with --queue and '[host]' otherwise"
+    )
+    parser.add_argument(
+        "--cache",
+        action = "store",
+        help = "directory for the restaurant page cache instead of cache/"
+    )
+    parser.add_argument(
+        "--cache-mode",
+        action = "store",
+        help = "'use' cached pages, 'refresh' them from the network, or 'bypass' the cache",
+        choices = CACHE_MODES,
+        default = "use"
+    )
     args = parser.parse_args()
+    if args.csv is None and args.queue is None:
+        parser.error("one of --csv or --queue is required")
     
     main(args)
\ No newline at end of file
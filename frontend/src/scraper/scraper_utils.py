@@ -1,96 +1,194 @@
+import csv
 import hashlib
 import json
+import time
 import asyncio
 import inspect
-from time import sleep
 from typing import Callable
 from pathlib import Path
 
-import pandas as pd
 import httpx
-import nest_asyncio
 from loguru import logger
-from fake_useragent import UserAgent
-from stem import Signal
-from stem.control import Controller
+try:
+    # Optional faster JSON backend for decoding page state
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
-from database import Restaurant, Session
+from database import Restaurant, to_row, upsert_restaurants
+from writer import DatabaseWriter
+from throttle import AdaptiveThrottle, BACKOFF_STATUSES
+from cache import ResponseCache
+from identities import IdentityPool
+from proxies import ProxyPool, ProxyTransport, load_candidates, PROXY_FILE
+from retry import RETRY_POLICY, RetryPolicy, CircuitBreakers, CircuitOpenError, is_retryable
+from telemetry import TELEMETRY
+from user_agents import random_user_agent
 
 
-RETRY_WAIT_TIME = 15
 MAX_CONNECTIONS = 5
 TIMEOUT = 5
-MAX_RETRIES = 5
 
 
 class ScraperClient(httpx.AsyncClient):
-    def __init__(self, headers: dict = {}, proxy: str = ""):
+    def __init__(self,
+                 headers: dict = {},
+                 proxy: str = "",
+                 transport: httpx.AsyncBaseTransport | None = None,
+                 throttle: AdaptiveThrottle | None = None,
+                 cache: ResponseCache | None = None,
+                 breakers: CircuitBreakers | None = None,
+                 proxy_pool: ProxyPool | None = None,
+                 identity_pool: IdentityPool | None = None):
         headers = {
             "Authority": "www.tripadvisor.com",
-            "User-Agent": UserAgent().random,
+            "User-Agent": random_user_agent(),
             "Accept": "*/*",
             "Accept-Language": "en-US,en;q=0.6",
             "Accept-Encoding": "gzip, deflate, br",
             **headers
         }
         
-        proxies = None
-        if proxy == "tor":
-            proxies = "socks5://127.0.0.1:9050"
-        elif proxy == "http":
-            pass
+        if proxy == "tor" and transport is None:
+            transport = identity_pool or IdentityPool.tor()
+        elif proxy == "http" and transport is None:
+            transport = ProxyTransport(proxy_pool or ProxyPool(load_candidates(PROXY_FILE)))
         
+        self._proxy = proxy
+        self.identities = transport if isinstance(transport, IdentityPool) else None
+        self.throttle = throttle
+        self.cache = cache
+        self.breakers = breakers if breakers is not None else CircuitBreakers()
         super().__init__(
             headers = headers,
-            proxies = proxies,
+            transport = transport,
             http2 = True,
             timeout = httpx.Timeout(TIMEOUT),
             limits = httpx.Limits(max_connections = MAX_CONNECTIONS)
         )
         
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        # Requests to a host whose circuit is open fail immediately instead of waiting on it
+        breaker = self.breakers.host(request.url.host)
+        try:
+            breaker.check()
+        except CircuitOpenError:
+            TELEMETRY.inc("circuit_rejections_total", host = request.url.host)
+            raise
+        try:
+            response = await self._send_throttled(request, **kwargs)
+        except httpx.TransportError:
+            breaker.failure()
+            raise
+        if response.status_code in BACKOFF_STATUSES or response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        return response
+
+    async def _send_throttled(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        if self.throttle is None:
+            return await self._send_measured(request, **kwargs)
+        start = time.perf_counter()
+        async with self.throttle.slot(request.url.host) as outcome:
+            TELEMETRY.observe("throttle_wait_seconds", time.perf_counter() - start, host = request.url.host)
+            response = await self._send_measured(request, **kwargs)
+            if response.status_code in BACKOFF_STATUSES:
+                outcome["ok"] = False
+            return response
+
+    async def _send_measured(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        host = request.url.host
+        start = time.perf_counter()
+        try:
+            response = await super().send(request, **kwargs)
+        except httpx.TransportError as e:
+            TELEMETRY.observe("http_request_seconds", time.perf_counter() - start, host = host, status = type(e).__name__)
+            raise
+        TELEMETRY.observe("http_request_seconds", time.perf_counter() - start, host = host, status = response.status_code)
+        TELEMETRY.inc("http_response_bytes_total", response.num_bytes_downloaded, host = host)
+        if response.status_code in BACKOFF_STATUSES:
+            TELEMETRY.inc("http_bans_total", host = host, status = response.status_code)
+        return response
+
     def reset(self):
-        self.headers["User-Agent"] = UserAgent().random
-        with Controller.from_port(port = "9051") as controller:
-            controller.authenticate(password = "password")
-            controller.signal(Signal.NEWNYM) # type: ignore
-        # Need way to reset client here?
-        
+        # Identities rotate their own User-Agents, circuits and connections in the background
+        if self.identities is not None:
+            return
+        self.headers["User-Agent"] = random_user_agent()
 
 
-def wrap_except(err_msg: str = "Default exception") -> Callable:
+def wrap_except(err_msg: str = "Default exception", policy: RetryPolicy | None = None) -> Callable:
     """Creates customized decorator for sync/async function for logging exceptions and re-running
 
+    Only transient errors are retried, with jittered exponential backoff and while the policy's retry budget lasts.
+
     Args:
         err_msg (str, optional): Exception message description. Defaults to "Default exception".
+        policy (RetryPolicy | None, optional): Retry limits and backoff. Defaults to RETRY_POLICY.
 
     Returns:
         Callable: Customized decorator with message embedded
     """
     def decorator(func: Callable) -> Callable:
         async def inner(*args: list, **kwargs: dict) -> object:
-            for i in range(MAX_RETRIES):
+            retry = policy if policy is not None else RETRY_POLICY
+            retry.budget.deposit()
+            i = 0
+            circuit_wait = 0.0
+            while i < retry.max_attempts:
                 try:
                     return await func(*args, **kwargs)
+                except CircuitOpenError as e:
+                    caller_func = inspect.currentframe().f_back.f_code.co_name # type: ignore
+                    wait = retry.circuit_delay(e)
+                    circuit_wait += wait
+                    if circuit_wait > retry.max_circuit_wait:
+                        give_up(err_msg, caller_func, e, i, retry)
+                        TELEMETRY.inc("giveups_total", func = func.__name__)
+                        return None
+                    logger.debug(f"{err_msg} @ {caller_func}: {e} - waiting {wait:.1f}s")
+                    await asyncio.sleep(wait)
                 except Exception as e:
                     caller_func = inspect.currentframe().f_back.f_code.co_name # type: ignore
-                    logger.error(f"{err_msg} @ {caller_func}: {e}")
-                    logger.error(f"{i + 1} attempt(s) made - waiting {RETRY_WAIT_TIME}s ({i + 1}/{MAX_RETRIES})")
-                    await asyncio.sleep(RETRY_WAIT_TIME)
+                    if not retry.should_retry(e, i):
+                        give_up(err_msg, caller_func, e, i, retry)
+                        TELEMETRY.inc("giveups_total", func = func.__name__)
+                        return None
+                    TELEMETRY.inc("retries_total", func = func.__name__)
+                    wait = retry.delay(i)
+                    logger.warning(f"{err_msg} @ {caller_func}: {e}")
+                    logger.warning(f"{i + 1} attempt(s) made - waiting {wait:.1f}s ({i + 1}/{retry.max_attempts})")
+                    await asyncio.sleep(wait)
+                    i += 1
         if not inspect.iscoroutinefunction(func):
-            sync_func = func
-            async def async_func(*args, **kwargs):
-                return sync_func(*args, **kwargs)
-            func = async_func
+            # Retry sync functions in place - re-entering the running loop to sleep loses task wakeups under concurrency
             def sync_inner(*args: list, **kwargs: dict) -> object:
-                nest_asyncio.apply()
-                loop = asyncio.get_running_loop()
-                return loop.run_until_complete(inner(*args, **kwargs))
+                retry = policy if policy is not None else RETRY_POLICY
+                for i in range(retry.max_attempts):
+                    try:
+                        return func(*args, **kwargs)
+                    except Exception as e:
+                        caller_func = inspect.currentframe().f_back.f_code.co_name # type: ignore
+                        if i + 1 >= retry.max_attempts or not is_retryable(e):
+                            give_up(err_msg, caller_func, e, i, retry)
+                            TELEMETRY.inc("giveups_total", func = func.__name__)
+                            return None
+                        TELEMETRY.inc("retries_total", func = func.__name__)
+                        logger.warning(f"{err_msg} @ {caller_func}: {e}")
+                        logger.warning(f"{i + 1} attempt(s) made ({i + 1}/{retry.max_attempts})")
             return sync_inner
         else:
             return inner
     return decorator
 
 
+def give_up(err_msg: str, caller_func: str, e: Exception, attempt: int, policy: RetryPolicy):
+    policy.budget.exhausted += 1
+    logger.error(f"{err_msg} @ {caller_func}: {type(e).__name__}: {e}")
+    logger.error(f"Giving up after {attempt + 1} attempt(s)")
+
+
 def ta_url(url_stem):
     url_root = "https://www.tripadvisor.com"
     return url_root + url_stem
@@ -112,6 +210,45 @@ def find_nested_key(data: dict, target: str) -> dict:
     return results
 
 
+_string_decoder = json.JSONDecoder()
+
+
+def extract_nested_key(html: str, target: str) -> dict | None:
+    """Extracts specific key from the JS state in a page without decoding the rest of the pageManifest
+
+    Equivalent to find_nested_key on get_page_data's urqlCache results, but only the single embedded
+    JSON string containing the target key is located, unescaped and decoded.
+
+    Args:
+        html (str): Page HTML
+        target (str): Target key
+
+    Returns:
+        dict | None: Dictionary corresponding to target key, or None if it could not be found
+    """
+    start = html.find("urqlCache")
+    if start < 0:
+        return None
+    idx = html.find(f'\\"{target}\\"', start)
+    if idx < 0:
+        return None
+    # Walk back to the opening quote of the "data" string that contains the target
+    key = html.rfind('"data":', start, idx)
+    if key < 0:
+        return None
+    quote = key + len('"data":')
+    while html[quote] in " \t\r\n":
+        quote += 1
+    try:
+        data, _ = _string_decoder.raw_decode(html, quote)
+        results = json_loads(data)
+    except ValueError:
+        return None
+    if not isinstance(results, dict) or target not in results:
+        return None
+    return results
+
+
 def hash_str(key: str) -> str:
     h = hashlib.sha256(key.encode("utf-8")).hexdigest()
     h = int(h, 16) % (10**8)
@@ -132,17 +269,18 @@ def save_json(file: str | Path, data: list):
         json.dump(temp, f, indent = 4)
         
 
-def save_all(file: str | Path, rst_list: list[Restaurant]):
+@TELEMETRY.timed("save_all")
+def save_all(file: str | Path, rst_list: list[Restaurant], writer: DatabaseWriter | None = None):
     if isinstance(file, str):
         file = Path(file)
     file = file.with_suffix(".json")
     save_json(file, rst_list)
+    if writer is not None:
+        writer.add(rst_list)
+        return
     try:
-        with Session() as session:
-            session.add_all(rst_list)
-            session.commit()
+        upsert_restaurants([to_row(rst) for rst in rst_list])
     except Exception as e:
-        file.unlink(missing_ok = True)
         logger.exception(f"Failed to save to database - {e}")
         
 
@@ -153,8 +291,17 @@ def is_file(file: str | Path) -> bool:
         
 
 def load_locations(file: str | Path) -> list[str]:
+    """Reads the location names in the first column of a CSV, streaming it row by row
+
+    Args:
+        file (str | Path): CSV file, with or without its suffix
+
+    Returns:
+        list[str]: Location names, skipping the header and empty rows
+    """
     if isinstance(file, str):
         file = Path(file)
-    df = pd.read_csv(file.with_suffix(".csv"))
-    names = df.iloc[:,0]
-    return names.tolist()
\ No newline at end of file
+    with open(file.with_suffix(".csv"), newline = "", encoding = "utf-8") as f:
+        rows = csv.reader(f)
+        next(rows, None)
+        return [row[0].strip() for row in rows if row and row[0].strip()]
\ No newline at end of file
@@ -0,0 +1,236 @@
+import re
+import json
+import time
+
+from sqlalchemy import text
+
+from database import engine
+
+
+SEARCH_FIELDS = ["name", "address", "tags", "price"] # Columns of the full-text index
+FACET_FIELDS = ["tags", "price"]
+FILTER_FIELDS = {"rating": "number", "review_count": "number", "price": "string", "tags": "array", "name": "string", "address": "string"}
+SORT_FIELDS = {"rating": "r.rating", "review_count": "r.review_count", "_text_match": "text_match"}
+DEFAULT_SORT = "_text_match:desc,review_count:desc" # Mirrors the collection's default_sorting_field
+MAX_FACET_VALUES = 10
+
+_index_ready = False
+
+
+def ensure_index():
+    """Creates the full-text index over restaurants, kept in sync with the table by triggers"""
+    global _index_ready
+    if _index_ready:
+        return
+    columns = ", ".join(SEARCH_FIELDS)
+    new_columns = ", ".join(f"new.{c}" for c in SEARCH_FIELDS)
+    old_columns = ", ".join(f"old.{c}" for c in SEARCH_FIELDS)
+    with engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'restaurants_fts'")).first()
+        conn.execute(text(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS restaurants_fts USING fts5(
+                {columns}, content = 'restaurants', content_rowid = 'rowid',
+                prefix = '2 3 4', tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """))
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS restaurants_fts_insert AFTER INSERT ON restaurants BEGIN
+                INSERT INTO restaurants_fts (rowid, {columns}) VALUES (new.rowid, {new_columns});
+            END
+        """))
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS restaurants_fts_delete AFTER DELETE ON restaurants BEGIN
+                INSERT INTO restaurants_fts (restaurants_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_columns});
+            END
+        """))
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS restaurants_fts_update AFTER UPDATE ON restaurants BEGIN
+                INSERT INTO restaurants_fts (restaurants_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_columns});
+                INSERT INTO restaurants_fts (rowid, {columns}) VALUES (new.rowid, {new_columns});
+            END
+        """))
+        if exists is None:
+            conn.execute(text("INSERT INTO restaurants_fts (restaurants_fts) VALUES ('rebuild')"))
+    _index_ready = True
+
+
+def parse_query(query: str, query_by: str) -> str | None:
+    """Converts a typesense query into an FTS5 match expression with prefix matching on every token
+
+    Args:
+        query (str): Search text, "*" to match everything
+        query_by (str): Comma-separated fields to search
+
+    Returns:
+        str | None: FTS5 match expression, or None to match everything
+    """
+    tokens = re.findall(r"\w+", query)
+    if query.strip() in ("", "*") or len(tokens) == 0:
+        return None
+    fields = [f.strip() for f in query_by.split(",") if f.strip()] or ["name"]
+    for f in fields:
+        if f not in SEARCH_FIELDS:
+            raise ValueError(f"Cannot query by '{f}' - must be one of {SEARCH_FIELDS}")
+    match = " ".join(f'"{token}"*' for token in tokens)
+    return f"{{{' '.join(fields)}}} : ({match})"
+
+
+def parse_filter(filter_by: str, params: dict) -> list[str]:
+    """Converts a typesense filter into SQL conditions joined by AND
+
+    Supports "field:value", "field:=value", "field:!=value", "field:>value" (also >=, <, <=),
+    "field:[a, b]" for any of several values and "field:[lo..hi]" for numeric ranges.
+
+    Args:
+        filter_by (str): Clauses joined by "&&"
+        params (dict): Bound parameters - values are added here
+
+    Returns:
+        list[str]: SQL conditions on restaurants aliased as r
+    """
+    conditions = []
+    for clause in [c.strip() for c in filter_by.split("&&") if c.strip()]:
+        m = re.fullmatch(r"(\w+)\s*:\s*(>=|<=|!=|>|<|=)?\s*(.+)", clause)
+        if m is None or m.group(1) not in FILTER_FIELDS:
+            raise ValueError(f"Invalid filter '{clause}' - fields must be one of {list(FILTER_FIELDS)}")
+        field, op, value = m.group(1), m.group(2) or ":", m.group(3).strip()
+        kind = FILTER_FIELDS[field]
+
+        values = [value]
+        if value.startswith("[") and value.endswith("]"):
+            values = [v.strip() for v in value[1:-1].split(",") if v.strip()]
+        values = [v.strip("`") for v in values]
+        if field == "price":
+            values = ["" if v == "N/A" else v for v in values]
+
+        parts = []
+        for v in values:
+            p = f"p{len(params)}"
+            if kind == "number":
+                if ".." in v:
+                    lo, hi = v.split("..")
+                    params[f"{p}_lo"], params[f"{p}_hi"] = float(lo), float(hi)
+                    parts.append(f"r.{field} BETWEEN :{p}_lo AND :{p}_hi")
+                    continue
+                params[p] = float(v)
+                parts.append(f"r.{field} {'=' if op in (':', '!=') else op} :{p}")
+            elif kind == "array":
+                params[p] = v
+                parts.append(f"r.id IN (SELECT rt.restaurant_id FROM restaurant_tags rt JOIN tags t ON t.id = rt.tag_id WHERE t.name = :{p})")
+            elif field == "price":
+                params[p] = v
+                parts.append(f"r.price_id = (SELECT id FROM price_tiers WHERE name = :{p})")
+            elif op == ":" and field in ("name", "address"):
+                params[p] = f"%{v}%"
+                parts.append(f"r.{field} LIKE :{p}")
+            else:
+                params[p] = v
+                parts.append(f"r.{field} = :{p}")
+        condition = f"({' OR '.join(parts)})"
+        conditions.append(f"NOT {condition}" if op == "!=" else condition)
+    return conditions
+
+
+def parse_sort(sort_by: str, has_query: bool) -> str:
+    """Converts a typesense sort into an SQL ORDER BY clause
+
+    Args:
+        sort_by (str): Comma-separated "field:asc" or "field:desc"
+        has_query (bool): Whether results have a text match score
+
+    Returns:
+        str: ORDER BY clause
+    """
+    order = []
+    for part in [p.strip() for p in (sort_by or DEFAULT_SORT).split(",") if p.strip()]:
+        field, _, direction = part.partition(":")
+        direction = (direction or "desc").lower()
+        if field not in SORT_FIELDS or direction not in ("asc", "desc"):
+            raise ValueError(f"Invalid sort '{part}' - fields must be one of {list(SORT_FIELDS)}")
+        if field == "_text_match":
+            if not has_query:
+                continue
+            # bm25() is lower for better matches
+            direction = "asc" if direction == "desc" else "desc"
+        order.append(f"{SORT_FIELDS[field]} {direction.upper()}")
+    return f"ORDER BY {', '.join(order + ['r.id'])}"
+
+
+def to_document(row: dict) -> dict:
+    doc = {k: v for k, v in row.items() if k in ("id", "name", "url", "rating", "review_count", "price", "tags", "imgs", "address", "phone")}
+    doc["price"] = doc["price"] or "N/A"
+    for k in ("tags", "imgs"):
+        try:
+            doc[k] = json.loads(doc[k])
+        except (TypeError, ValueError):
+            doc[k] = []
+    doc["imgs"] = list(set(doc["imgs"]))
+    if row.get("cell", -1) >= 0:
+        doc["location"] = [row["lat"], row["lng"]]
+    return doc
+
+
+def search_local(query: str,
+                 query_by: str = "",
+                 filter_by: str = "",
+                 sort_by: str = "",
+                 page: int = 1,
+                 per_page: int = 10) -> dict:
+    """Searches restaurants in scrape.db with the same parameters and result shape as a typesense search
+
+    Args:
+        query (str): Search text, "*" to match everything
+        query_by (str, optional): Comma-separated fields to search. Defaults to "name".
+        filter_by (str, optional): Typesense filter expression. Defaults to "".
+        sort_by (str, optional): Typesense sort expression. Defaults to DEFAULT_SORT.
+        page (int, optional): 1-based page of results. Defaults to 1.
+        per_page (int, optional): Results per page. Defaults to 10.
+
+    Returns:
+        dict: "found", "hits", "facet_counts", "page" and "search_time_ms"
+    """
+    start = time.perf_counter()
+    ensure_index()
+    params: dict = {}
+    match = parse_query(query, query_by)
+    conditions = parse_filter(filter_by, params)
+    source = "restaurants r"
+    if match is not None:
+        source = "restaurants_fts f JOIN restaurants r ON r.rowid = f.rowid"
+        conditions.insert(0, "restaurants_fts MATCH :match")
+        params["match"] = match
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    score = "bm25(restaurants_fts)" if match is not None else "0.0"
+
+    with engine.connect() as conn:
+        found = conn.execute(text(f"SELECT COUNT(*) FROM {source} {where}"), params).scalar()
+        rows = conn.execute(text(
+            f"SELECT r.*, {score} AS text_match FROM {source} {where} {parse_sort(sort_by, match is not None)} LIMIT :limit OFFSET :offset"
+        ), {**params, "limit": per_page, "offset": (page - 1) * per_page}).mappings().all()
+        facet_counts = []
+        for field in FACET_FIELDS:
+            if not conditions:
+                # Unfiltered counts are kept up to date by the writer
+                counts = conn.execute(text(
+                    f"SELECT value, count FROM facet_counts WHERE field = :field ORDER BY count DESC, value LIMIT {MAX_FACET_VALUES}"
+                ), {"field": field}).mappings().all()
+            else:
+                if field == "tags":
+                    facet_source = f"{source} JOIN restaurant_tags rt ON rt.restaurant_id = r.id JOIN tags t ON t.id = rt.tag_id"
+                    value = "t.name"
+                else:
+                    facet_source = f"{source} JOIN price_tiers pt ON pt.id = r.price_id"
+                    value = "pt.name"
+                counts = conn.execute(text(
+                    f"SELECT {value} AS value, COUNT(*) AS count FROM {facet_source} {where} GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT {MAX_FACET_VALUES}"
+                ), params).mappings().all()
+            counts = [{"value": c["value"] or "N/A" if field == "price" else c["value"], "count": c["count"]} for c in counts]
+            facet_counts.append({"field_name": field, "counts": counts})
+
+    return {
+        "found": found,
+        "page": page,
+        "hits": [{"document": to_document(dict(row)), "text_match": -row["text_match"]} for row in rows],
+        "facet_counts": facet_counts,
+        "search_time_ms": round((time.perf_counter() - start) * 1000, 2)
+    }
@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import bisect
+import asyncio
+import inspect
+import functools
+import threading
+from pathlib import Path
+from typing import Callable
+from contextlib import contextmanager
+
+from loguru import logger
+
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60] # Seconds
+SNAPSHOT_INTERVAL = 15 # Seconds between metrics files written during a run
+METRIC_PREFIX = "utravel_"
+
+
+class Histogram:
+    """Latency distribution over fixed buckets, cumulative as in Prometheus"""
+    def __init__(self, buckets: list[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot counts observations above every bucket
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile by interpolating within its bucket
+
+        Args:
+            q (float): Quantile between 0 and 1
+
+        Returns:
+            float: Estimated value, 0 with no observations
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n > 0 and seen + n >= rank:
+                lo = self.buckets[i - 1] if i > 0 else 0.0
+                hi = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                return min(self.max, lo + max(0.0, hi - lo) * (rank - seen) / n)
+            seen += n
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "p99": round(self.quantile(0.99), 6),
+            "max": round(self.max, 6)
+        }
+
+
+def _key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = [*key, *extra]
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Telemetry:
+    """Counters, gauges and histograms for a crawl, exported as a Prometheus textfile or a JSON snapshot
+
+    Metrics are keyed on a name and a set of labels. Updates are thread-safe, so parsing and database
+    threads can record alongside the event loop.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._gauges: dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, dict[tuple, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[_key(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def counter(self, name: str, **labels) -> float:
+        """Sums a counter over every series matching the given labels"""
+        wanted = set(_key(labels))
+        with self._lock:
+            return sum(v for k, v in self._counters.get(name, {}).items() if wanted <= set(k))
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observes the time spent in a block, labelled with whether it raised"""
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels, outcome = outcome)
+
+    def timed(self, stage: str) -> Callable:
+        """Creates a decorator observing each call of a sync or async function in the "stage_seconds" histogram
+
+        Args:
+            stage (str): Stage label
+
+        Returns:
+            Callable: Decorator
+        """
+        def decorator(func: Callable) -> Callable:
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def inner(*args, **kwargs):
+                    with self.timer("stage_seconds", stage = stage):
+                        return await func(*args, **kwargs)
+                return inner
+
+            @functools.wraps(func)
+            def sync_inner(*args, **kwargs):
+                with self.timer("stage_seconds", stage = stage):
+                    return func(*args, **kwargs)
+            return sync_inner
+        return decorator
+
+    def snapshot(self) -> dict:
+        elapsed = time.time() - self.started
+        with self._lock:
+            counters = {name: [{"labels": dict(k), "value": v} for k, v in series.items()] for name, series in self._counters.items()}
+            gauges = {name: [{"labels": dict(k), "value": v} for k, v in series.items()] for name, series in self._gauges.items()}
+            histograms = {name: [{"labels": dict(k), **h.to_dict()} for k, h in series.items()] for name, series in self._histograms.items()}
+        pages = self.counter("pages_scraped_total")
+        return {
+            "time": time.time(),
+            "elapsed": round(elapsed, 3),
+            "pages_per_second": round(pages / elapsed, 3) if elapsed > 0 else 0.0,
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms
+        }
+
+    def to_prometheus(self) -> str:
+        """Renders every metric in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+                lines.extend(f"{METRIC_PREFIX}{name}{_labels(k)} {v}" for k, v in series.items())
+            for name, series in sorted(self._gauges.items()):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} gauge")
+                lines.extend(f"{METRIC_PREFIX}{name}{_labels(k)} {v}" for k, v in series.items())
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+                for k, h in series.items():
+                    cumulative = 0
+                    for bound, n in zip([*h.buckets, "+Inf"], h.counts):
+                        cumulative += n
+                        lines.append(f"{METRIC_PREFIX}{name}_bucket{_labels(k, (('le', bound),))} {cumulative}")
+                    lines.append(f"{METRIC_PREFIX}{name}_sum{_labels(k)} {h.sum}")
+                    lines.append(f"{METRIC_PREFIX}{name}_count{_labels(k)} {h.count}")
+        lines.append(f"# TYPE {METRIC_PREFIX}run_start_time_seconds gauge")
+        lines.append(f"{METRIC_PREFIX}run_start_time_seconds {self.started}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, file: str | Path):
+        """Writes a Prometheus textfile (.prom) or JSON snapshot atomically, so collectors never read a partial file
+
+        Args:
+            file (str | Path): Destination - the format follows the suffix
+        """
+        file = Path(file)
+        file.parent.mkdir(parents = True, exist_ok = True)
+        content = self.to_prometheus() if file.suffix == ".prom" else json.dumps(self.snapshot(), indent = 4)
+        temp = file.with_name(f".{file.name}.tmp")
+        temp.write_text(content)
+        os.replace(temp, file)
+
+    async def report(self, file: str | Path, interval: float = SNAPSHOT_INTERVAL):
+        """Writes the metrics file every interval until cancelled, then once more
+
+        Args:
+            file (str | Path): Destination - ".prom" for a Prometheus textfile, anything else for JSON
+            interval (float, optional): Seconds between writes. Defaults to SNAPSHOT_INTERVAL.
+        """
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await asyncio.to_thread(self.write, file)
+                except OSError as e:
+                    logger.error(f"Could not write metrics to {file} - {e}")
+        finally:
+            self.write(file)
+
+    def summary(self) -> str:
+        """Summarizes where the time of a run went, one line per stage and host"""
+        snap = self.snapshot()
+        lines = [f"Run summary - {snap['elapsed']:.1f}s, {self.counter('pages_scraped_total'):.0f} pages ({snap['pages_per_second']:.2f} pages/s)"]
+        for name, series in sorted(snap["histograms"].items()):
+            for s in sorted(series, key = lambda s: -s["sum"]):
+                labels = ", ".join(f"{k}={v}" for k, v in s["labels"].items())
+                lines.append(f"  {name}[{labels}]: n={s['count']} total={s['sum']:.2f}s p50={s['p50'] * 1000:.0f}ms p95={s['p95'] * 1000:.0f}ms max={s['max'] * 1000:.0f}ms")
+        for name, series in sorted(snap["counters"].items()):
+            if name == "pages_scraped_total":
+                continue
+            for s in series:
+                labels = ", ".join(f"{k}={v}" for k, v in s["labels"].items())
+                lines.append(f"  {name}[{labels}]: {s['value']:.0f}")
+        return "\n".join(lines)
+
+
+TELEMETRY = Telemetry() # Shared by every instrumented module in a run
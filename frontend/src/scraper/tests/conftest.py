@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The scraper's modules import each other by name, and importing database migrates SCRAPE_DB
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ["SCRAPE_DB"] = str(Path(tempfile.mkdtemp(prefix = "scraper-tests-")) / "scrape.db")
+
+
+class Origin:
+    """Local site behind the mock proxies - answers every path with 200, except /status/[code]"""
+    def __init__(self):
+        self.requests = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests += 1
+                status = int(self.path.rpartition("/")[2]) if self.path.startswith("/status/") else 200
+                content = self.path.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format: str, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def origin():
+    server = Origin()
+    thread = threading.Thread(target = server._server.serve_forever, daemon = True)
+    thread.start()
+    yield server
+    server._server.shutdown()
+    server._server.server_close()
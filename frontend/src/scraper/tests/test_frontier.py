@@ -0,0 +1,27 @@
+import time
+
+from frontier import add_urls, lease_url, release_leases, complete_urls, get_status
+
+
+def test_live_lease_is_never_taken_twice():
+    url = f"https://www.tripadvisor.com/Restaurant_Review-g1-d{time.time_ns()}-Reviews.html"
+    add_urls([url], "restaurant", "test")
+    assert lease_url(url, "a")
+    # Not by another worker, nor by another location task of the same one
+    assert not lease_url(url, "b")
+    assert not lease_url(url, "a")
+
+    # A restarted worker releases its old leases before crawling
+    assert release_leases(["a"]) == 1
+    assert get_status(url) == "pending"
+    assert lease_url(url, "a")
+    complete_urls([url])
+    assert not lease_url(url, "a")
+
+
+def test_expired_lease_can_be_taken_over():
+    url = f"https://www.tripadvisor.com/Restaurant_Review-g1-d{time.time_ns()}-Reviews.html"
+    add_urls([url], "restaurant", "test")
+    assert lease_url(url, "a", lease_time = -1)
+    assert lease_url(url, "b")
+    assert release_leases(["a"]) == 0
@@ -0,0 +1,91 @@
+import asyncio
+
+import httpx
+import pytest
+
+from mock_tor import MockTor
+from identities import IdentityPool
+from proxies import ProxyPool
+
+
+def tor_pool(tors: list[MockTor], **kwargs) -> IdentityPool:
+    return IdentityPool.tor([t.socks_port for t in tors], [t.control_port for t in tors], **kwargs)
+
+
+async def fetch(pool: IdentityPool, url: str, n: int) -> list[int]:
+    async with httpx.AsyncClient(transport = pool) as client:
+        return [r.status_code for r in await asyncio.gather(*[client.get(url) for _ in range(n)])]
+
+
+async def wait_for(condition, timeout: float = 5):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError("Condition not met in time")
+
+
+def test_requests_spread_across_identities(origin):
+    with MockTor() as a, MockTor() as b:
+        pool = tor_pool([a, b], interval = 3600)
+        assert asyncio.run(fetch(pool, f"{origin.url}/page", 20)) == [200] * 20
+        assert [i.requests for i in pool.identities] == [10, 10]
+        assert [i.in_flight for i in pool.identities] == [0, 0]
+        # Each identity keeps to its own Tor instance and circuit
+        assert a.connections > 0 and b.connections > 0
+        assert len(a.circuits) == len(b.circuits) == 1
+
+
+def test_rotation_renews_one_identity(origin):
+    with MockTor() as a, MockTor() as b:
+        pool = tor_pool([a, b], interval = 3600, cooldown = 0)
+
+        async def run():
+            async with httpx.AsyncClient(transport = pool) as client:
+                await client.get(f"{origin.url}/before")
+                await client.get(f"{origin.url}/before")
+                await pool.identities[0].rotate(cooldown = 0)
+                await client.get(f"{origin.url}/after")
+                await client.get(f"{origin.url}/after")
+
+        asyncio.run(run())
+        assert a.newnyms == 1 and b.newnyms == 0
+        assert len(a.circuits) == 2 and len(b.circuits) == 1
+        assert [i.rotations for i in pool.identities] == [1, 0]
+
+
+def test_throttled_identity_rotates(origin):
+    with MockTor() as a, MockTor() as b:
+        pool = tor_pool([a, b], interval = 3600, cooldown = 0)
+
+        async def run():
+            async with httpx.AsyncClient(transport = pool) as client:
+                assert (await client.get(f"{origin.url}/status/429")).status_code == 429
+                await wait_for(lambda: pool.identities[0].rotations == 1)
+
+        asyncio.run(run())
+        assert a.newnyms == 1 and b.newnyms == 0
+        assert pool.identities[0].failures == 1
+
+
+def test_rotations_are_staggered(origin):
+    with MockTor() as a, MockTor() as b:
+        pool = tor_pool([a, b], interval = 0.4, cooldown = 0.1)
+
+        async def run():
+            async with httpx.AsyncClient(transport = pool) as client:
+                # Requests keep flowing through whichever identity isn't cooling down
+                for _ in range(20):
+                    assert (await client.get(f"{origin.url}/page")).status_code == 200
+                    assert not all(i.cooling for i in pool.identities)
+                    await asyncio.sleep(0.05)
+
+        asyncio.run(run())
+        assert a.newnyms >= 1 and b.newnyms >= 1
+
+
+def test_proxies_rejected_with_identities():
+    import scraper_ta
+    pool = IdentityPool.tor([1], [1])
+    with pytest.raises(ValueError):
+        asyncio.run(scraper_ta.scrape(["LA"], transport = pool, proxy_pool = ProxyPool(["http://127.0.0.1:1"])))
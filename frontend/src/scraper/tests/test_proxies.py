@@ -0,0 +1,67 @@
+import asyncio
+
+import httpx
+import pytest
+
+from mock_proxy import MockProxy
+from proxies import ProxyPool, ProxyTransport, NoProxyError, SESSION_EXTENSION
+
+
+async def fetch(pool: ProxyPool, url: str, n: int, session: str | None = None) -> list[int]:
+    extensions = {} if session is None else {SESSION_EXTENSION: session}
+    async with httpx.AsyncClient(transport = ProxyTransport(pool)) as client:
+        return [(await client.send(client.build_request("GET", url, extensions = extensions))).status_code for _ in range(n)]
+
+
+def test_failing_proxy_is_evicted(origin):
+    # The working proxy is slow, so the broken one scores higher until its failures evict it
+    with MockProxy(latency = (0.25, 0.25)) as good, MockProxy(error_rate = 1) as bad:
+        pool = ProxyPool([good.url, bad.url])
+        statuses = asyncio.run(fetch(pool, f"{origin.url}/page", 20))
+        assert [p.url for p in pool.active] == [good.url]
+        assert bad.requests == pool.max_failures
+        assert good.requests == statuses.count(200) == 20 - pool.max_failures
+
+
+def test_health_check_evicts_broken_proxies(origin):
+    with MockProxy() as good, MockProxy(error_rate = 1) as bad:
+        pool = ProxyPool([good.url, bad.url, "http://127.0.0.1:1"], check_url = origin.url)
+        passed = asyncio.run(pool.check(timeout = 2))
+        assert [p.url for p in passed] == [good.url]
+        assert pool.stats()["evicted"] == 2
+
+
+def test_sticky_session_keeps_its_proxy(origin):
+    with MockProxy() as a, MockProxy() as b, MockProxy() as c:
+        mocks = {m.url: m for m in (a, b, c)}
+        pool = ProxyPool(list(mocks))
+        assert asyncio.run(fetch(pool, f"{origin.url}/page", 10, session = "s1")) == [200] * 10
+        used = [m for m in mocks.values() if m.requests > 0]
+        assert len(used) == 1 and used[0].requests == 10
+
+        # An evicted proxy hands the session to another one, which then keeps it
+        pool.evict(pool.choose("s1"), "test")
+        asyncio.run(fetch(pool, f"{origin.url}/page", 5, session = "s1"))
+        moved = [m for m in mocks.values() if m is not used[0] and m.requests > 0]
+        assert len(moved) == 1 and moved[0].requests == 5
+
+
+def test_no_proxies_left():
+    with MockProxy(error_rate = 1) as bad:
+        pool = ProxyPool([bad.url])
+        with pytest.raises(NoProxyError):
+            asyncio.run(fetch(pool, "http://127.0.0.1:1/page", pool.max_failures + 1))
+
+
+def test_request_page_session_keeps_its_proxy(origin):
+    import scraper_ta
+    from scraper_utils import ScraperClient
+
+    async def run(pool: ProxyPool):
+        async with ScraperClient(transport = ProxyTransport(pool)) as client:
+            for i in range(6):
+                assert await scraper_ta.request_page(client, f"{origin.url}/search/{i}", session = "LA") == f"/search/{i}"
+
+    with MockProxy() as a, MockProxy() as b, MockProxy() as c:
+        asyncio.run(run(ProxyPool([a.url, b.url, c.url])))
+        assert sorted(m.requests for m in (a, b, c)) == [0, 0, 6]
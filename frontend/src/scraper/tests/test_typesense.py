@@ -0,0 +1,55 @@
+import json
+import random
+
+import pytest
+
+import typesense_utils
+from mock_typesense import MockTypesense
+
+
+DOCS = [
+    {"id": str(i), "name": f"Restaurant {i}", "url": f"/r{i}", "imgs": [], "address": "", "phone": "",
+     "rating": 4.5, "review_count": i, "tags": ["Pizza"], "price": "$"}
+    for i in range(25)
+]
+
+
+@pytest.fixture
+def export(tmp_path, monkeypatch):
+    monkeypatch.setattr(typesense_utils, "curr_path", tmp_path)
+    monkeypatch.setattr(typesense_utils, "PUSH_RETRY_WAIT_TIME", 0)
+    (tmp_path / "data").mkdir()
+
+    def write(docs: list[dict]):
+        (tmp_path / "data" / "test.jsonl").write_text("\n".join(json.dumps(d) for d in docs) + "\n")
+
+    write(DOCS)
+    return write
+
+
+def test_push_skips_unchanged_documents(export):
+    with MockTypesense() as ts:
+        typesense_utils.init_client(ts.config)
+        assert typesense_utils.push_docs("test", batch_size = 10) == {"pushed": 25, "skipped": 0, "failed": 0}
+        assert ts.documents["restaurants"].keys() == {d["id"] for d in DOCS}
+
+        export([{**d, "rating": 3.0} if d["id"] == "7" else d for d in DOCS])
+        imported = ts.imported
+        assert typesense_utils.push_docs("test", batch_size = 10) == {"pushed": 1, "skipped": 24, "failed": 0}
+        assert ts.imported == imported + 1
+        assert ts.documents["restaurants"]["7"]["rating"] == 3.0
+
+
+def test_push_retries_rejected_lines(export):
+    random.seed(1)
+    with MockTypesense(error_rate = 0.3, line_error_rate = 0.3) as ts:
+        typesense_utils.init_client(ts.config)
+        counts = typesense_utils.push_docs("test", batch_size = 5, workers = 1)
+        assert counts["pushed"] + counts["failed"] == 25
+        assert counts["pushed"] == len(ts.documents["restaurants"])
+        assert ts.errors > 0
+
+        # Only documents that never made it are pushed again
+        ts.error_rate = ts.line_error_rate = 0
+        assert typesense_utils.push_docs("test", batch_size = 5) == {"pushed": counts["failed"], "skipped": counts["pushed"], "failed": 0}
+        assert len(ts.documents["restaurants"]) == 25
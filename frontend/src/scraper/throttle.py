@@ -0,0 +1,129 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from loguru import logger
+
+
+BACKOFF_STATUSES = {403, 429, 503}
+
+
+class HostLimiter:
+    """AIMD limiter for a single host - additive increase on success, multiplicative decrease on backoff"""
+    def __init__(self,
+                 host: str,
+                 concurrency: float = 5,
+                 rate: float = 1,
+                 min_concurrency: float = 1,
+                 max_concurrency: float = 20,
+                 min_rate: float = 0.1,
+                 max_rate: float = 20,
+                 increase: float = 1,
+                 decrease: float = 0.5,
+                 cooldown: float = 5):
+        self.host = host
+        self.concurrency = concurrency
+        self.rate = rate
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.successes = 0
+        self.backoffs = 0
+        self._next_start = 0.0
+        self._last_backoff = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+
+        # Reserve the next start slot so requests are spaced 1/rate apart
+        now = time.monotonic()
+        start = max(now, self._next_start)
+        self._next_start = start + 1 / self.rate
+        if start > now:
+            try:
+                await asyncio.sleep(start - now)
+            except asyncio.CancelledError:
+                await self.release(None)
+                raise
+
+    async def release(self, ok: bool | None):
+        if ok is True:
+            self.success()
+        elif ok is False:
+            self.backoff()
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def success(self):
+        # Increase by roughly one unit per window's worth of successful requests
+        self.successes += 1
+        self.concurrency = min(self.max_concurrency, self.concurrency + self.increase / self.concurrency)
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def backoff(self):
+        # Only back off once per cooldown so a single burst of failures doesn't collapse the limits
+        now = time.monotonic()
+        if now - self._last_backoff < self.cooldown:
+            return
+        self._last_backoff = now
+        self.backoffs += 1
+        self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease)
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self._next_start = now + 1 / self.rate
+        logger.warning(f"[{self.host}] Backing off to {int(self.concurrency)} requests at once, {self.rate:.2f} requests/s")
+
+    def limits(self) -> dict:
+        return {
+            "concurrency": int(self.concurrency),
+            "rate": round(self.rate, 2),
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "backoffs": self.backoffs
+        }
+
+
+class AdaptiveThrottle:
+    """Per-host collection of HostLimiters sharing the same starting limits"""
+    def __init__(self, concurrency: float = 5, rate: float = 1, **kwargs):
+        self._kwargs = {"concurrency": concurrency, "rate": rate, **kwargs}
+        self._hosts: dict[str, HostLimiter] = {}
+
+    def host(self, host: str) -> HostLimiter:
+        if host not in self._hosts:
+            self._hosts[host] = HostLimiter(host, **self._kwargs)
+        return self._hosts[host]
+
+    @asynccontextmanager
+    async def slot(self, host: str):
+        """Holds a request slot for a host, backing off if the block raises
+
+        Args:
+            host (str): Host being requested
+
+        Yields:
+            dict: Outcome of the request - set "ok" to False to report a ban without raising
+        """
+        limiter = self.host(host)
+        await limiter.acquire()
+        outcome = {"ok": None}
+        try:
+            yield outcome
+            if outcome["ok"] is None:
+                outcome["ok"] = True
+        except Exception:
+            outcome["ok"] = False
+            raise
+        finally:
+            await limiter.release(outcome["ok"])
+
+    def limits(self) -> dict[str, dict]:
+        return {host: limiter.limits() for host, limiter in self._hosts.items()}
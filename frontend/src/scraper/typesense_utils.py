@@ -1,29 +1,49 @@
 import argparse
 import json
+import gzip
+import time
+import hashlib
 from pathlib import Path
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from pprint import pprint
 
 import typesense
 from typesense.exceptions import ObjectAlreadyExists
 from dotenv import dotenv_values
+from loguru import logger
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.sqlite import insert
+
+from database import engine, Restaurant, ExportState, PushedDoc, RST_COLUMNS
+from mock_typesense import MockTypesense
+from search import search_local
 
 
 curr_path = Path(__file__).resolve().parent
 config = dotenv_values(curr_path / "ts_admin.env")
 client: typesense.Client = None # type: ignore
 
+EXPORT_CHUNK_SIZE = 5000 # Rows fetched and written at a time
+PUSH_BATCH_SIZE = 1000 # Documents per import request
+PUSH_WORKERS = 4 # Import requests in flight at once
+PUSH_RETRIES = 3
+PUSH_RETRY_WAIT_TIME = 2
+RETRY_CODES = {408, 429, 500, 502, 503, 504} # Line-level error codes worth importing again
+
 
-def init_client():
+def init_client(ts_config: dict | None = None):
     global client
-    if client is not None:
+    if client is not None and ts_config is None:
         return
+    ts_config = ts_config or config
     client = typesense.Client({
         "nodes": [{
-            "host": config["TYPESENSE_HOST"],
-            "port": config["TYPESENSE_PORT"],
-            "protocol": config["TYPESENSE_PROTOCOL"]
+            "host": ts_config["TYPESENSE_HOST"],
+            "port": ts_config["TYPESENSE_PORT"],
+            "protocol": ts_config["TYPESENSE_PROTOCOL"]
         }],
-        "api_key": config["TYPESENSE_API_KEY"],
+        "api_key": ts_config["TYPESENSE_API_KEY"],
         "connection_timeout_seconds": 2
     })
 
@@ -36,29 +56,87 @@ def clean(data: dict):
         data["tags"] = json.loads(data["tags"])
     except Exception:
         pass
+    lat, lng = data.pop("lat", 0), data.pop("lng", 0)
+    if lat != 0 or lng != 0:
+        data["location"] = [lat, lng]
+
+
+def to_jsonl(fn: str = "all",
+             incremental: bool = False,
+             compress: bool = False,
+             chunk_size: int = EXPORT_CHUNK_SIZE) -> Path:
+    """Streams restaurants from the database into data/[fn].jsonl
 
+    Args:
+        fn (str, optional): Output file name, also used to track the export's watermark. Defaults to "all".
+        incremental (bool, optional): Only export restaurants changed since the last export of fn. Defaults to False.
+        compress (bool, optional): Write data/[fn].jsonl.gz instead. Defaults to False.
+        chunk_size (int, optional): Number of rows fetched and written at a time. Defaults to EXPORT_CHUNK_SIZE.
 
-def to_jsonl():
+    Returns:
+        Path: Exported file
+    """
     path = curr_path / "data"
-    if not path.is_dir():
-        raise RuntimeError("No data to process")
-    jsonl_path = path / "all.jsonl"
-    
-    with open(jsonl_path, "w") as f:
-        for file in path.iterdir():
-            with open(file) as fr:
-                try:
-                    data = json.load(fr)
-                except json.JSONDecodeError:
-                    continue
-                for d in data:
+    path.mkdir(exist_ok = True)
+    jsonl_path = path / (f"{fn}.jsonl.gz" if compress else f"{fn}.jsonl")
+    tmp_path = jsonl_path.with_name(f"{jsonl_path.name}.tmp")
+    start = time.perf_counter()
+
+    with engine.connect() as conn:
+        since = None
+        if incremental:
+            since = conn.execute(select(ExportState.watermark).where(ExportState.name == fn)).scalar()
+        watermark = conn.execute(select(func.max(Restaurant.updated))).scalar() or 0.0
+
+        # Rows changed after the watermark was read are picked up by the next export
+        stmt = (
+            select(*[Restaurant.__table__.c[c] for c in RST_COLUMNS])
+            .where(Restaurant.updated <= watermark)
+            .order_by(Restaurant.updated)
+        )
+        if since is not None:
+            stmt = stmt.where(Restaurant.updated > since)
+        num_rows = 0
+        with (gzip.open(tmp_path, "wt") if compress else open(tmp_path, "w")) as f:
+            result = conn.execution_options(stream_results = True, yield_per = chunk_size).execute(stmt)
+            for rows in result.mappings().partitions(chunk_size):
+                lines = []
+                for row in rows:
+                    d = dict(row)
+                    del d["updated"]
                     clean(d)
-                    f.write(json.dumps(d))
-                    f.write("\n")
-        # f.flush()
+                    lines.append(json.dumps(d))
+                f.write("\n".join(lines) + "\n")
+                num_rows += len(rows)
+    tmp_path.replace(jsonl_path)
 
+    with engine.begin() as conn:
+        conn.execute(
+            ExportState.__table__.insert().prefix_with("OR REPLACE"),
+            {"name": fn, "watermark": watermark, "rows": num_rows, "exported": time.time()}
+        )
+    logger.info(f"Exported {num_rows} restaurants to {jsonl_path.name} in {time.perf_counter() - start:.2f}s")
+    return jsonl_path
 
-def push_docs(fn: str):
+
+def push_docs(fn: str,
+              batch_size: int = PUSH_BATCH_SIZE,
+              workers: int = PUSH_WORKERS,
+              force: bool = False) -> dict[str, int]:
+    """Streams documents in data/[fn].jsonl(.gz) to the typesense server as concurrent batches of upserts
+
+    Documents whose content is unchanged since they were last pushed are skipped, and only the lines
+    rejected with a transient error are retried.
+
+    Args:
+        fn (str): Name of the JSONL file in data/
+        batch_size (int, optional): Documents per import request. Defaults to PUSH_BATCH_SIZE.
+        workers (int, optional): Import requests in flight at once. Defaults to PUSH_WORKERS.
+        force (bool, optional): Push every document even if it was pushed before. Defaults to False.
+
+    Returns:
+        dict[str, int]: Number of documents "pushed", "skipped" as unchanged and "failed"
+    """
     global client
     rst_schema = {
         "name": "restaurants",
@@ -72,7 +150,8 @@ def push_docs(fn: str):
             {"name": "rating", "type": "float"},
             {"name": "review_count", "type": "int32"},
             {"name": "tags", "type": "string[]", "facet": True},
-            {"name": "price", "type": "string", "facet": True}
+            {"name": "price", "type": "string", "facet": True},
+            {"name": "location", "type": "geopoint", "optional": True}
         ],
         "default_sorting_field": "review_count"
     }
@@ -81,11 +160,135 @@ def push_docs(fn: str):
         client.collections.create(rst_schema)
     except ObjectAlreadyExists:
         pass
-        
 
     jsonl_path = curr_path / "data" / f"{fn}.jsonl"
-    with open(jsonl_path) as jsonl_file:
-        client.collections["restaurants"].documents.import_(jsonl_file.read().encode("utf-8")) # type: ignore
+    if not jsonl_path.is_file():
+        jsonl_path = jsonl_path.with_suffix(".jsonl.gz")
+    counts = {"pushed": 0, "skipped": 0, "failed": 0}
+    start = time.perf_counter()
+    pending: set[Future] = set()
+
+    def collect(futures: set[Future]):
+        for future in futures:
+            pushed, failed = future.result()
+            mark_pushed("restaurants", pushed)
+            counts["pushed"] += len(pushed)
+            counts["failed"] += len(failed)
+
+    with ThreadPoolExecutor(workers) as executor:
+        for batch in read_batches(jsonl_path, batch_size):
+            if not force:
+                num_docs = len(batch)
+                batch = unchanged_filter("restaurants", batch)
+                counts["skipped"] += num_docs - len(batch)
+            if len(batch) == 0:
+                continue
+            # Bound the batches held in memory to the ones being imported plus one queued per worker
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(import_batch, "restaurants", batch))
+        collect(set(wait(pending).done))
+
+    logger.info(f"Pushed {jsonl_path.name} in {time.perf_counter() - start:.2f}s - {counts}")
+    return counts
+
+
+def read_batches(jsonl_path: Path, batch_size: int) -> Iterator[list[tuple[str, str, str]]]:
+    """Reads a JSONL file lazily in batches
+
+    Args:
+        jsonl_path (Path): JSONL file, gzipped if it ends with .gz
+        batch_size (int): Number of documents per batch
+
+    Yields:
+        list[tuple[str, str, str]]: Id, content hash and line of each document
+    """
+    with (gzip.open(jsonl_path, "rt") if jsonl_path.suffix == ".gz" else open(jsonl_path)) as f:
+        batch = []
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            doc = json.loads(line)
+            digest = hashlib.sha256(json.dumps(doc, sort_keys = True).encode("utf-8")).hexdigest()
+            batch.append((str(doc["id"]), digest, line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def push_target(collection: str) -> str:
+    node = client.config.nodes[0]
+    return f"{node.host}:{node.port}/{collection}"
+
+
+def unchanged_filter(collection: str, batch: list[tuple[str, str, str]]) -> list[tuple[str, str, str]]:
+    # Keep only documents whose content differs from what was last pushed to this server
+    stmt = select(PushedDoc.id, PushedDoc.hash).where(
+        PushedDoc.target == push_target(collection),
+        PushedDoc.id.in_([doc_id for doc_id, _, _ in batch])
+    )
+    with engine.connect() as conn:
+        pushed = dict(conn.execute(stmt).all())
+    return [doc for doc in batch if pushed.get(doc[0]) != doc[1]]
+
+
+def mark_pushed(collection: str, docs: list[tuple[str, str, str]]):
+    if len(docs) == 0:
+        return
+    now = time.time()
+    stmt = insert(PushedDoc)
+    stmt = stmt.on_conflict_do_update(
+        index_elements = ["target", "id"],
+        set_ = {"hash": stmt.excluded.hash, "pushed": stmt.excluded.pushed}
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt, [{"target": push_target(collection), "id": doc_id, "hash": digest, "pushed": now} for doc_id, digest, _ in docs])
+
+
+def import_batch(collection: str,
+                 batch: list[tuple[str, str, str]],
+                 retries: int = PUSH_RETRIES) -> tuple[list[tuple[str, str, str]], list[tuple[str, str, str]]]:
+    """Upserts a batch of documents, retrying the whole request on failure and rejected lines on transient errors
+
+    Args:
+        collection (str): Collection to import into
+        batch (list[tuple[str, str, str]]): Id, content hash and line of each document
+        retries (int, optional): Attempts per document. Defaults to PUSH_RETRIES.
+
+    Returns:
+        tuple[list[tuple[str, str, str]], list[tuple[str, str, str]]]: Imported and failed documents
+    """
+    imported = []
+    failed = []
+    for i in range(retries):
+        if i > 0:
+            time.sleep(PUSH_RETRY_WAIT_TIME * 2**(i - 1))
+        try:
+            response = client.collections[collection].documents.import_( # type: ignore
+                "\n".join(line for _, _, line in batch).encode("utf-8"),
+                {"action": "upsert"}
+            )
+        except Exception as e:
+            logger.warning(f"Import of {len(batch)} documents failed ({i + 1}/{retries}) - {e}")
+            continue
+        retry = []
+        for doc, result in zip(batch, [json.loads(r) for r in response.splitlines()]):
+            if result.get("success"):
+                imported.append(doc)
+            elif result.get("code") in RETRY_CODES:
+                retry.append(doc)
+            else:
+                logger.error(f"Document {doc[0]} rejected - {result.get('error')}")
+                failed.append(doc)
+        batch = retry
+        if len(batch) == 0:
+            break
+        logger.warning(f"Retrying {len(batch)} rejected documents ({i + 1}/{retries})")
+    return imported, failed + batch
 
 
 def get_collections():
@@ -94,12 +297,20 @@ def get_collections():
 
 def del_collection(name: str):
     client.collections[name].delete() # type: ignore
+    with engine.begin() as conn:
+        conn.execute(delete(PushedDoc).where(PushedDoc.target == push_target(name)))
 
 
 def search_docs(query: str,
                 query_by: str = "",
                 filter_by: str = "",
-                sort_by: str = ""):
+                sort_by: str = "",
+                local: bool = False):
+    if local:
+        results = search_local(query, query_by, filter_by, sort_by)
+        pprint(results)
+        pprint(f"Number of results: {results['found']}")
+        return
     params = {
         "q": query,
         "query_by": query_by if query_by != "" else "name",
@@ -115,32 +326,79 @@ def search_docs(query: str,
     
 def main(args: argparse.Namespace):
     if args.jsonl:
-        to_jsonl()
-    if args.push or args.get or args.delete or args.search:
+        to_jsonl(args.jsonl, args.incremental, args.gzip)
+    if args.mock is not None:
+        # Push to a throwaway local server and forget what was pushed to it once it stops
+        with MockTypesense(line_error_rate = args.mock) as server:
+            init_client(server.config)
+            push_docs(args.push or args.jsonl or "all", args.batch_size, args.push_workers, args.force)
+            with engine.begin() as conn:
+                conn.execute(delete(PushedDoc).where(PushedDoc.target == push_target("restaurants")))
+        return
+    if args.push or args.get or args.delete or (args.search and not args.local):
         init_client()
     if args.push:
-        push_docs(args.push)
+        push_docs(args.push, args.batch_size, args.push_workers, args.force)
     if args.get:
         get_collections()
     if args.delete:
         del_collection(args.delete)
     if args.search:
         search_args = args.search.split(";")
-        search_docs(*search_args)
+        search_docs(*search_args, local = args.local)
     
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Typesense utilities")
     parser.add_argument(
         "--jsonl",
+        action = "store",
+        help = "export restaurants in the database to data/[file].jsonl",
+        nargs = "?",
+        const = "all"
+    )
+    parser.add_argument(
+        "--incremental", "-i",
         action = "store_true",
-        help = "convert JSON array into JSONL of array elements"
+        help = "with --jsonl, only export restaurants changed since the file was last exported"
+    )
+    parser.add_argument(
+        "--gzip", "-z",
+        action = "store_true",
+        help = "with --jsonl, write data/[file].jsonl.gz"
     )
     parser.add_argument(
         "--push", "-p",
         action = "store",
         help = "push documents in [file].jsonl to typesense server"
     )
+    parser.add_argument(
+        "--batch-size",
+        action = "store",
+        help = "documents per import request",
+        type = int,
+        default = PUSH_BATCH_SIZE
+    )
+    parser.add_argument(
+        "--push-workers",
+        action = "store",
+        help = "import requests in flight at once",
+        type = int,
+        default = PUSH_WORKERS
+    )
+    parser.add_argument(
+        "--force", "-f",
+        action = "store_true",
+        help = "push every document, even those unchanged since they were last pushed"
+    )
+    parser.add_argument(
+        "--mock",
+        action = "store",
+        help = "push to a local mock typesense server rejecting a given fraction of documents instead",
+        type = float,
+        nargs = "?",
+        const = 0.0
+    )
     parser.add_argument(
         "--get", "-g",
         action = "store_true",
@@ -156,7 +414,12 @@ if __name__ == "__main__":
         action = "store",
         help = "search documents with format string '[query];[query by];[filter by];[sort by]'"
     )
+    parser.add_argument(
+        "--local", "-l",
+        action = "store_true",
+        help = "with --search, search the local database instead of the typesense server"
+    )
     args = parser.parse_args()
-    if not any(vars(args).values()):
+    if not any([args.jsonl, args.push, args.get, args.delete, args.search, args.mock is not None]):
         parser.error("No arguments provided")
     main(args)
\ No newline at end of file
@@ -0,0 +1,46 @@
+import json
+import time
+import random
+import functools
+from pathlib import Path
+
+from loguru import logger
+
+
+UA_FILE = Path(__file__).resolve().parent / "cache" / "user_agents.json"
+UA_MAX_AGE = 30 * 24 * 60 * 60 # Seconds before the pool is rebuilt from fake_useragent's data
+
+
+@functools.cache
+def load_pool(file: Path = UA_FILE, max_age: float = UA_MAX_AGE) -> dict[str, list[str]]:
+    """Loads User-Agents per browser once per process
+
+    The pool is read from a local cache file, which is only built from fake_useragent's dataset when it is
+    missing or older than max_age - so most runs never import fake_useragent at all.
+
+    Args:
+        file (Path, optional): Cache file. Defaults to UA_FILE.
+        max_age (float, optional): Seconds before the cache file is rebuilt. Defaults to UA_MAX_AGE.
+
+    Returns:
+        dict[str, list[str]]: User-Agent strings for each browser
+    """
+    try:
+        if time.time() - file.stat().st_mtime < max_age:
+            return json.loads(file.read_text())
+    except (OSError, ValueError):
+        pass
+    from fake_useragent import UserAgent # Only needed to build the cache
+    pool = {browser: agents for browser, agents in UserAgent().data_browsers.items() if agents}
+    try:
+        file.parent.mkdir(parents = True, exist_ok = True)
+        file.write_text(json.dumps(pool))
+    except OSError as e:
+        logger.warning(f"Could not cache User-Agents to {file} - {e}")
+    return pool
+
+
+def random_user_agent() -> str:
+    # Browser first, then one of its User-Agents, as fake_useragent picks them
+    pool = load_pool()
+    return random.choice(pool[random.choice(list(pool))])
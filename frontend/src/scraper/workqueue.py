@@ -0,0 +1,480 @@
+# Distributed crawling: a coordinator shards CSV rows into a shared work queue and any number of workers lease
+# locations from it
+#
+# Coordinator: python workqueue.py --queue /shared/queue.db shard --csv uscounties
+#              python workqueue.py --queue /shared/queue.db watch
+# Workers:     python scraper_ta.py --queue /shared/queue.db -n 10
+# Results:     python workqueue.py merge worker1/scrape.db worker2/scrape.db
+#
+# The queue is a SQLite file, so every worker needs it on a filesystem they share. It uses a rollback journal,
+# as WAL needs shared memory that network filesystems don't provide. Workers holding a location heartbeat its
+# lease, and a location whose lease runs out - its worker crashed or lost the queue - goes back to pending for
+# any other worker to claim, with the restaurants that worker had leased.
+
+import os
+import time
+import socket
+import asyncio
+import argparse
+from pathlib import Path
+
+from loguru import logger
+from sqlalchemy import Engine, create_engine, event, select, update, and_, case, func
+from sqlalchemy.dialects.sqlite import insert
+
+import database
+from database import (
+    WorkItem,
+    Restaurant,
+    LocationEntry,
+    SeenEntity,
+    RST_COLUMNS,
+    UPSERT_CHUNK,
+    BUSY_TIMEOUT,
+    upsert_restaurants
+)
+from frontier import release_leases
+from scraper_utils import load_locations
+
+
+LEASE_TIME = 5 * 60 # Seconds a claimed location stays leased without a heartbeat
+HEARTBEAT_INTERVAL = 60 # Seconds between lease renewals - well under LEASE_TIME so one missed beat is harmless
+POLL_INTERVAL = 15 # Seconds an idle worker waits before looking for reclaimed locations again
+MAX_ATTEMPTS = 3 # Claims of a location before it is marked failed
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+CSV_PATH = Path(__file__).resolve().parent / "csv"
+
+
+def open_queue(path: str | Path | None) -> Engine:
+    """Opens the work queue database
+
+    Args:
+        path (str | Path | None): SQLite file shared by the coordinator and workers, None for scrape.db
+
+    Returns:
+        Engine: Engine with the work queue table created
+    """
+    if path is None:
+        return database.engine
+    engine = create_engine(f"sqlite:///{Path(path).resolve()}", connect_args = {"timeout": BUSY_TIMEOUT})
+    event.listen(engine, "connect", set_queue_pragmas)
+    WorkItem.__table__.create(engine, checkfirst = True)
+    return engine
+
+
+def set_queue_pragmas(dbapi_conn, connection_record):
+    # The queue file is shared across machines, where WAL's shared memory index doesn't work
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=DELETE")
+    cursor.close()
+
+
+class WorkQueue:
+    """Locations leased to workers from a shared SQLite database
+
+    Every update is a single statement, so SQLite's write lock makes claims atomic across processes
+    and machines without any other coordination.
+    """
+    def __init__(self,
+                 path: str | Path | None = None,
+                 lease_time: float = LEASE_TIME,
+                 max_attempts: int = MAX_ATTEMPTS):
+        """
+        Args:
+            path (str | Path | None, optional): SQLite file holding the queue, None for scrape.db. Defaults to None.
+            lease_time (float, optional): Seconds a lease lasts without a heartbeat. Defaults to LEASE_TIME.
+            max_attempts (int, optional): Claims of a location before it is marked failed. Defaults to MAX_ATTEMPTS.
+        """
+        self.engine = open_queue(path)
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+
+    def shard(self, queries: list[str], source: str, requeue: bool = False) -> int:
+        """Adds locations to the queue, leaving locations already in it untouched
+
+        Args:
+            queries (list[str]): Location names in CSV order
+            source (str): CSV file the locations came from
+            requeue (bool, optional): Put finished and failed locations back to pending for a new crawl. Defaults to False.
+
+        Returns:
+            int: Number of locations added or put back to pending
+        """
+        now = time.time()
+        rows = [{"query": q, "source": source, "row": i, "updated": now} for i, q in enumerate(dict.fromkeys(queries))]
+        if len(rows) == 0:
+            return 0
+        num_changed = 0
+        with self.engine.begin() as conn:
+            for i in range(0, len(rows), UPSERT_CHUNK):
+                num_changed += conn.execute(insert(WorkItem).on_conflict_do_nothing(index_elements = ["query"]), rows[i:i + UPSERT_CHUNK]).rowcount
+            if requeue:
+                stmt = (
+                    update(WorkItem)
+                    .where(WorkItem.source == source, WorkItem.status.in_(["done", "failed"]))
+                    .values(status = "pending", attempts = 0, worker = "", error = "", result = -1, updated = now)
+                )
+                num_changed += conn.execute(stmt).rowcount
+        return num_changed
+
+    def reclaim(self) -> int:
+        """Puts locations whose leases ran out back to pending, or marks them failed once out of attempts
+
+        The restaurants their workers had leased in the crawl frontier are released too, or whoever claims
+        the location next would skip them until the frontier leases ran out as well.
+
+        Returns:
+            int: Number of expired leases
+        """
+        now = time.time()
+        expired = and_(WorkItem.status == "leased", WorkItem.lease_until < now)
+        with self.engine.begin() as conn:
+            failed = conn.execute(
+                update(WorkItem)
+                .where(expired, WorkItem.attempts >= self.max_attempts)
+                .values(status = "failed", error = "Lease expired", lease_until = 0.0, updated = now)
+                .returning(WorkItem.worker)
+            ).scalars().all()
+            requeued = conn.execute(
+                update(WorkItem).where(expired).values(status = "pending", lease_until = 0.0, updated = now).returning(WorkItem.worker)
+            ).scalars().all()
+        if len(requeued) + len(failed) == 0:
+            return 0
+        num_released = release_leases(list(set(requeued) | set(failed)))
+        logger.warning(f"Reclaimed {len(requeued) + len(failed)} expired leases ({len(failed)} out of attempts), releasing {num_released} restaurants")
+        return len(requeued) + len(failed)
+
+    def claim(self, worker: str, n: int = 1) -> list[str]:
+        """Leases the next pending locations, reclaiming expired leases first
+
+        Args:
+            worker (str): Worker taking the lease
+            n (int, optional): Maximum number of locations. Defaults to 1.
+
+        Returns:
+            list[str]: Claimed location names, empty if nothing is pending
+        """
+        self.reclaim()
+        now = time.time()
+        pending = select(WorkItem.query).where(WorkItem.status == "pending").order_by(WorkItem.row, WorkItem.source).limit(n)
+        stmt = (
+            update(WorkItem)
+            .where(WorkItem.query.in_(pending.scalar_subquery()))
+            .values(
+                status = "leased",
+                worker = worker,
+                attempts = WorkItem.attempts + 1,
+                lease_until = now + self.lease_time,
+                updated = now
+            )
+            .returning(WorkItem.query)
+        )
+        with self.engine.begin() as conn:
+            return list(conn.execute(stmt).scalars())
+
+    def heartbeat(self, worker: str, queries: list[str]) -> list[str]:
+        """Extends the leases a worker still holds
+
+        Args:
+            worker (str): Worker holding the leases
+            queries (list[str]): Locations the worker is scraping
+
+        Returns:
+            list[str]: Locations still leased to the worker - the rest were reclaimed by someone else
+        """
+        if len(queries) == 0:
+            return []
+        now = time.time()
+        stmt = (
+            update(WorkItem)
+            .where(WorkItem.query.in_(queries), WorkItem.status == "leased", WorkItem.worker == worker)
+            .values(lease_until = now + self.lease_time, updated = now)
+            .returning(WorkItem.query)
+        )
+        with self.engine.begin() as conn:
+            return list(conn.execute(stmt).scalars())
+
+    def complete(self, worker: str, query: str, result: int) -> bool:
+        """Marks a location done
+
+        A location reclaimed from a slow worker is still marked done when that worker finishes, as its
+        results are as good as anyone's.
+
+        Args:
+            worker (str): Worker that scraped the location
+            query (str): Location name
+            result (int): Number of restaurant pages scraped
+
+        Returns:
+            bool: Whether the worker still held the lease
+        """
+        now = time.time()
+        with self.engine.begin() as conn:
+            held = conn.execute(
+                select(WorkItem.query).where(WorkItem.query == query, WorkItem.status == "leased", WorkItem.worker == worker)
+            ).first() is not None
+            conn.execute(
+                update(WorkItem)
+                .where(WorkItem.query == query)
+                .values(status = "done", worker = worker, result = result, error = "", lease_until = 0.0, updated = now)
+            )
+        return held
+
+    def fail(self, worker: str, query: str, error: str) -> str | None:
+        """Gives a location back after a failed attempt
+
+        Args:
+            worker (str): Worker that held the lease
+            query (str): Location name
+            error (str): Why the attempt failed
+
+        Returns:
+            str | None: New status - "pending" to be retried, or "failed" once out of attempts. None if the lease was lost
+        """
+        now = time.time()
+        held = and_(WorkItem.query == query, WorkItem.status == "leased", WorkItem.worker == worker)
+        stmt = (
+            update(WorkItem)
+            .where(held)
+            .values(
+                status = case((WorkItem.attempts >= self.max_attempts, "failed"), else_ = "pending"),
+                error = error,
+                lease_until = 0.0,
+                updated = now
+            )
+            .returning(WorkItem.status)
+        )
+        with self.engine.begin() as conn:
+            return conn.execute(stmt).scalar()
+
+    def release(self, worker: str, queries: list[str]):
+        """Returns unfinished locations to pending without counting the attempt, e.g. when a worker is stopped"""
+        if len(queries) == 0:
+            return
+        stmt = (
+            update(WorkItem)
+            .where(WorkItem.query.in_(queries), WorkItem.status == "leased", WorkItem.worker == worker)
+            .values(status = "pending", attempts = WorkItem.attempts - 1, lease_until = 0.0, updated = time.time())
+        )
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
+
+    def counts(self) -> dict[str, int]:
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        with self.engine.connect() as conn:
+            counts.update(dict(conn.execute(select(WorkItem.status, func.count()).group_by(WorkItem.status)).all()))
+        return counts
+
+    def is_finished(self) -> bool:
+        """Whether every location is done or failed - leased locations count as open, as their leases may still run out"""
+        counts = self.counts()
+        return counts["pending"] + counts["leased"] == 0
+
+    def failures(self) -> dict[str, str]:
+        with self.engine.connect() as conn:
+            return dict(conn.execute(select(WorkItem.query, WorkItem.error).where(WorkItem.status == "failed")).all())
+
+
+class QueueWorker:
+    """Feeds a scrape with locations leased from a WorkQueue, heartbeating them until they finish
+
+    Queue calls run in threads so a busy queue database never stalls the event loop.
+    """
+    def __init__(self,
+                 queue: WorkQueue,
+                 worker_id: str = WORKER_ID,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 poll_interval: float = POLL_INTERVAL):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.held: set[str] = set()
+        self.num_done = 0
+        self.num_failed = 0
+        self._task: asyncio.Task | None = None
+
+    async def next(self) -> str | None:
+        """Claims the next location, waiting while other workers hold the rest in case their leases run out
+
+        Returns:
+            str | None: Location name, None once the queue is finished
+        """
+        while True:
+            claimed = await asyncio.to_thread(self.queue.claim, self.worker_id)
+            if len(claimed) > 0:
+                self.held.update(claimed)
+                return claimed[0]
+            if await asyncio.to_thread(self.queue.is_finished):
+                return None
+            await asyncio.sleep(self.poll_interval)
+
+    async def done(self, query: str, result: int | None, error: str = ""):
+        """Reports a location as scraped, or failed if result is None"""
+        self.held.discard(query)
+        if result is not None:
+            self.num_done += 1
+            if not await asyncio.to_thread(self.queue.complete, self.worker_id, query, result):
+                logger.warning(f"[{query}] Finished after its lease had been reclaimed")
+            return
+        self.num_failed += 1
+        status = await asyncio.to_thread(self.queue.fail, self.worker_id, query, error)
+        if status is None:
+            logger.warning(f"[{query}] Failed after its lease was lost - {error}")
+            return
+        logger.warning(f"[{query}] Returned to the queue as {status} - {error}")
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            held = list(self.held)
+            try:
+                kept = await asyncio.to_thread(self.queue.heartbeat, self.worker_id, held)
+            except Exception as e:
+                logger.error(f"Could not renew leases - {e}")
+                continue
+            for query in set(held) - set(kept):
+                logger.warning(f"[{query}] Lease was reclaimed by another worker")
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._heartbeat())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions = True)
+        self._task = None
+        # Anything still held was interrupted, so other workers can take it straight away
+        await asyncio.to_thread(self.queue.release, self.worker_id, list(self.held))
+        self.held.clear()
+        logger.info(f"Worker {self.worker_id} finished {self.num_done} locations, {self.num_failed} failed - queue: {self.queue.counts()}")
+
+    async def __aenter__(self) -> "QueueWorker":
+        self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+async def watch(queue: WorkQueue, interval: float = POLL_INTERVAL):
+    """Reports progress and reclaims expired leases until the queue is finished
+
+    Args:
+        queue (WorkQueue): Queue to watch
+        interval (float, optional): Seconds between checks. Defaults to POLL_INTERVAL.
+    """
+    start = time.monotonic()
+    while True:
+        queue.reclaim()
+        counts = queue.counts()
+        total = sum(counts.values())
+        logger.info(f"{counts['done'] + counts['failed']}/{total} locations finished after {time.monotonic() - start:.0f}s - {counts}")
+        if counts["pending"] + counts["leased"] == 0:
+            break
+        await asyncio.sleep(interval)
+    failures = queue.failures()
+    if len(failures) > 0:
+        logger.warning(f"{len(failures)} locations failed: {failures}")
+
+
+def merge(paths: list[str | Path]) -> int:
+    """Merges the restaurants and resolved locations of worker databases into scrape.db
+
+    Args:
+        paths (list[str | Path]): Worker scrape.db files
+
+    Returns:
+        int: Number of restaurants merged
+    """
+    num_merged = 0
+    for path in paths:
+        source = create_engine(f"sqlite:///{Path(path).resolve()}")
+        with source.connect() as conn:
+            result = conn.execute(select(*[Restaurant.__table__.c[c] for c in RST_COLUMNS]))
+            for chunk in result.mappings().partitions(UPSERT_CHUNK):
+                upsert_restaurants([dict(row) for row in chunk])
+                num_merged += len(chunk)
+            locations = [dict(row) for row in conn.execute(select(LocationEntry)).mappings()]
+            seen = [dict(row) for row in conn.execute(select(SeenEntity)).mappings()]
+        source.dispose()
+        with database.engine.begin() as conn:
+            if locations:
+                stmt = insert(LocationEntry)
+                conn.execute(stmt.on_conflict_do_update(
+                    index_elements = ["query"],
+                    set_ = {c: stmt.excluded[c] for c in locations[0] if c != "query"},
+                    where = LocationEntry.updated < stmt.excluded.updated
+                ), locations)
+            if seen:
+                conn.execute(insert(SeenEntity).on_conflict_do_nothing(index_elements = ["entity_id"]), seen)
+        logger.info(f"Merged {path} - restaurants so far: {num_merged}")
+    return num_merged
+
+
+def main(args: argparse.Namespace):
+    queue = WorkQueue(args.queue, lease_time = args.lease_time)
+    if args.command == "shard":
+        for name in args.csv:
+            file = CSV_PATH / name
+            num_added = queue.shard(load_locations(file), file.stem, requeue = args.requeue)
+            logger.info(f"Queued {num_added} locations from {file.stem}")
+        logger.info(f"Queue: {queue.counts()}")
+    elif args.command == "status":
+        logger.info(f"Queue: {queue.counts()}")
+        for query, error in queue.failures().items():
+            logger.info(f"[{query}] Failed - {error}")
+    elif args.command == "watch":
+        asyncio.run(watch(queue, args.interval))
+    elif args.command == "merge":
+        merge(args.databases)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Distributed crawl coordinator")
+    parser.add_argument(
+        "--queue", "-q",
+        action = "store",
+        help = "SQLite file shared with the workers, scrape.db by default"
+    )
+    parser.add_argument(
+        "--lease-time",
+        action = "store",
+        help = "seconds a lease lasts without a heartbeat",
+        type = float,
+        default = LEASE_TIME
+    )
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    shard_parser = subparsers.add_parser("shard", help = "add the rows of CSV files to the queue")
+    shard_parser.add_argument(
+        "--csv",
+        action = "store",
+        help = "CSV files containing locations to scrape",
+        nargs = "+",
+        required = True
+    )
+    shard_parser.add_argument(
+        "--requeue",
+        action = "store_true",
+        help = "put finished and failed locations from these files back to pending"
+    )
+    subparsers.add_parser("status", help = "print the number of locations in each state and the failures")
+    watch_parser = subparsers.add_parser("watch", help = "report progress and reclaim expired leases until every location is finished")
+    watch_parser.add_argument(
+        "--interval",
+        action = "store",
+        help = "seconds between checks",
+        type = float,
+        default = POLL_INTERVAL
+    )
+    merge_parser = subparsers.add_parser("merge", help = "merge worker databases into scrape.db")
+    merge_parser.add_argument(
+        "databases",
+        action = "store",
+        help = "worker scrape.db files",
+        nargs = "+"
+    )
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+from loguru import logger
+
+from database import Restaurant, to_row, upsert_restaurants
+from telemetry import TELEMETRY
+
+
+WRITE_BATCH_SIZE = 500
+WRITE_INTERVAL = 2 # Maximum seconds between commits while rows are waiting
+
+
+class DatabaseWriter:
+    """Single writer task that batches restaurants across pages into bulk upserts off the event loop"""
+    def __init__(self, batch_size: int = WRITE_BATCH_SIZE, interval: float = WRITE_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.rows_written = 0
+        self.batches = 0
+        self.write_time = 0.0
+        self._queue: asyncio.Queue[dict | None] = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    def add(self, rst_list: list[Restaurant]):
+        # Rows are copied here so ORM objects never cross into the writer thread
+        for rst in rst_list:
+            self._queue.put_nowait(to_row(rst))
+        TELEMETRY.set("queue_depth", self._queue.qsize(), stage = "writer")
+
+    async def _run(self):
+        done = False
+        while not done:
+            batch = []
+            row = await self._queue.get()
+            if row is None:
+                break
+            batch.append(row)
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    done = True
+                    break
+                batch.append(row)
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[dict]):
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(upsert_restaurants, batch)
+        except Exception as e:
+            TELEMETRY.inc("db_write_failures_total")
+            logger.exception(f"Failed to save {len(batch)} restaurants to database - {e}")
+            return
+        elapsed = time.perf_counter() - start
+        TELEMETRY.observe("db_write_seconds", elapsed)
+        TELEMETRY.inc("db_rows_written_total", len(batch))
+        TELEMETRY.set("queue_depth", self._queue.qsize(), stage = "writer")
+        self.write_time += elapsed
+        self.rows_written += len(batch)
+        self.batches += 1
+        logger.debug(f"Saved {len(batch)} restaurants to database")
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+        logger.info(f"Database writer saved {self.rows_written} restaurants in {self.batches} batches ({self.write_time:.2f}s)")
+
+    async def __aenter__(self) -> "DatabaseWriter":
+        self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()